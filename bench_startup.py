@@ -0,0 +1,92 @@
+"""قياس زمن الإقلاع البارد: استيراد وحدة البوت وأول تحديث يعالجه، في مفسر جديد لكل تشغيل.
+
+الاستخدام:
+    python bench_startup.py [--runs 5]
+
+كل تشغيل يبدأ عملية بايثون جديدة (فلا تفيده أي وحدة محمّلة مسبقاً)، تستورد البوت، تهيئ قاعدة SQLite
+مؤقتة، ثم تمرر تحديث /start وهمياً عبر track_first_update و start كما يفعل التطبيق مع أول رسالة.
+لا يتصل بتيليجرام؛ الكائنات الوهمية من bench_tap.py.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from bench_tap import Chat, FakeMessage, load_bot
+
+
+class MessageUpdate:
+    def __init__(self, chat):
+        self.callback_query = None
+        self.message = FakeMessage(chat)
+        self.effective_user = chat.user
+
+
+async def timed_update(bot, chat):
+    started = time.perf_counter()
+    update = MessageUpdate(chat)
+    await bot.track_first_update(update, chat.context)
+    await bot.start(update, chat.context)
+    return time.perf_counter() - started
+
+
+# تعمل داخل العملية الجديدة وتطبع النتائج بصيغة JSON
+def child(db_path):
+    started = time.perf_counter()
+    bot = load_bot(db_path)
+    imported = time.perf_counter()
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.store.init()
+    initialized = time.perf_counter()
+
+    chat = Chat(user_id=424242)
+    first = asyncio.run(timed_update(bot, chat))
+    second = asyncio.run(timed_update(bot, chat))
+    print(json.dumps({
+        'import': imported - started,
+        'module_import': bot.IMPORT_SECONDS,
+        'init': initialized - imported,
+        'first_update': first,
+        'second_update': second,
+        'to_first_reply': time.perf_counter() - started - second,
+        'heavy_loaded': sorted(m for m in ('pandas', 'flask', 'fpdf', 'PIL') if m in sys.modules),
+    }))
+    bot.store.close()
+
+
+def run_once(tmp, index):
+    db_path = os.path.join(tmp, f'startup-{index}.db')
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', db_path],
+                         capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس زمن استيراد البوت وأول تحديث في مفسر جديد")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', metavar='DB_PATH', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [run_once(tmp, i) for i in range(args.runs)]
+    for key in ('process', 'import', 'module_import', 'init', 'first_update', 'second_update', 'to_first_reply'):
+        ms = sorted(r[key] * 1000 for r in results)
+        print(f"{key:<14} median={statistics.median(ms):8.1f}ms min={ms[0]:8.1f}ms max={ms[-1]:8.1f}ms")
+    print(f"heavy modules loaded at first reply: {', '.join(results[-1]['heavy_loaded']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""قياس زمن ضغطة الإجابة (ans_) كاملة عبر handle_callbacks على محركي التخزين.
+
+الاستخدام:
+    python bench_tap.py [--taps 2000] [--engines sqlite,memory]
+
+كل محرك يُقاس مرتين: بدون خلط، ومع خلط الأسئلة والخيارات معاً، لإظهار أن كلفة الضغطة لا تتغير بالخلط.
+
+لا يتصل بتيليجرام: التحديثات والرسائل كائنات وهمية تسجل ما يُرسل فقط،
+وكل ضغطة تستخدم callback_data من أزرار السؤال الذي عرضه البوت فعلاً (الخيار الأول دائماً،
+فتمر الإجابات الخاطئة بمسار جدول المراجعة أيضاً).
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+
+# اسم ملف البوت قد يحمل محارف اتجاه غير مرئية، فنبحث عنه بعد حذفها
+def load_bot(db_path):
+    os.environ['DB_PATH'] = db_path
+    name = next(f for f in os.listdir(HERE) if ''.join(ch for ch in f if ch.isprintable()) == 'main.py')
+    spec = importlib.util.spec_from_file_location('quizbot', os.path.join(HERE, name))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.full_name = 'Bench'
+        self.username = 'bench'
+
+
+class FakeMessage:
+    photo = None
+
+    def __init__(self, chat):
+        self.chat = chat
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.chat.markup = reply_markup
+
+    async def edit_reply_markup(self, reply_markup=None, **kwargs):
+        pass
+
+
+class FakeQuery:
+    def __init__(self, chat, data):
+        self.chat = chat
+        self.data = data
+        self.from_user = chat.user
+        self.message = FakeMessage(chat)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.chat.markup = reply_markup
+
+
+class FakeUpdate:
+    def __init__(self, query):
+        self.callback_query = query
+        self.message = None
+        self.effective_user = query.from_user
+
+
+class FakeBot:
+    def __init__(self, chat):
+        self.chat = chat
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.chat.markup = reply_markup
+
+    async def get_chat_member(self, **kwargs):
+        return None
+
+
+class FakeContext:
+    def __init__(self, chat):
+        self.bot = FakeBot(chat)
+        self.user_data = {}
+        self.args = []
+
+
+class Chat:
+    def __init__(self, user_id):
+        self.user = FakeUser(user_id)
+        self.markup = None
+        self.context = FakeContext(self)
+
+    async def tap(self, bot, data):
+        await bot.handle_callbacks(FakeUpdate(FakeQuery(self, data)), self.context)
+
+    def first_button(self):
+        return self.markup.inline_keyboard[0][0].callback_data
+
+
+def make_store(bot, engine, db_path, counter):
+    store = bot.create_storage(engine, db_path, trace_callback=lambda _: counter.__setitem__(0, counter[0] + 1))
+    store.init()
+    return store
+
+
+async def run_engine(bot, engine, db_path, taps, shuffle):
+    counter = [0]
+    store = make_store(bot, engine, db_path, counter)
+    bot.store = store
+    quiz_id = store.create_quiz('Bench')
+    store.toggle_quiz_flag(quiz_id, 'is_active')
+    if shuffle:
+        store.toggle_quiz_flag(quiz_id, 'shuffle_questions')
+        store.toggle_quiz_flag(quiz_id, 'shuffle_options')
+    # مجموعة أكبر من عدد الضغطات حتى لا تنتهي أثناء القياس
+    rows = [(f'question {i}', f'a{i}', f'b{i}', f'c{i}', f'd{i}', 'ABCD'[i % 4], f'explanation {i}', None)
+            for i in range(taps + 1)]
+    store.import_group(quiz_id, 'bench', rows, {})
+
+    chat = Chat(user_id=424242)
+    store.add_user(chat.user.id, chat.user.full_name, chat.user.username)
+    await chat.tap(bot, f'startquiz_{quiz_id}')
+
+    timings = []
+    counter[0] = 0
+    for _ in range(taps):
+        data = chat.first_button()
+        started = time.perf_counter()
+        await chat.tap(bot, data)
+        timings.append(time.perf_counter() - started)
+    statements = counter[0]
+    answered = store.user_rank(quiz_id, chat.user.id)[2]
+    store.close()
+    if answered != taps:
+        raise RuntimeError(f"{engine}: احتُسبت {answered} إجابة من {taps}")
+    return timings, statements
+
+
+def report(label, timings, statements):
+    timings = sorted(timings)
+    ms = [t * 1000 for t in timings]
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    line = (f"{label:<16} taps={len(ms):<6} mean={statistics.mean(ms):.3f}ms p50={statistics.median(ms):.3f}ms "
+            f"p95={p95:.3f}ms max={ms[-1]:.3f}ms taps/s={len(ms) / sum(timings):.0f}")
+    if statements:
+        line += f" sql/tap={statements / len(ms):.1f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس زمن ضغطة الإجابة على محركي التخزين")
+    parser.add_argument('--taps', type=int, default=2000)
+    parser.add_argument('--engines', default='sqlite,memory')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = load_bot(os.path.join(tmp, 'bench.db'))
+        logging.getLogger().setLevel(logging.WARNING)
+        for engine in args.engines.split(','):
+            for shuffle in (False, True):
+                label = f"{engine}/{'shuffle' if shuffle else 'plain'}"
+                db_path = os.path.join(tmp, f"{engine}-{'shuffle' if shuffle else 'plain'}.db")
+                timings, statements = asyncio.run(run_engine(bot, engine, db_path, args.taps, shuffle))
+                report(label, timings, statements)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1925 @@
+import os
+import abc
+import time
+import bisect
+import shutil
+import difflib
+import sqlite3
+import logging
+import datetime
+import hashlib
+import itertools
+import threading
+import functools
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'required_channel': '',
+    'channel_link': '',
+    'bot_active': '1',
+    'show_channel_link': '1',
+}
+QUIZ_COLUMNS = ('name', 'is_active', 'private_token', 'max_users', 'session_ttl_days',
+                'shuffle_questions', 'shuffle_options')
+HASHED_FIELDS = ('stem', 'a', 'b', 'c', 'd')
+SEARCH_FIELDS = ('stem', 'a', 'b', 'c', 'd', 'explanation')
+SEARCH_WEIGHTS = (3.0, 1.0, 1.0, 1.0, 1.0, 0.5)
+EDIT_SIMILARITY = 0.8
+EDIT_PAIR_WINDOW = 3
+IMPORT_RETRIES = 3
+
+
+class StorageError(Exception):
+    pass
+
+
+def normalize_text(text):
+    text = '' if text is None else str(text)
+    if text.strip().lower() == 'nan':
+        text = ''
+    return ' '.join(text.split()).casefold()
+
+# بصمة السؤال تعتمد على نصه وخياراته فقط، أما الإجابة والشرح والصورة فتُعدّل في مكانها
+def question_text(stem, a, b, c, d):
+    return '\x1f'.join(normalize_text(x) for x in (stem, a, b, c, d))
+
+def question_hash(stem, a, b, c, d):
+    return hashlib.sha256(question_text(stem, a, b, c, d).encode('utf-8')).hexdigest()
+
+def empty_import_summary(rows, incoming):
+    return {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'duplicates': len(rows) - len(incoming)}
+
+def dedupe_import_rows(rows):
+    incoming = {}
+    for row in rows:
+        incoming.setdefault(question_hash(*row[:5]), row)
+    return incoming
+
+# الأسئلة التي اختفت بصمتها تُطابق بالترتيب مع الأسئلة الجديدة القريبة منها نصاً، فيُعد تصحيح خطأ إملائي
+# تعديلاً يبقي رقم السؤال ومراجعاته بدل حذف وإضافة. stale: [(id, نص)] و fresh: [(بصمة, نص)].
+# كل سؤال جديد يُقارن بعدد محدود من الأسئلة التالية فقط، فيبقى العمل خطياً حتى لو تغير الملف كله
+def pair_edited_rows(stale, fresh):
+    pairs, start = [], 0
+    for h, text in fresh:
+        for i in range(start, min(start + EDIT_PAIR_WINDOW, len(stale))):
+            m = difflib.SequenceMatcher(None, stale[i][1], text, autojunk=False)
+            if (m.real_quick_ratio() >= EDIT_SIMILARITY and m.quick_ratio() >= EDIT_SIMILARITY
+                    and m.ratio() >= EDIT_SIMILARITY):
+                pairs.append((stale[i][0], h))
+                start = i + 1
+                break
+    return pairs
+
+# يحسب فرق الاستيراد على لقطة من صفوف المجموعة دون أي كتابة، فيُنفذ قبل فتح معاملة الكتابة.
+# existing_rows: (id, بصمة, متقاعد, stem, a, b, c, d, correct, explanation, image_hash) مرتبة بالرقم.
+# تعيد (inserts: [(بصمة, صف)], updates: [(id, بصمة, صف)], retire: [id], old_ids: الأسئلة الفعالة قبل الاستيراد)
+def plan_import(incoming, existing_rows, summary):
+    existing, old_ids, retire = {}, [], []
+    for q_id, h, retired, *content in existing_rows:
+        if not retired:
+            old_ids.append(q_id)
+        if h is None or h in existing:
+            if not retired:
+                retire.append(q_id)
+        else:
+            existing[h] = (q_id, retired, tuple(content))
+
+    stale = [(q_id, question_text(*content[:5]))
+             for h, (q_id, retired, content) in existing.items() if h not in incoming and not retired]
+    fresh = [(h, question_text(*row[:5])) for h, row in incoming.items() if h not in existing]
+    edited = {h: q_id for q_id, h in pair_edited_rows(stale, fresh)}
+
+    inserts, updates = [], []
+    for h, row in incoming.items():
+        if h in edited:
+            updates.append((edited[h], h, row))
+            summary['updated'] += 1
+        elif h not in existing:
+            inserts.append((h, row))
+            summary['added'] += 1
+        elif existing[h][1]:
+            updates.append((existing[h][0], h, row))
+            summary['added'] += 1
+        elif existing[h][2][5:] != tuple(row[5:]):
+            updates.append((existing[h][0], h, row))
+            summary['updated'] += 1
+        else:
+            summary['unchanged'] += 1
+
+    paired = set(edited.values())
+    retire += [q_id for q_id, _ in stale if q_id not in paired]
+    summary['removed'] += len(retire)
+    return inserts, updates, retire, old_ids
+
+# موضع المستخدم بعد تغيير أسئلة مجموعته: بدون خلط يبقى على نفس السؤال (أو الذي يليه إن أُزيل)،
+# ومع الخلط يتغير الترتيب كله فيُكتفى بإبقاء المؤشر داخل الحدود
+def remap_progress_idx(idx, old_ids, new_ids, shuffled):
+    if shuffled or idx >= len(old_ids):
+        return min(idx, len(new_ids))
+    return bisect.bisect_left(new_ids, old_ids[idx])
+
+
+# --- واجهة التخزين: كل ما تحتاجه المعالجات من بيانات يمر عبر هذه الدوال ---
+class Storage(abc.ABC):
+    name = None
+    can_backup = False
+
+    @abc.abstractmethod
+    def init(self):
+        ...
+
+    # الإعدادات
+    @abc.abstractmethod
+    def get_setting(self, key):
+        ...
+
+    @abc.abstractmethod
+    def set_setting(self, key, value):
+        ...
+
+    # المستخدمون
+    @abc.abstractmethod
+    def add_user(self, user_id, full_name, username):
+        ...
+
+    @abc.abstractmethod
+    def count_users(self):
+        ...
+
+    @abc.abstractmethod
+    def list_user_ids(self):
+        ...
+
+    # تعيد عدد المستخدمين الذين فشل الإرسال إليهم مرتين متتاليتين أو أكثر
+    @abc.abstractmethod
+    def record_deliveries(self, results):
+        ...
+
+    # الاختبارات
+    @abc.abstractmethod
+    def create_quiz(self, name):
+        ...
+
+    @abc.abstractmethod
+    def update_quiz(self, quiz_id, **fields):
+        ...
+
+    @abc.abstractmethod
+    def toggle_quiz_flag(self, quiz_id, column):
+        ...
+
+    @abc.abstractmethod
+    def quiz_name(self, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def find_quiz_by_token(self, token):
+        ...
+
+    @abc.abstractmethod
+    def active_quizzes(self):
+        ...
+
+    @abc.abstractmethod
+    def visible_quizzes(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def quiz_overview(self):
+        ...
+
+    @abc.abstractmethod
+    def quiz_ttls(self):
+        ...
+
+    @abc.abstractmethod
+    def quiz_shuffle(self, quiz_id):
+        ...
+
+    # الوصول الخاص
+    @abc.abstractmethod
+    def private_access_status(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def register_private_access(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def private_users(self, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def clear_private_access(self, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def quiz_visible_to(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def group_visible_to(self, user_id, grp_id):
+        ...
+
+    # المجموعات
+    @abc.abstractmethod
+    def first_group(self, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def next_group(self, quiz_id, grp_id):
+        ...
+
+    @abc.abstractmethod
+    def list_groups(self, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def delete_group(self, grp_id):
+        ...
+
+    # الأسئلة
+    @abc.abstractmethod
+    def group_questions(self, grp_id):
+        ...
+
+    @abc.abstractmethod
+    def answer_context(self, user_id, q_id):
+        ...
+
+    @abc.abstractmethod
+    def get_question(self, q_id):
+        ...
+
+    # تعيد True عند الحفظ، وFalse إذا أصبح السؤال مطابقاً لسؤال آخر في نفس المجموعة، وNone إذا لم يعد موجوداً
+    @abc.abstractmethod
+    def update_question(self, q_id, field, value):
+        ...
+
+    @abc.abstractmethod
+    def import_group(self, quiz_id, group_name, rows, images):
+        ...
+
+    @abc.abstractmethod
+    def group_for_pdf(self, grp_id):
+        ...
+
+    @abc.abstractmethod
+    def search_questions(self, text, limit, offset):
+        ...
+
+    # التقدم والجلسات
+    # الجلسة الحالية كاملة في استدعاء واحد: (المجموعة، المؤشر، البذرة، اسم المجموعة، خلط الأسئلة، خلط الخيارات، الأسئلة)
+    # وتعيد None إذا لم يكن هناك تقدم أو حُذفت مجموعته
+    @abc.abstractmethod
+    def load_session(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def start_progress(self, user_id, quiz_id, grp_id, seed):
+        ...
+
+    @abc.abstractmethod
+    def move_progress(self, user_id, quiz_id, grp_id):
+        ...
+
+    @abc.abstractmethod
+    def clear_progress(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def restore_archived_session(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def evict_idle_batch(self, quiz_id, cutoff, limit, archive):
+        ...
+
+    @abc.abstractmethod
+    def session_table_sizes(self):
+        ...
+
+    # تقدّم المؤشر وتحدّث مجموع النقاط معاً
+    # تُحتسب الإجابة فقط إذا كان المستخدم ما يزال على الموضع idx، وتعيد False للضغطات المتأخرة.
+    # كل سؤال يُحتسب مرة واحدة لكل مستخدم، وتبقى أفضل محاولة (الصحيحة) عند إعادة الاختبار
+    @abc.abstractmethod
+    def record_answer(self, user_id, quiz_id, q_id, idx, is_correct):
+        ...
+
+    # المراجعة المتباعدة
+    @abc.abstractmethod
+    # due_before: تعيد الصف فقط إذا كان موعد مراجعته قد حان (لرفض الضغطات المكررة أو القديمة)
+    def get_review(self, user_id, q_id, due_before=None):
+        ...
+
+    @abc.abstractmethod
+    def save_review(self, user_id, quiz_id, q_id, interval, ease, reps, due_at):
+        ...
+
+    @abc.abstractmethod
+    def count_due_reviews(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def next_due_review(self, user_id, quiz_id):
+        ...
+
+    @abc.abstractmethod
+    def next_review_at(self, user_id, quiz_id):
+        ...
+
+    # لوحة المتصدرين
+    @abc.abstractmethod
+    def top_scores(self, quiz_id, limit, private_only=False):
+        ...
+
+    @abc.abstractmethod
+    def user_rank(self, quiz_id, user_id):
+        ...
+
+    # الصور وذاكرة ملفات PDF
+    @abc.abstractmethod
+    def get_image(self, sha):
+        ...
+
+    @abc.abstractmethod
+    def set_image_file_id(self, sha, file_id):
+        ...
+
+    @abc.abstractmethod
+    def get_pdf_file_id(self, content_hash):
+        ...
+
+    @abc.abstractmethod
+    def set_pdf_file_id(self, content_hash, file_id):
+        ...
+
+    # يحذف دفعة واحدة من صفوف الجدول المطابقة للعمود (أو كل الصفوف) ويعيد عددها
+    @abc.abstractmethod
+    def delete_batch(self, table, column, value, limit):
+        ...
+
+    # النسخ الاحتياطي والاستعادة؛ timeout أقصى مدة للنسخ بالثواني قبل إلغائه
+    def backup(self, dest_path, timeout):
+        raise StorageError(f"النسخ الاحتياطي غير مدعوم في محرك التخزين {self.name}")
+
+    def restore(self, src_path):
+        raise StorageError(f"الاستعادة غير مدعومة في محرك التخزين {self.name}")
+
+    def close(self):
+        pass
+
+
+# --- محرك SQLite (ملف قاعدة البيانات) ---
+# فلاتر خاصة للحذف على دفعات لا تطابق عموداً في الجدول نفسه
+PURGE_FILTERS = {
+    ('reviews', 'group_id'): 'question_id IN (SELECT id FROM questions WHERE group_id=?)',
+    ('answers', 'group_id'): 'question_id IN (SELECT id FROM questions WHERE group_id=?)',
+}
+
+# الاتصال يبقى مفتوحاً ويُعاد استخدامه في نفس الخيط، فلا يُعاد تحليل المخطط مع كل استدعاء.
+# close() لا تغلقه فعلاً، بل تتراجع عن أي معاملة لم تُحفظ حتى يعود الاتصال نظيفاً
+class ThreadConnection(sqlite3.Connection):
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def shutdown(self):
+        sqlite3.Connection.close(self)
+
+class SQLiteStorage(Storage):
+    name = 'sqlite'
+    can_backup = True
+
+    def __init__(self, path, trace_callback=None):
+        self.path = path
+        self.trace_callback = trace_callback
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+
+    def connect(self):
+        thread_id = threading.get_ident()
+        conn = self.connections.get(thread_id)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=20, factory=ThreadConnection)
+            if self.trace_callback:
+                conn.set_trace_callback(self.trace_callback)
+            with self.connections_lock:
+                self.connections[thread_id] = conn
+        return conn
+
+    def close(self):
+        with self.connections_lock:
+            connections, self.connections = self.connections, {}
+        for conn in connections.values():
+            conn.shutdown()
+
+    def init(self):
+        conn = self.connect()
+        c = conn.cursor()
+        # في وضع WAL لا يحجب القراء (كالنسخ الاحتياطي) الكتّاب ولا العكس
+        c.execute('PRAGMA journal_mode=WAL')
+
+        c.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, full_name TEXT, username TEXT, joined_at TIMESTAMP)')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS quizzes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            is_active INTEGER DEFAULT 0,
+            private_token TEXT UNIQUE,
+            max_users INTEGER DEFAULT 0,
+            used_users INTEGER DEFAULT 0,
+            shuffle_questions INTEGER DEFAULT 0,
+            shuffle_options INTEGER DEFAULT 0,
+            session_ttl_days INTEGER DEFAULT 0
+        )''')
+
+        c.execute('CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY AUTOINCREMENT, quiz_id INTEGER, file_name TEXT)')
+        c.execute('''CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quiz_id INTEGER,
+            group_id INTEGER,
+            stem TEXT,
+            a TEXT,
+            b TEXT,
+            c TEXT,
+            d TEXT,
+            correct TEXT,
+            explanation TEXT,
+            image_hash TEXT,
+            content_hash TEXT,
+            retired INTEGER DEFAULT 0
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS progress (
+            user_id INTEGER,
+            quiz_id INTEGER,
+            current_grp_id INTEGER,
+            current_q_idx INTEGER DEFAULT 0,
+            seed INTEGER DEFAULT 0,
+            last_activity INTEGER,
+            PRIMARY KEY (user_id, quiz_id)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS progress_archive (
+            user_id INTEGER,
+            quiz_id INTEGER,
+            current_grp_id INTEGER,
+            current_q_idx INTEGER,
+            seed INTEGER,
+            last_activity INTEGER,
+            archived_at INTEGER
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS private_access (
+            user_id INTEGER,
+            quiz_id INTEGER,
+            accessed_at TIMESTAMP,
+            PRIMARY KEY (user_id, quiz_id)
+        )''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS reviews (
+            user_id INTEGER,
+            quiz_id INTEGER,
+            question_id INTEGER,
+            interval_sec INTEGER DEFAULT 0,
+            ease REAL DEFAULT 2.5,
+            reps INTEGER DEFAULT 0,
+            due_at INTEGER,
+            PRIMARY KEY (user_id, question_id)
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reviews_due ON reviews (user_id, quiz_id, due_at)')
+        # حذف المراجعات مع الأسئلة أو الاختبار يمر بهذين الفهرسين بدل مسح الجدول
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reviews_question ON reviews (question_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reviews_quiz ON reviews (quiz_id)')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS scores (
+            quiz_id INTEGER,
+            user_id INTEGER,
+            correct INTEGER DEFAULT 0,
+            answered INTEGER DEFAULT 0,
+            updated_at INTEGER,
+            PRIMARY KEY (quiz_id, user_id)
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_scores_rank ON scores (quiz_id, correct DESC, answered)')
+
+        # أفضل نتيجة لكل (مستخدم، سؤال) حتى لا تضخم إعادة الاختبار أو الضغط المزدوج النقاط
+        c.execute('''CREATE TABLE IF NOT EXISTS answers (
+            user_id INTEGER,
+            question_id INTEGER,
+            quiz_id INTEGER,
+            correct INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, question_id)
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_answers_quiz ON answers (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_answers_question ON answers (question_id)')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS pdf_cache (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            created_at TIMESTAMP
+        )''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS images (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT,
+            file_id TEXT
+        )''')
+
+        for key, value in DEFAULT_SETTINGS.items():
+            c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+        try:
+            c.execute("SELECT fail_count FROM users LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE users ADD COLUMN fail_count INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة عمود fail_count لجدول المستخدمين")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT private_token FROM quizzes LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE quizzes ADD COLUMN private_token TEXT")
+                conn.commit()
+                logger.info("تم إضافة عمود private_token")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT max_users FROM quizzes LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE quizzes ADD COLUMN max_users INTEGER DEFAULT 0")
+                c.execute("ALTER TABLE quizzes ADD COLUMN used_users INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة أعمدة التحكم في عدد المستخدمين")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT image_hash FROM questions LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE questions ADD COLUMN image_hash TEXT")
+                conn.commit()
+                logger.info("تم إضافة عمود image_hash لجدول الأسئلة")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT content_hash FROM questions LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE questions ADD COLUMN content_hash TEXT")
+                conn.commit()
+                logger.info("تم إضافة عمود content_hash لجدول الأسئلة")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT retired FROM questions LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE questions ADD COLUMN retired INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة عمود retired لجدول الأسئلة")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT shuffle_questions FROM quizzes LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE quizzes ADD COLUMN shuffle_questions INTEGER DEFAULT 0")
+                c.execute("ALTER TABLE quizzes ADD COLUMN shuffle_options INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة أعمدة خلط الأسئلة والخيارات")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT seed FROM progress LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE progress ADD COLUMN seed INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة عمود seed لجدول التقدم")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT last_activity FROM progress LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE progress ADD COLUMN last_activity INTEGER")
+                c.execute("UPDATE progress SET last_activity=?", (int(time.time()),))
+                conn.commit()
+                logger.info("تم إضافة عمود last_activity لجدول التقدم")
+            except sqlite3.OperationalError:
+                pass
+
+        try:
+            c.execute("SELECT session_ttl_days FROM quizzes LIMIT 1")
+        except sqlite3.OperationalError:
+            try:
+                c.execute("ALTER TABLE quizzes ADD COLUMN session_ttl_days INTEGER DEFAULT 0")
+                conn.commit()
+                logger.info("تم إضافة عمود session_ttl_days لجدول الاختبارات")
+            except sqlite3.OperationalError:
+                pass
+
+        # بصمة فريدة لكل سؤال داخل مجموعته؛ الصفوف المكررة القديمة تبقى بلا بصمة حتى أول إعادة رفع
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_questions_hash
+                     ON questions (group_id, content_hash) WHERE content_hash IS NOT NULL''')
+        missing = c.execute('SELECT id, stem, a, b, c, d FROM questions WHERE content_hash IS NULL').fetchall()
+        if missing:
+            c.executemany('UPDATE OR IGNORE questions SET content_hash=? WHERE id=?',
+                          [(question_hash(*r[1:]), r[0]) for r in missing])
+            conn.commit()
+
+        # فهارس تسمح بالحذف على دفعات صغيرة دون مسح الجداول بالكامل
+        c.execute('CREATE INDEX IF NOT EXISTS idx_questions_quiz ON questions (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_questions_group ON questions (group_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_groups_quiz ON groups (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_quiz ON progress (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_group ON progress (current_grp_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_private_access_quiz ON private_access (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_activity ON progress (quiz_id, last_activity)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_archive_user ON progress_archive (user_id, quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_archive_quiz ON progress_archive (quiz_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_progress_archive_group ON progress_archive (current_grp_id)')
+        conn.commit()
+
+        # فهرس البحث النصي الكامل، تبقيه المشغلات (triggers) متزامناً مع جدول الأسئلة
+        try:
+            fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='questions_fts'").fetchone()
+            c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+                stem, a, b, c, d, explanation,
+                content='questions', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS questions_fts_ai AFTER INSERT ON questions BEGIN
+                INSERT INTO questions_fts (rowid, stem, a, b, c, d, explanation)
+                VALUES (new.id, new.stem, new.a, new.b, new.c, new.d, new.explanation);
+            END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS questions_fts_ad AFTER DELETE ON questions BEGIN
+                INSERT INTO questions_fts (questions_fts, rowid, stem, a, b, c, d, explanation)
+                VALUES ('delete', old.id, old.stem, old.a, old.b, old.c, old.d, old.explanation);
+            END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS questions_fts_au AFTER UPDATE OF stem, a, b, c, d, explanation ON questions BEGIN
+                INSERT INTO questions_fts (questions_fts, rowid, stem, a, b, c, d, explanation)
+                VALUES ('delete', old.id, old.stem, old.a, old.b, old.c, old.d, old.explanation);
+                INSERT INTO questions_fts (rowid, stem, a, b, c, d, explanation)
+                VALUES (new.id, new.stem, new.a, new.b, new.c, new.d, new.explanation);
+            END''')
+            if not fts_exists:
+                c.execute("INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')")
+                logger.info("تم إنشاء فهرس البحث للأسئلة")
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.error(f"تعذر إنشاء فهرس البحث FTS5: {e}")
+
+        conn.close()
+        logger.info("تم تهيئة قاعدة البيانات بنجاح")
+
+    # الإعدادات
+    def get_setting(self, key):
+        conn = self.connect()
+        try:
+            result = conn.execute('SELECT value FROM settings WHERE key=?', (key,)).fetchone()
+            return result[0] if result else ''
+        finally:
+            conn.close()
+
+    def set_setting(self, key, value):
+        conn = self.connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # المستخدمون
+    def add_user(self, user_id, full_name, username):
+        conn = self.connect()
+        try:
+            cur = conn.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, joined_at) VALUES (?,?,?,?)',
+                               (user_id, full_name, username, datetime.datetime.now()))
+            conn.commit()
+            return cur.rowcount > 0
+        finally:
+            conn.close()
+
+    def count_users(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        finally:
+            conn.close()
+
+    def list_user_ids(self):
+        conn = self.connect()
+        try:
+            return [r[0] for r in conn.execute('SELECT user_id FROM users')]
+        finally:
+            conn.close()
+
+    def record_deliveries(self, results):
+        conn = self.connect()
+        try:
+            died = 0
+            for uid, ok in results:
+                if ok:
+                    conn.execute('UPDATE users SET fail_count = 0 WHERE user_id = ?', (uid,))
+                    continue
+                conn.execute('UPDATE users SET fail_count = fail_count + 1 WHERE user_id = ?', (uid,))
+                fail = conn.execute('SELECT fail_count FROM users WHERE user_id = ?', (uid,)).fetchone()
+                if fail and fail[0] >= 2:
+                    died += 1
+            conn.commit()
+            return died
+        finally:
+            conn.close()
+
+    # الاختبارات
+    def create_quiz(self, name):
+        conn = self.connect()
+        try:
+            cur = conn.execute('INSERT INTO quizzes (name) VALUES (?)', (name,))
+            conn.commit()
+            return cur.lastrowid
+        finally:
+            conn.close()
+
+    def update_quiz(self, quiz_id, **fields):
+        unknown = set(fields) - set(QUIZ_COLUMNS)
+        if unknown:
+            raise ValueError(f"أعمدة غير معروفة: {', '.join(sorted(unknown))}")
+        assignments = ', '.join(f'{column}=?' for column in fields)
+        conn = self.connect()
+        try:
+            conn.execute(f'UPDATE quizzes SET {assignments} WHERE id=?', (*fields.values(), quiz_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def toggle_quiz_flag(self, quiz_id, column):
+        if column not in ('is_active', 'shuffle_questions', 'shuffle_options'):
+            raise ValueError(f"عمود غير معروف: {column}")
+        conn = self.connect()
+        try:
+            conn.execute(f'UPDATE quizzes SET {column} = 1 - {column} WHERE id=?', (quiz_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def quiz_name(self, quiz_id):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT name FROM quizzes WHERE id=?', (quiz_id,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def find_quiz_by_token(self, token):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, name FROM quizzes WHERE private_token=?', (token,)).fetchone()
+        finally:
+            conn.close()
+
+    def active_quizzes(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, name FROM quizzes WHERE is_active=1').fetchall()
+        finally:
+            conn.close()
+
+    def visible_quizzes(self, user_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT id, name FROM quizzes q
+                                   WHERE is_active=1
+                                      OR EXISTS (SELECT 1 FROM private_access p WHERE p.quiz_id = q.id AND p.user_id = ?)''',
+                                (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def quiz_overview(self):
+        conn = self.connect()
+        try:
+            return conn.execute('''
+                SELECT
+                    q.id,
+                    q.name,
+                    q.is_active,
+                    q.max_users,
+                    q.used_users,
+                    q.shuffle_questions,
+                    q.shuffle_options,
+                    q.session_ttl_days,
+                    (SELECT COUNT(*) FROM groups WHERE quiz_id = q.id) as files_count,
+                    (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id AND retired = 0) as questions_count,
+                    (SELECT COUNT(DISTINCT user_id) FROM progress WHERE quiz_id = q.id) as users_count
+                FROM quizzes q
+            ''').fetchall()
+        finally:
+            conn.close()
+
+    def quiz_ttls(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, session_ttl_days FROM quizzes').fetchall()
+        finally:
+            conn.close()
+
+    def quiz_shuffle(self, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT shuffle_questions, shuffle_options FROM quizzes WHERE id=?', (quiz_id,)).fetchone() or (0, 0)
+        finally:
+            conn.close()
+
+    # الوصول الخاص
+    def private_access_status(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            quiz = conn.execute('SELECT max_users, used_users FROM quizzes WHERE id=?', (quiz_id,)).fetchone()
+            if not quiz:
+                return None
+            existing = conn.execute('SELECT 1 FROM private_access WHERE user_id=? AND quiz_id=?', (user_id, quiz_id)).fetchone()
+            return quiz[0], quiz[1], bool(existing)
+        finally:
+            conn.close()
+
+    def register_private_access(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            conn.execute('INSERT OR IGNORE INTO private_access (user_id, quiz_id, accessed_at) VALUES (?,?,?)',
+                         (user_id, quiz_id, datetime.datetime.now()))
+            conn.execute('''UPDATE quizzes SET used_users = (
+                SELECT COUNT(*) FROM private_access WHERE quiz_id=?
+            ) WHERE id=?''', (quiz_id, quiz_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def private_users(self, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT u.user_id, u.full_name, u.username, p.accessed_at
+                                   FROM private_access p
+                                   JOIN users u ON u.user_id = p.user_id
+                                   WHERE p.quiz_id=?''', (quiz_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def clear_private_access(self, quiz_id):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM private_access WHERE quiz_id=?', (quiz_id,))
+            conn.execute('UPDATE quizzes SET used_users=0 WHERE id=?', (quiz_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # الاختبار مرئي إذا كان مفعلاً أو للمستخدم وصول خاص إليه
+    def quiz_visible_to(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            row = conn.execute('''SELECT q.is_active,
+                                         EXISTS(SELECT 1 FROM private_access p WHERE p.quiz_id = q.id AND p.user_id = ?)
+                                  FROM quizzes q WHERE q.id=?''', (user_id, quiz_id)).fetchone()
+            return bool(row and (row[0] or row[1]))
+        finally:
+            conn.close()
+
+    def group_visible_to(self, user_id, grp_id):
+        conn = self.connect()
+        try:
+            row = conn.execute('''SELECT q.is_active,
+                                         EXISTS(SELECT 1 FROM private_access p WHERE p.quiz_id = q.id AND p.user_id = ?)
+                                  FROM groups g JOIN quizzes q ON q.id = g.quiz_id
+                                  WHERE g.id=?''', (user_id, grp_id)).fetchone()
+            return bool(row and (row[0] or row[1]))
+        finally:
+            conn.close()
+
+    # المجموعات
+    def first_group(self, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=? ORDER BY id LIMIT 1', (quiz_id,)).fetchone()
+        finally:
+            conn.close()
+
+    def next_group(self, quiz_id, grp_id):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=? AND id > ? ORDER BY id LIMIT 1',
+                                (quiz_id, grp_id)).fetchone()
+        finally:
+            conn.close()
+
+    def list_groups(self, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=?', (quiz_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def delete_group(self, grp_id):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM groups WHERE id=?', (grp_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # الأسئلة
+    def group_questions(self, grp_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT id, quiz_id, group_id, stem, a, b, c, d, correct, explanation, image_hash
+                                   FROM questions WHERE group_id=? AND retired=0 ORDER BY id''', (grp_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def answer_context(self, user_id, q_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT q.stem, q.correct, q.explanation, q.a, q.b, q.c, q.d, qz.shuffle_options, p.seed
+                                   FROM questions q
+                                   LEFT JOIN quizzes qz ON qz.id = q.quiz_id
+                                   LEFT JOIN progress p ON p.user_id = ? AND p.quiz_id = q.quiz_id
+                                   WHERE q.id=?''', (user_id, q_id)).fetchone()
+        finally:
+            conn.close()
+
+    def get_question(self, q_id):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT stem, a, b, c, d, correct, explanation FROM questions WHERE id=?', (q_id,)).fetchone()
+        finally:
+            conn.close()
+
+    def update_question(self, q_id, field, value):
+        conn = self.connect()
+        try:
+            if not conn.execute(f'UPDATE questions SET {field}=? WHERE id=?', (value, q_id)).rowcount:
+                return None
+            if field in HASHED_FIELDS:
+                r = conn.execute('SELECT stem, a, b, c, d, group_id FROM questions WHERE id=?', (q_id,)).fetchone()
+                h = question_hash(*r[:5])
+                # السؤال المتقاعد بنفس النص يتنازل عن بصمته للسؤال الفعال
+                conn.execute('UPDATE questions SET content_hash=NULL WHERE group_id=? AND content_hash=? AND retired=1',
+                             (r[5], h))
+                try:
+                    conn.execute('UPDATE questions SET content_hash=? WHERE id=?', (h, q_id))
+                except sqlite3.IntegrityError:
+                    conn.rollback()
+                    return False
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    # إعادة رفع ملف بنفس الاسم تُطبق كفرق على المجموعة الموجودة: يبقى رقم المجموعة ثابتاً، والأسئلة المزالة
+    # تُعلَّم متقاعدة بدل حذفها، ومؤشرات التقدم تُعدَّل لتبقى على نفس السؤال. الفرق يُحسب على لقطة قبل المعاملة،
+    # ثم تتحقق المعاملة القصيرة أن المجموعة لم تتغير وتنفذ الكتابة فقط
+    def import_group(self, quiz_id, group_name, rows, images):
+        incoming = dedupe_import_rows(rows)
+
+        conn = self.connect()
+        try:
+            for _ in range(IMPORT_RETRIES):
+                snapshot = self.group_snapshot(conn, quiz_id, group_name)
+                summary = empty_import_summary(rows, incoming)
+                inserts, updates, retire, old_ids = plan_import(incoming, snapshot[1], summary)
+
+                conn.execute('BEGIN IMMEDIATE')
+                if self.group_snapshot(conn, quiz_id, group_name) != snapshot:
+                    conn.rollback()
+                    continue
+                grp_id = snapshot[0]
+                if grp_id is None:
+                    grp_id = conn.execute('INSERT INTO groups (quiz_id, file_name) VALUES (?,?)',
+                                          (quiz_id, group_name)).lastrowid
+                conn.executemany('INSERT OR IGNORE INTO images (sha256, path) VALUES (?,?)', list(images.items()))
+                conn.executemany('''UPDATE questions SET stem=?, a=?, b=?, c=?, d=?, correct=?, explanation=?, image_hash=?,
+                                    content_hash=?, retired=0 WHERE id=?''',
+                                 [(*row, h, q_id) for q_id, h, row in updates])
+                conn.executemany('''INSERT INTO questions
+                    (quiz_id, group_id, stem, a, b, c, d, correct, explanation, image_hash, content_hash)
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?)''',
+                    [(quiz_id, grp_id, *row, h) for h, row in inserts])
+                conn.executemany('UPDATE questions SET retired=1 WHERE id=?', [(q_id,) for q_id in retire])
+                if snapshot[0] is not None:
+                    self.remap_group_progress(conn, quiz_id, grp_id, old_ids)
+                conn.commit()
+                return snapshot[0] is not None, summary
+            raise StorageError("تغيرت المجموعة أثناء الاستيراد، حاول مرة أخرى")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def group_snapshot(self, conn, quiz_id, group_name):
+        grp = conn.execute('SELECT id FROM groups WHERE quiz_id=? AND file_name=? ORDER BY id LIMIT 1',
+                           (quiz_id, group_name)).fetchone()
+        if not grp:
+            return None, []
+        return grp[0], conn.execute('''SELECT id, content_hash, retired, stem, a, b, c, d, correct, explanation, image_hash
+                                      FROM questions WHERE group_id=? ORDER BY id''', (grp[0],)).fetchall()
+
+    def remap_group_progress(self, conn, quiz_id, grp_id, old_ids):
+        new_ids = [r[0] for r in conn.execute('SELECT id FROM questions WHERE group_id=? AND retired=0 ORDER BY id',
+                                              (grp_id,))]
+        if new_ids == old_ids:
+            return
+        shuffled = (conn.execute('SELECT shuffle_questions FROM quizzes WHERE id=?', (quiz_id,)).fetchone() or (0,))[0]
+        for table in ('progress', 'progress_archive'):
+            rows = conn.execute(f'SELECT rowid, current_q_idx FROM {table} WHERE current_grp_id=?', (grp_id,)).fetchall()
+            conn.executemany(f'UPDATE {table} SET current_q_idx=? WHERE rowid=?',
+                             [(remap_progress_idx(idx or 0, old_ids, new_ids, shuffled), rowid) for rowid, idx in rows])
+
+    def group_for_pdf(self, grp_id):
+        conn = self.connect()
+        try:
+            grp = conn.execute('SELECT file_name FROM groups WHERE id=?', (grp_id,)).fetchone()
+            if not grp:
+                return None, []
+            rows = conn.execute('''SELECT q.stem, q.a, q.b, q.c, q.d, q.correct, q.explanation, i.path
+                                   FROM questions q LEFT JOIN images i ON i.sha256 = q.image_hash
+                                   WHERE q.group_id=? AND q.retired=0 ORDER BY q.id''', (grp_id,)).fetchall()
+            return grp[0], rows
+        finally:
+            conn.close()
+
+    # كل كلمة تُمرر كعبارة بين علامتي تنصيص حتى لا تُفسر كصيغة FTS5
+    @staticmethod
+    def fts_query(text):
+        terms = [t.replace('"', '""') for t in text.split()]
+        return ' '.join(f'"{t}"' for t in terms)
+
+    def search_questions(self, text, limit, offset):
+        conn = self.connect()
+        try:
+            match = self.fts_query(text)
+            total = conn.execute('''SELECT COUNT(*) FROM questions_fts JOIN questions q ON q.id = questions_fts.rowid
+                                    WHERE questions_fts MATCH ? AND q.retired = 0''', (match,)).fetchone()[0]
+            rows = conn.execute('''SELECT q.id, qz.name, g.file_name,
+                                        snippet(questions_fts, -1, '«', '»', '…', 12)
+                                 FROM questions_fts
+                                 JOIN questions q ON q.id = questions_fts.rowid
+                                 LEFT JOIN groups g ON g.id = q.group_id
+                                 LEFT JOIN quizzes qz ON qz.id = q.quiz_id
+                                 WHERE questions_fts MATCH ? AND q.retired = 0
+                                 ORDER BY bm25(questions_fts, 3.0, 1.0, 1.0, 1.0, 1.0, 0.5)
+                                 LIMIT ? OFFSET ?''', (match, limit, offset)).fetchall()
+            return total, rows
+        except sqlite3.OperationalError as e:
+            raise StorageError(str(e))
+        finally:
+            conn.close()
+
+    # التقدم والجلسات
+    def load_session(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            row = conn.execute('''SELECT p.current_grp_id, p.current_q_idx, p.seed, g.file_name,
+                                         COALESCE(qz.shuffle_questions, 0), COALESCE(qz.shuffle_options, 0)
+                                  FROM progress p
+                                  JOIN groups g ON g.id = p.current_grp_id
+                                  LEFT JOIN quizzes qz ON qz.id = p.quiz_id
+                                  WHERE p.user_id=? AND p.quiz_id=?''', (user_id, quiz_id)).fetchone()
+            if not row:
+                return None
+            questions = conn.execute('''SELECT id, quiz_id, group_id, stem, a, b, c, d, correct, explanation, image_hash
+                                        FROM questions WHERE group_id=? AND retired=0 ORDER BY id''', (row[0],)).fetchall()
+            return (*row, questions)
+        finally:
+            conn.close()
+
+    def start_progress(self, user_id, quiz_id, grp_id, seed):
+        conn = self.connect()
+        try:
+            conn.execute('''INSERT OR REPLACE INTO progress (user_id, quiz_id, current_grp_id, current_q_idx, seed, last_activity)
+                            VALUES (?,?,?,0,?,?)''', (user_id, quiz_id, grp_id, seed, int(time.time())))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def move_progress(self, user_id, quiz_id, grp_id):
+        conn = self.connect()
+        try:
+            conn.execute('UPDATE progress SET current_grp_id=?, current_q_idx=0, last_activity=? WHERE user_id=? AND quiz_id=?',
+                         (grp_id, int(time.time()), user_id, quiz_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear_progress(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM progress WHERE user_id=? AND quiz_id=?', (user_id, quiz_id))
+            conn.execute('DELETE FROM progress_archive WHERE user_id=? AND quiz_id=?', (user_id, quiz_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # المستخدم العائد بعد الأرشفة يكمل من حيث توقف
+    def restore_archived_session(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            row = conn.execute('''SELECT rowid, current_grp_id, current_q_idx, seed FROM progress_archive
+                                  WHERE user_id=? AND quiz_id=? ORDER BY archived_at DESC LIMIT 1''', (user_id, quiz_id)).fetchone()
+            if not row:
+                return None
+            conn.execute('''INSERT OR REPLACE INTO progress (user_id, quiz_id, current_grp_id, current_q_idx, seed, last_activity)
+                            VALUES (?,?,?,?,?,?)''', (user_id, quiz_id, row[1], row[2], row[3], int(time.time())))
+            conn.execute('DELETE FROM progress_archive WHERE user_id=? AND quiz_id=?', (user_id, quiz_id))
+            conn.commit()
+            return row[1], row[2], row[3]
+        finally:
+            conn.close()
+
+    def evict_idle_batch(self, quiz_id, cutoff, limit, archive):
+        conn = self.connect()
+        try:
+            rowids = [r[0] for r in conn.execute('SELECT rowid FROM progress WHERE quiz_id=? AND last_activity < ? LIMIT ?',
+                                                 (quiz_id, cutoff, limit))]
+            if not rowids:
+                return 0
+            marks = ','.join('?' * len(rowids))
+            if archive:
+                conn.execute(f'''INSERT INTO progress_archive
+                                 (user_id, quiz_id, current_grp_id, current_q_idx, seed, last_activity, archived_at)
+                                 SELECT user_id, quiz_id, current_grp_id, current_q_idx, seed, last_activity, ?
+                                 FROM progress WHERE rowid IN ({marks})''', (int(time.time()), *rowids))
+            conn.execute(f'DELETE FROM progress WHERE rowid IN ({marks})', rowids)
+            conn.commit()
+            return len(rowids)
+        finally:
+            conn.close()
+
+    def session_table_sizes(self):
+        conn = self.connect()
+        try:
+            return (conn.execute('SELECT COUNT(*) FROM progress').fetchone()[0],
+                    conn.execute('SELECT COUNT(*) FROM progress_archive').fetchone()[0])
+        finally:
+            conn.close()
+
+    # المجاميع تُحدّث مع كل إجابة، فالترتيب يُقرأ مباشرة من الفهرس دون حساب على كل المحاولات
+    def record_answer(self, user_id, quiz_id, q_id, idx, is_correct):
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            if not conn.execute('''UPDATE progress SET current_q_idx = current_q_idx + 1, last_activity=?
+                                   WHERE user_id=? AND quiz_id=? AND current_q_idx=?''',
+                                (now, user_id, quiz_id, idx)).rowcount:
+                conn.rollback()
+                return False
+            prev = conn.execute('SELECT correct FROM answers WHERE user_id=? AND question_id=?', (user_id, q_id)).fetchone()
+            gained = 1 if is_correct and not (prev and prev[0]) else 0
+            if prev is None:
+                conn.execute('INSERT INTO answers (user_id, question_id, quiz_id, correct) VALUES (?,?,?,?)',
+                             (user_id, q_id, quiz_id, gained))
+            elif gained:
+                conn.execute('UPDATE answers SET correct=1 WHERE user_id=? AND question_id=?', (user_id, q_id))
+            conn.execute('''INSERT INTO scores (quiz_id, user_id, correct, answered, updated_at)
+                            VALUES (?,?,?,?,?)
+                            ON CONFLICT (quiz_id, user_id) DO UPDATE SET
+                                correct = correct + excluded.correct,
+                                answered = answered + excluded.answered,
+                                updated_at = excluded.updated_at''',
+                         (quiz_id, user_id, gained, 1 if prev is None else 0, now))
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    # المراجعة المتباعدة
+    def get_review(self, user_id, q_id, due_before=None):
+        conn = self.connect()
+        try:
+            if due_before is not None:
+                return conn.execute('''SELECT interval_sec, ease, reps FROM reviews
+                                       WHERE user_id=? AND question_id=? AND due_at<=?''',
+                                    (user_id, q_id, due_before)).fetchone()
+            return conn.execute('SELECT interval_sec, ease, reps FROM reviews WHERE user_id=? AND question_id=?',
+                                (user_id, q_id)).fetchone()
+        finally:
+            conn.close()
+
+    def save_review(self, user_id, quiz_id, q_id, interval, ease, reps, due_at):
+        conn = self.connect()
+        try:
+            conn.execute('''INSERT OR REPLACE INTO reviews (user_id, quiz_id, question_id, interval_sec, ease, reps, due_at)
+                            VALUES (?,?,?,?,?,?,?)''', (user_id, quiz_id, q_id, interval, ease, reps, due_at))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def count_due_reviews(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT COUNT(*) FROM reviews r JOIN questions q ON q.id = r.question_id AND q.retired = 0
+                                   WHERE r.user_id=? AND r.quiz_id=? AND r.due_at<=?''',
+                                (user_id, quiz_id, int(time.time()))).fetchone()[0]
+        finally:
+            conn.close()
+
+    def next_due_review(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT q.id, q.stem, q.a, q.b, q.c, q.d, q.image_hash, qz.shuffle_options, p.seed
+                                   FROM reviews r
+                                   JOIN questions q ON q.id = r.question_id AND q.retired = 0
+                                   LEFT JOIN quizzes qz ON qz.id = r.quiz_id
+                                   LEFT JOIN progress p ON p.user_id = r.user_id AND p.quiz_id = r.quiz_id
+                                   WHERE r.user_id=? AND r.quiz_id=? AND r.due_at<=?
+                                   ORDER BY r.due_at LIMIT 1''', (user_id, quiz_id, int(time.time()))).fetchone()
+        finally:
+            conn.close()
+
+    def next_review_at(self, user_id, quiz_id):
+        conn = self.connect()
+        try:
+            return conn.execute('''SELECT MIN(r.due_at) FROM reviews r JOIN questions q ON q.id = r.question_id AND q.retired = 0
+                                   WHERE r.user_id=? AND r.quiz_id=?''', (user_id, quiz_id)).fetchone()[0]
+        finally:
+            conn.close()
+
+    # لوحة المتصدرين
+    def top_scores(self, quiz_id, limit, private_only=False):
+        private_filter = ('AND EXISTS (SELECT 1 FROM private_access p WHERE p.quiz_id = s.quiz_id AND p.user_id = s.user_id)'
+                          if private_only else '')
+        conn = self.connect()
+        try:
+            return conn.execute(f'''SELECT s.user_id, u.full_name, u.username, s.correct, s.answered
+                                    FROM scores s LEFT JOIN users u ON u.user_id = s.user_id
+                                    WHERE s.quiz_id=? {private_filter}
+                                    ORDER BY s.correct DESC, s.answered ASC LIMIT ?''', (quiz_id, limit)).fetchall()
+        finally:
+            conn.close()
+
+    def user_rank(self, quiz_id, user_id):
+        conn = self.connect()
+        try:
+            mine = conn.execute('SELECT correct, answered FROM scores WHERE quiz_id=? AND user_id=?', (quiz_id, user_id)).fetchone()
+            if not mine:
+                return None
+            correct, answered = mine
+            rank = conn.execute('''SELECT COUNT(*) + 1 FROM scores
+                                   WHERE quiz_id=? AND (correct > ? OR (correct = ? AND answered < ?))''',
+                                (quiz_id, correct, correct, answered)).fetchone()[0]
+            return rank, correct, answered
+        finally:
+            conn.close()
+
+    # الصور وذاكرة ملفات PDF
+    def get_image(self, sha):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT path, file_id FROM images WHERE sha256=?', (sha,)).fetchone()
+        finally:
+            conn.close()
+
+    def set_image_file_id(self, sha, file_id):
+        conn = self.connect()
+        try:
+            conn.execute('UPDATE images SET file_id=? WHERE sha256=?', (file_id, sha))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_pdf_file_id(self, content_hash):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT file_id FROM pdf_cache WHERE content_hash=?', (content_hash,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def set_pdf_file_id(self, content_hash, file_id):
+        conn = self.connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO pdf_cache (content_hash, file_id, created_at) VALUES (?,?,?)',
+                         (content_hash, file_id, datetime.datetime.now()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # كل دفعة معاملة قصيرة مستقلة، فلا تُحجب الكتابات الأخرى طويلاً
+    def delete_batch(self, table, column, value, limit):
+        if column is None:
+            where, params = '1=1', ()
+        else:
+            where, params = PURGE_FILTERS.get((table, column), f'{column}=?'), (value,)
+        conn = self.connect()
+        try:
+            if table == 'answers':
+                return self.delete_answers_batch(conn, where, params, limit)
+            cur = conn.execute(
+                f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)',
+                (*params, limit)
+            )
+            conn.commit()
+            return cur.rowcount
+        finally:
+            conn.close()
+
+    # حذف الإجابات يطرح أثرها من المجاميع في نفس المعاملة، فلا تُحتسب مرتين عند إعادة رفع مجموعة محذوفة
+    def delete_answers_batch(self, conn, where, params, limit):
+        rows = conn.execute(f'SELECT rowid, quiz_id, user_id, correct FROM answers WHERE {where} LIMIT ?',
+                            (*params, limit)).fetchall()
+        if not rows:
+            return 0
+        totals = {}
+        for _, quiz_id, user_id, correct in rows:
+            answered, right = totals.get((quiz_id, user_id), (0, 0))
+            totals[(quiz_id, user_id)] = (answered + 1, right + (correct or 0))
+        conn.executemany('''UPDATE scores SET answered = MAX(answered - ?, 0), correct = MAX(correct - ?, 0)
+                            WHERE quiz_id=? AND user_id=?''',
+                         [(answered, right, quiz_id, user_id) for (quiz_id, user_id), (answered, right) in totals.items()])
+        conn.executemany('DELETE FROM answers WHERE rowid=?', [(r[0],) for r in rows])
+        conn.commit()
+        return len(rows)
+
+    # نسخ حي بأمر VACUUM INTO من اتصال قراءة مستقل: ينسخ لقطة متسقة في خطوة واحدة، وفي وضع WAL لا يحجب
+    # الكتّاب ولا يعيد البدء عند كل كتابة. معالج التقدم يلغي النسخ إذا تجاوز المهلة حتى لا يعلق للأبد
+    def backup(self, dest_path, timeout):
+        deadline = time.monotonic() + timeout
+        src = sqlite3.connect(self.path, timeout=min(20, timeout))
+        try:
+            src.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try:
+                src.execute('VACUUM INTO ?', (dest_path,))
+            except sqlite3.OperationalError as e:
+                if time.monotonic() > deadline:
+                    raise StorageError(f"تجاوز النسخ الاحتياطي المهلة ({timeout} ث)")
+                raise StorageError(f"فشل النسخ الاحتياطي: {e}")
+        finally:
+            src.close()
+        dst = sqlite3.connect(dest_path)
+        try:
+            result = dst.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise StorageError(f"فشل فحص سلامة النسخة: {result}")
+        finally:
+            dst.close()
+
+    # تُستدعى قبل init()؛ الملف الحالي يُحفظ جانباً ولا يُحذف
+    def restore(self, src_path):
+        self.close()
+        if os.path.exists(self.path):
+            # دمج ملف WAL في القاعدة أولاً حتى تكون النسخة الجانبية كاملة
+            conn = sqlite3.connect(self.path)
+            try:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                conn.close()
+            shutil.copyfile(self.path, f"{self.path}.before-restore-{int(time.time())}")
+        tmp_path = f"{self.path}.restore-tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, self.path)
+        for suffix in ('-wal', '-shm', '-journal'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+# --- المحرك المؤقت في الذاكرة (للتجارب وقياس منطق المعالجات بعيداً عن القرص) ---
+# كل جدول قاموس من المفتاح إلى صف (قاموس أعمدة)، والبيانات تضيع عند إعادة التشغيل
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def fold_text(text):
+    text = unicodedata.normalize('NFKD', '' if text is None else str(text))
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+
+# مقتطف بنحو اثنتي عشرة كلمة حول أول تطابق، على غرار snippet() في FTS5
+def make_snippet(text, terms, size=12):
+    words = str(text).split()
+    hits = [i for i, w in enumerate(words) if any(t in fold_text(w) for t in terms)]
+    if not hits:
+        return ' '.join(words[:size]) + ('…' if len(words) > size else '')
+    start = max(0, min(hits[0] - size // 2, len(words) - size))
+    end = min(len(words), start + size)
+    marked = [f"«{w}»" if i in hits else w for i, w in enumerate(words[start:end], start=start)]
+    return ('…' if start > 0 else '') + ' '.join(marked) + ('…' if end < len(words) else '')
+
+class MemoryStorage(Storage):
+    name = 'memory'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables = {name: {} for name in ('settings', 'users', 'quizzes', 'groups', 'questions', 'progress',
+                                             'progress_archive', 'private_access', 'reviews', 'scores', 'answers',
+                                             'pdf_cache', 'images')}
+        self.ids = {name: itertools.count(1) for name in ('quizzes', 'groups', 'questions', 'progress_archive')}
+
+    @locked
+    def init(self):
+        for key, value in DEFAULT_SETTINGS.items():
+            self.tables['settings'].setdefault(key, value)
+        logger.info("تم تهيئة التخزين المؤقت في الذاكرة (البيانات لا تُحفظ بعد إعادة التشغيل)")
+
+    # الإعدادات
+    @locked
+    def get_setting(self, key):
+        return self.tables['settings'].get(key, '')
+
+    @locked
+    def set_setting(self, key, value):
+        self.tables['settings'][key] = value
+
+    # المستخدمون
+    @locked
+    def add_user(self, user_id, full_name, username):
+        if user_id in self.tables['users']:
+            return False
+        self.tables['users'][user_id] = {'user_id': user_id, 'full_name': full_name, 'username': username,
+                                         'joined_at': datetime.datetime.now(), 'fail_count': 0}
+        return True
+
+    @locked
+    def count_users(self):
+        return len(self.tables['users'])
+
+    @locked
+    def list_user_ids(self):
+        return list(self.tables['users'])
+
+    @locked
+    def record_deliveries(self, results):
+        died = 0
+        for uid, ok in results:
+            user = self.tables['users'].get(uid)
+            if not user:
+                continue
+            user['fail_count'] = 0 if ok else user['fail_count'] + 1
+            if user['fail_count'] >= 2:
+                died += 1
+        return died
+
+    # الاختبارات
+    @locked
+    def create_quiz(self, name):
+        quiz_id = next(self.ids['quizzes'])
+        self.tables['quizzes'][quiz_id] = {'id': quiz_id, 'name': name, 'is_active': 0, 'private_token': None,
+                                           'max_users': 0, 'used_users': 0, 'shuffle_questions': 0,
+                                           'shuffle_options': 0, 'session_ttl_days': 0}
+        return quiz_id
+
+    @locked
+    def update_quiz(self, quiz_id, **fields):
+        unknown = set(fields) - set(QUIZ_COLUMNS)
+        if unknown:
+            raise ValueError(f"أعمدة غير معروفة: {', '.join(sorted(unknown))}")
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if quiz:
+            quiz.update(fields)
+
+    @locked
+    def toggle_quiz_flag(self, quiz_id, column):
+        if column not in ('is_active', 'shuffle_questions', 'shuffle_options'):
+            raise ValueError(f"عمود غير معروف: {column}")
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if quiz:
+            quiz[column] = 1 - quiz[column]
+
+    @locked
+    def quiz_name(self, quiz_id):
+        quiz = self.tables['quizzes'].get(quiz_id)
+        return quiz['name'] if quiz else None
+
+    @locked
+    def find_quiz_by_token(self, token):
+        for quiz in self.tables['quizzes'].values():
+            if token and quiz['private_token'] == token:
+                return quiz['id'], quiz['name']
+        return None
+
+    @locked
+    def active_quizzes(self):
+        return [(q['id'], q['name']) for q in self.tables['quizzes'].values() if q['is_active'] == 1]
+
+    @locked
+    def visible_quizzes(self, user_id):
+        return [(q['id'], q['name']) for q in self.tables['quizzes'].values()
+                if q['is_active'] == 1 or (user_id, q['id']) in self.tables['private_access']]
+
+    @locked
+    def quiz_overview(self):
+        rows = []
+        for q in self.tables['quizzes'].values():
+            files = sum(1 for g in self.tables['groups'].values() if g['quiz_id'] == q['id'])
+            questions = sum(1 for r in self.tables['questions'].values() if r['quiz_id'] == q['id'] and not r['retired'])
+            users = len({p['user_id'] for p in self.tables['progress'].values() if p['quiz_id'] == q['id']})
+            rows.append((q['id'], q['name'], q['is_active'], q['max_users'], q['used_users'], q['shuffle_questions'],
+                         q['shuffle_options'], q['session_ttl_days'], files, questions, users))
+        return rows
+
+    @locked
+    def quiz_ttls(self):
+        return [(q['id'], q['session_ttl_days']) for q in self.tables['quizzes'].values()]
+
+    @locked
+    def quiz_shuffle(self, quiz_id):
+        quiz = self.tables['quizzes'].get(quiz_id)
+        return (quiz['shuffle_questions'], quiz['shuffle_options']) if quiz else (0, 0)
+
+    # الوصول الخاص
+    @locked
+    def private_access_status(self, user_id, quiz_id):
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if not quiz:
+            return None
+        return quiz['max_users'], quiz['used_users'], (user_id, quiz_id) in self.tables['private_access']
+
+    @locked
+    def register_private_access(self, user_id, quiz_id):
+        access = self.tables['private_access']
+        access.setdefault((user_id, quiz_id), {'user_id': user_id, 'quiz_id': quiz_id,
+                                               'accessed_at': datetime.datetime.now()})
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if quiz:
+            quiz['used_users'] = sum(1 for p in access.values() if p['quiz_id'] == quiz_id)
+
+    @locked
+    def private_users(self, quiz_id):
+        users = self.tables['users']
+        return [(p['user_id'], users[p['user_id']]['full_name'], users[p['user_id']]['username'], p['accessed_at'])
+                for p in self.tables['private_access'].values()
+                if p['quiz_id'] == quiz_id and p['user_id'] in users]
+
+    @locked
+    def clear_private_access(self, quiz_id):
+        access = self.tables['private_access']
+        for key in [k for k, p in access.items() if p['quiz_id'] == quiz_id]:
+            del access[key]
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if quiz:
+            quiz['used_users'] = 0
+
+    @locked
+    def quiz_visible_to(self, user_id, quiz_id):
+        quiz = self.tables['quizzes'].get(quiz_id)
+        if not quiz:
+            return False
+        return bool(quiz['is_active'] or (user_id, quiz_id) in self.tables['private_access'])
+
+    @locked
+    def group_visible_to(self, user_id, grp_id):
+        grp = self.tables['groups'].get(grp_id)
+        return bool(grp) and self.quiz_visible_to(user_id, grp['quiz_id'])
+
+    # المجموعات
+    @locked
+    def first_group(self, quiz_id):
+        return self.next_group(quiz_id, 0)
+
+    @locked
+    def next_group(self, quiz_id, grp_id):
+        ids = [g['id'] for g in self.tables['groups'].values() if g['quiz_id'] == quiz_id and g['id'] > grp_id]
+        if not ids:
+            return None
+        grp = self.tables['groups'][min(ids)]
+        return grp['id'], grp['file_name']
+
+    @locked
+    def list_groups(self, quiz_id):
+        return [(g['id'], g['file_name']) for g in self.tables['groups'].values() if g['quiz_id'] == quiz_id]
+
+    @locked
+    def delete_group(self, grp_id):
+        self.tables['groups'].pop(grp_id, None)
+
+    # الأسئلة
+    @locked
+    def group_questions(self, grp_id):
+        return [(q['id'], q['quiz_id'], q['group_id'], q['stem'], q['a'], q['b'], q['c'], q['d'], q['correct'],
+                 q['explanation'], q['image_hash'])
+                for q in sorted(self.tables['questions'].values(), key=lambda r: r['id'])
+                if q['group_id'] == grp_id and not q['retired']]
+
+    @locked
+    def answer_context(self, user_id, q_id):
+        q = self.tables['questions'].get(q_id)
+        if not q:
+            return None
+        quiz = self.tables['quizzes'].get(q['quiz_id']) or {}
+        prog = self.tables['progress'].get((user_id, q['quiz_id'])) or {}
+        return (q['stem'], q['correct'], q['explanation'], q['a'], q['b'], q['c'], q['d'],
+                quiz.get('shuffle_options'), prog.get('seed'))
+
+    @locked
+    def get_question(self, q_id):
+        q = self.tables['questions'].get(q_id)
+        if not q:
+            return None
+        return q['stem'], q['a'], q['b'], q['c'], q['d'], q['correct'], q['explanation']
+
+    @locked
+    def update_question(self, q_id, field, value):
+        q = self.tables['questions'].get(q_id)
+        if not q:
+            return None
+        if field in HASHED_FIELDS:
+            h = question_hash(*({**q, field: value}[f] for f in HASHED_FIELDS))
+            same = [o for o in self.tables['questions'].values()
+                    if o['id'] != q_id and o['group_id'] == q['group_id'] and o['content_hash'] == h]
+            if any(not o['retired'] for o in same):
+                return False
+            # السؤال المتقاعد بنفس النص يتنازل عن بصمته للسؤال الفعال
+            for o in same:
+                o['content_hash'] = None
+            q['content_hash'] = h
+        q[field] = value
+        return True
+
+    @locked
+    def import_group(self, quiz_id, group_name, rows, images):
+        incoming = dedupe_import_rows(rows)
+        summary = empty_import_summary(rows, incoming)
+        for sha, path in images.items():
+            self.tables['images'].setdefault(sha, {'sha256': sha, 'path': path, 'file_id': None})
+
+        grp = next((g for g in sorted(self.tables['groups'].values(), key=lambda r: r['id'])
+                    if g['quiz_id'] == quiz_id and g['file_name'] == group_name), None)
+        questions = self.tables['questions']
+        existing_rows = []
+        if grp:
+            grp_id = grp['id']
+            existing_rows = [(q['id'], q['content_hash'], q['retired'], q['stem'], q['a'], q['b'], q['c'], q['d'],
+                              q['correct'], q['explanation'], q['image_hash'])
+                             for q in sorted(questions.values(), key=lambda r: r['id']) if q['group_id'] == grp_id]
+        else:
+            grp_id = next(self.ids['groups'])
+            self.tables['groups'][grp_id] = {'id': grp_id, 'quiz_id': quiz_id, 'file_name': group_name}
+        inserts, updates, retire, old_ids = plan_import(incoming, existing_rows, summary)
+
+        fields = ('stem', 'a', 'b', 'c', 'd', 'correct', 'explanation', 'image_hash')
+        for q_id, h, row in updates:
+            questions[q_id].update(zip(fields, row), content_hash=h, retired=0)
+        for h, row in inserts:
+            q_id = next(self.ids['questions'])
+            questions[q_id] = {'id': q_id, 'quiz_id': quiz_id, 'group_id': grp_id, 'content_hash': h, 'retired': 0,
+                               **dict(zip(fields, row))}
+        for q_id in retire:
+            questions[q_id]['retired'] = 1
+
+        if grp:
+            self.remap_group_progress(quiz_id, grp_id, old_ids)
+        return bool(grp), summary
+
+    def remap_group_progress(self, quiz_id, grp_id, old_ids):
+        new_ids = [q[0] for q in self.group_questions(grp_id)]
+        if new_ids == old_ids:
+            return
+        shuffled = self.quiz_shuffle(quiz_id)[0]
+        for table in ('progress', 'progress_archive'):
+            for p in self.tables[table].values():
+                if p['current_grp_id'] == grp_id:
+                    p['current_q_idx'] = remap_progress_idx(p['current_q_idx'] or 0, old_ids, new_ids, shuffled)
+
+    @locked
+    def group_for_pdf(self, grp_id):
+        grp = self.tables['groups'].get(grp_id)
+        if not grp:
+            return None, []
+        images = self.tables['images']
+        return grp['file_name'], [(q[3], q[4], q[5], q[6], q[7], q[8], q[9], images.get(q[10], {}).get('path'))
+                                  for q in self.group_questions(grp_id)]
+
+    # بحث خطي بسيط بديل عن FTS5: يجب أن تظهر كل الكلمات، والترتيب بعدد مرات ظهورها موزوناً حسب الحقل
+    @locked
+    def search_questions(self, text, limit, offset):
+        terms = [fold_text(t) for t in text.split()]
+        if not terms:
+            return 0, []
+        matches = []
+        for q in self.tables['questions'].values():
+            if q['retired']:
+                continue
+            folded = [fold_text(q[f]) for f in SEARCH_FIELDS]
+            if not all(any(t in f for f in folded) for t in terms):
+                continue
+            score = sum(w * f.count(t) for w, f in zip(SEARCH_WEIGHTS, folded) for t in terms)
+            best = max(range(len(SEARCH_FIELDS)), key=lambda i: sum(folded[i].count(t) for t in terms))
+            matches.append((-score, q['id'], q, SEARCH_FIELDS[best]))
+        matches.sort(key=lambda m: m[:2])
+        rows = []
+        for _, q_id, q, field in matches[offset:offset + limit]:
+            quiz = self.tables['quizzes'].get(q['quiz_id']) or {}
+            grp = self.tables['groups'].get(q['group_id']) or {}
+            rows.append((q_id, quiz.get('name'), grp.get('file_name'), make_snippet(q[field], terms)))
+        return len(matches), rows
+
+    # التقدم والجلسات
+    @locked
+    def load_session(self, user_id, quiz_id):
+        p = self.tables['progress'].get((user_id, quiz_id))
+        grp = p and self.tables['groups'].get(p['current_grp_id'])
+        if not grp:
+            return None
+        shuffle_q, shuffle_o = self.quiz_shuffle(quiz_id)
+        return (p['current_grp_id'], p['current_q_idx'], p['seed'], grp['file_name'], shuffle_q, shuffle_o,
+                self.group_questions(grp['id']))
+
+    def put_progress(self, user_id, quiz_id, grp_id, idx, seed):
+        self.tables['progress'][(user_id, quiz_id)] = {'user_id': user_id, 'quiz_id': quiz_id, 'current_grp_id': grp_id,
+                                                       'current_q_idx': idx, 'seed': seed,
+                                                       'last_activity': int(time.time())}
+
+    @locked
+    def start_progress(self, user_id, quiz_id, grp_id, seed):
+        self.put_progress(user_id, quiz_id, grp_id, 0, seed)
+
+    @locked
+    def move_progress(self, user_id, quiz_id, grp_id):
+        p = self.tables['progress'].get((user_id, quiz_id))
+        if p:
+            p.update(current_grp_id=grp_id, current_q_idx=0, last_activity=int(time.time()))
+
+    @locked
+    def clear_progress(self, user_id, quiz_id):
+        self.tables['progress'].pop((user_id, quiz_id), None)
+        archive = self.tables['progress_archive']
+        for key in [k for k, a in archive.items() if (a['user_id'], a['quiz_id']) == (user_id, quiz_id)]:
+            del archive[key]
+
+    @locked
+    def restore_archived_session(self, user_id, quiz_id):
+        archive = self.tables['progress_archive']
+        saved = [a for a in archive.values() if (a['user_id'], a['quiz_id']) == (user_id, quiz_id)]
+        if not saved:
+            return None
+        last = max(saved, key=lambda a: a['archived_at'])
+        self.clear_progress(user_id, quiz_id)
+        self.put_progress(user_id, quiz_id, last['current_grp_id'], last['current_q_idx'], last['seed'])
+        return last['current_grp_id'], last['current_q_idx'], last['seed']
+
+    @locked
+    def evict_idle_batch(self, quiz_id, cutoff, limit, archive):
+        progress = self.tables['progress']
+        idle = [k for k, p in progress.items()
+                if p['quiz_id'] == quiz_id and p['last_activity'] is not None and p['last_activity'] < cutoff][:limit]
+        now = int(time.time())
+        for key in idle:
+            p = progress.pop(key)
+            if archive:
+                self.tables['progress_archive'][next(self.ids['progress_archive'])] = {**p, 'archived_at': now}
+        return len(idle)
+
+    @locked
+    def session_table_sizes(self):
+        return len(self.tables['progress']), len(self.tables['progress_archive'])
+
+    @locked
+    def record_answer(self, user_id, quiz_id, q_id, idx, is_correct):
+        now = int(time.time())
+        p = self.tables['progress'].get((user_id, quiz_id))
+        if not p or p['current_q_idx'] != idx:
+            return False
+        p['current_q_idx'] += 1
+        p['last_activity'] = now
+        prev = self.tables['answers'].get((user_id, q_id))
+        gained = 1 if is_correct and not (prev and prev['correct']) else 0
+        if prev is None:
+            self.tables['answers'][(user_id, q_id)] = {'user_id': user_id, 'question_id': q_id, 'quiz_id': quiz_id,
+                                                       'correct': gained}
+        elif gained:
+            prev['correct'] = 1
+        s = self.tables['scores'].setdefault((quiz_id, user_id), {'quiz_id': quiz_id, 'user_id': user_id,
+                                                                  'correct': 0, 'answered': 0, 'updated_at': now})
+        s['correct'] += gained
+        s['answered'] += 1 if prev is None else 0
+        s['updated_at'] = now
+        return True
+
+    # المراجعة المتباعدة
+    @locked
+    def get_review(self, user_id, q_id, due_before=None):
+        r = self.tables['reviews'].get((user_id, q_id))
+        if r and due_before is not None and r['due_at'] > due_before:
+            return None
+        return (r['interval_sec'], r['ease'], r['reps']) if r else None
+
+    @locked
+    def save_review(self, user_id, quiz_id, q_id, interval, ease, reps, due_at):
+        self.tables['reviews'][(user_id, q_id)] = {'user_id': user_id, 'quiz_id': quiz_id, 'question_id': q_id,
+                                                   'interval_sec': interval, 'ease': ease, 'reps': reps,
+                                                   'due_at': due_at}
+
+    def user_reviews(self, user_id, quiz_id):
+        questions = self.tables['questions']
+        return [r for r in self.tables['reviews'].values() if r['user_id'] == user_id and r['quiz_id'] == quiz_id
+                and not questions.get(r['question_id'], {'retired': 1})['retired']]
+
+    @locked
+    def count_due_reviews(self, user_id, quiz_id):
+        now = int(time.time())
+        return sum(1 for r in self.user_reviews(user_id, quiz_id) if r['due_at'] <= now)
+
+    @locked
+    def next_due_review(self, user_id, quiz_id):
+        now = int(time.time())
+        for r in sorted(self.user_reviews(user_id, quiz_id), key=lambda r: r['due_at']):
+            q = self.tables['questions'].get(r['question_id'])
+            if r['due_at'] > now:
+                break
+            if not q:
+                continue
+            quiz = self.tables['quizzes'].get(quiz_id) or {}
+            prog = self.tables['progress'].get((user_id, quiz_id)) or {}
+            return (q['id'], q['stem'], q['a'], q['b'], q['c'], q['d'], q['image_hash'],
+                    quiz.get('shuffle_options'), prog.get('seed'))
+        return None
+
+    @locked
+    def next_review_at(self, user_id, quiz_id):
+        return min((r['due_at'] for r in self.user_reviews(user_id, quiz_id)), default=None)
+
+    # لوحة المتصدرين
+    @locked
+    def top_scores(self, quiz_id, limit, private_only=False):
+        users = self.tables['users']
+        rows = [s for s in self.tables['scores'].values() if s['quiz_id'] == quiz_id
+                and (not private_only or (s['user_id'], quiz_id) in self.tables['private_access'])]
+        rows.sort(key=lambda s: (-s['correct'], s['answered']))
+        return [(s['user_id'], users.get(s['user_id'], {}).get('full_name'), users.get(s['user_id'], {}).get('username'),
+                 s['correct'], s['answered']) for s in rows[:limit]]
+
+    @locked
+    def user_rank(self, quiz_id, user_id):
+        mine = self.tables['scores'].get((quiz_id, user_id))
+        if not mine:
+            return None
+        correct, answered = mine['correct'], mine['answered']
+        ahead = sum(1 for s in self.tables['scores'].values() if s['quiz_id'] == quiz_id
+                    and (s['correct'] > correct or (s['correct'] == correct and s['answered'] < answered)))
+        return ahead + 1, correct, answered
+
+    # الصور وذاكرة ملفات PDF
+    @locked
+    def get_image(self, sha):
+        image = self.tables['images'].get(sha)
+        return (image['path'], image['file_id']) if image else None
+
+    @locked
+    def set_image_file_id(self, sha, file_id):
+        image = self.tables['images'].get(sha)
+        if image:
+            image['file_id'] = file_id
+
+    @locked
+    def get_pdf_file_id(self, content_hash):
+        return self.tables['pdf_cache'].get(content_hash)
+
+    @locked
+    def set_pdf_file_id(self, content_hash, file_id):
+        self.tables['pdf_cache'][content_hash] = file_id
+
+    @locked
+    def delete_batch(self, table, column, value, limit):
+        rows = self.tables[table]
+        if column is None:
+            keys = list(itertools.islice(rows, limit))
+        elif column == 'group_id' and table in ('reviews', 'answers'):
+            questions = self.tables['questions']
+            keys = [k for k, r in rows.items()
+                    if questions.get(r['question_id'], {}).get('group_id') == value][:limit]
+        else:
+            keys = [k for k, r in rows.items() if r.get(column) == value][:limit]
+        for key in keys:
+            removed = rows.pop(key)
+            if table == 'answers':
+                score = self.tables['scores'].get((removed['quiz_id'], removed['user_id']))
+                if score:
+                    score['answered'] = max(score['answered'] - 1, 0)
+                    score['correct'] = max(score['correct'] - removed['correct'], 0)
+        return len(keys)
+
+
+def create_storage(engine, path, trace_callback=None):
+    if engine == 'sqlite':
+        return SQLiteStorage(path, trace_callback=trace_callback)
+    if engine == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"محرك تخزين غير معروف: {engine}")
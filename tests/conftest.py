@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import create_storage
+
+
+# كل اختبار يعمل على المحركين، فأي اختلاف في السلوك بينهما يظهر كفشل
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    st = create_storage(request.param, str(tmp_path / 'quiz.db'))
+    st.init()
+    yield st
+    st.close()
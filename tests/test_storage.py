@@ -0,0 +1,356 @@
+import time
+
+import pytest
+
+from storage import Storage, StorageError, create_storage
+
+
+def row(stem, correct='A', explanation='e', image_hash=None):
+    return (stem, 'opt a', 'opt b', 'opt c', 'opt d', correct, explanation, image_hash)
+
+def rows(result):
+    return [tuple(r) for r in result]
+
+def make_quiz(store, name='Quiz', stems=('first question', 'second question', 'third question')):
+    quiz_id = store.create_quiz(name)
+    store.import_group(quiz_id, 'g1', [row(s) for s in stems], {})
+    grp_id = store.first_group(quiz_id)[0]
+    return quiz_id, grp_id, [q[0] for q in store.group_questions(grp_id)]
+
+# (المجموعة، المؤشر، البذرة) من الجلسة الحالية، أو None
+def progress(store, user_id, quiz_id):
+    session = store.load_session(user_id, quiz_id)
+    return tuple(session[:3]) if session else None
+
+
+def test_interface_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        create_storage('redis', 'x.db')
+
+
+# الإعدادات والمستخدمون
+def test_settings(store):
+    assert store.get_setting('bot_active') == '1'
+    assert store.get_setting('missing') in ('', None)
+    store.set_setting('required_channel', '@chan')
+    assert store.get_setting('required_channel') == '@chan'
+
+def test_users(store):
+    assert store.add_user(1, 'A', 'a') is True
+    assert store.add_user(1, 'A', 'a') is False
+    store.add_user(2, 'B', None)
+    assert store.count_users() == 2
+    assert sorted(store.list_user_ids()) == [1, 2]
+
+def test_record_deliveries(store):
+    store.add_user(1, 'A', 'a')
+    store.add_user(2, 'B', 'b')
+    assert store.record_deliveries([(1, False), (2, True)]) == 0
+    assert store.record_deliveries([(1, False), (2, True), (99, False)]) == 1
+    assert store.record_deliveries([(1, True)]) == 0
+
+
+# الاختبارات والوصول الخاص
+def test_quiz_crud(store):
+    quiz_id = store.create_quiz('Quiz')
+    assert store.quiz_name(quiz_id) == 'Quiz'
+    assert store.quiz_name(999) is None
+    store.update_quiz(quiz_id, name='Renamed', session_ttl_days=3, private_token='tok')
+    assert store.quiz_name(quiz_id) == 'Renamed'
+    assert tuple(store.find_quiz_by_token('tok')) == (quiz_id, 'Renamed')
+    assert store.find_quiz_by_token('nope') is None
+    assert (quiz_id, 3) in rows(store.quiz_ttls())
+    with pytest.raises(ValueError):
+        store.update_quiz(quiz_id, owner=1)
+
+def test_quiz_flags(store):
+    quiz_id = store.create_quiz('Quiz')
+    assert rows(store.active_quizzes()) == []
+    store.toggle_quiz_flag(quiz_id, 'is_active')
+    assert rows(store.active_quizzes()) == [(quiz_id, 'Quiz')]
+    store.toggle_quiz_flag(quiz_id, 'shuffle_options')
+    assert tuple(store.quiz_shuffle(quiz_id)) == (0, 1)
+    assert tuple(store.quiz_shuffle(999)) == (0, 0)
+    with pytest.raises(ValueError):
+        store.toggle_quiz_flag(quiz_id, 'name')
+
+def test_quiz_overview(store):
+    quiz_id, grp_id, _ = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    overview = rows(store.quiz_overview())
+    assert overview == [(quiz_id, 'Quiz', 0, 0, 0, 0, 0, 0, 1, 3, 1)]
+
+def test_private_access(store):
+    store.add_user(2, 'B', 'b')
+    quiz_id = store.create_quiz('Private')
+    store.update_quiz(quiz_id, max_users=5)
+    assert tuple(store.private_access_status(2, quiz_id))[:2] == (5, 0)
+    assert not store.private_access_status(2, quiz_id)[2]
+    assert not store.quiz_visible_to(2, quiz_id)
+    assert store.private_access_status(2, 999) is None
+    store.register_private_access(2, quiz_id)
+    store.register_private_access(2, quiz_id)
+    max_users, used, registered = store.private_access_status(2, quiz_id)
+    assert (max_users, used, bool(registered)) == (5, 1, True)
+    assert rows(store.visible_quizzes(2)) == [(quiz_id, 'Private')]
+    assert store.quiz_visible_to(2, quiz_id)
+    assert not store.quiz_visible_to(3, quiz_id)
+    assert not store.quiz_visible_to(2, 999)
+    assert rows(store.visible_quizzes(3)) == []
+    assert [tuple(u)[:3] for u in store.private_users(quiz_id)] == [(2, 'B', 'b')]
+    store.clear_private_access(quiz_id)
+    assert rows(store.private_users(quiz_id)) == []
+    assert tuple(store.private_access_status(2, quiz_id))[:2] == (5, 0)
+
+
+# المجموعات والأسئلة
+def test_groups(store):
+    quiz_id, g1, _ = make_quiz(store)
+    store.import_group(quiz_id, 'g2', [row('other')], {})
+    g2 = store.next_group(quiz_id, g1)[0]
+    assert tuple(store.first_group(quiz_id)) == (g1, 'g1')
+    assert tuple(store.next_group(quiz_id, g1)) == (g2, 'g2')
+    assert store.next_group(quiz_id, g2) is None
+    assert sorted(rows(store.list_groups(quiz_id))) == [(g1, 'g1'), (g2, 'g2')]
+    assert not store.group_visible_to(5, g1)
+    store.toggle_quiz_flag(quiz_id, 'is_active')
+    assert store.group_visible_to(5, g1)
+    assert not store.group_visible_to(5, 999)
+    store.delete_group(g2)
+    assert rows(store.list_groups(quiz_id)) == [(g1, 'g1')]
+
+def test_questions(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    questions = rows(store.group_questions(grp_id))
+    assert [q[3] for q in questions] == ['first question', 'second question', 'third question']
+    assert questions[0][1:3] == (quiz_id, grp_id)
+    assert tuple(store.get_question(ids[0])) == ('first question', 'opt a', 'opt b', 'opt c', 'opt d', 'A', 'e')
+    assert store.get_question(999) is None
+    store.start_progress(1, quiz_id, grp_id, 7)
+    assert tuple(store.answer_context(1, ids[0])) == ('first question', 'A', 'e', 'opt a', 'opt b', 'opt c', 'opt d', 0, 7)
+    assert store.answer_context(1, 999) is None
+
+def test_update_question(store):
+    _, grp_id, ids = make_quiz(store)
+    assert store.update_question(ids[0], 'explanation', 'new') is True
+    assert store.get_question(ids[0])[6] == 'new'
+    assert store.update_question(ids[1], 'stem', 'First  Question') is False
+    assert store.get_question(ids[1])[0] == 'second question'
+    assert store.update_question(999, 'stem', 'x') is None
+
+def test_import_diff(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    updated, summary = store.import_group(quiz_id, 'g1', [row('first question', 'B'), row('second question'),
+                                                          row('second question'), row('brand new entry')], {})
+    assert updated is True
+    assert summary == {'added': 1, 'updated': 1, 'removed': 1, 'unchanged': 1, 'duplicates': 1}
+    questions = rows(store.group_questions(grp_id))
+    assert [q[0] for q in questions][:2] == ids[:2]
+    assert questions[0][8] == 'B'
+
+def test_import_typo_keeps_id_and_reviews(store):
+    quiz_id, grp_id, ids = make_quiz(store, stems=('What is the capital of France?', 'Who wrote the book Hamlet?'))
+    store.save_review(1, quiz_id, ids[1], 0, 2.5, 0, 0)
+    _, summary = store.import_group(quiz_id, 'g1', [row('What is the capital of France?'),
+                                                    row('Who wrote the play Hamlet?')], {})
+    assert (summary['updated'], summary['added'], summary['removed']) == (1, 0, 0)
+    assert [q[0] for q in store.group_questions(grp_id)] == ids
+    assert tuple(store.get_review(1, ids[1])) == (0, 2.5, 0)
+
+def test_import_retires_and_revives(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    store.record_answer(1, quiz_id, ids[0], 0, True)
+    store.record_answer(1, quiz_id, ids[1], 1, True)
+    store.save_review(1, quiz_id, ids[0], 0, 2.5, 0, 0)
+    # حذف السؤال الأول يجب ألا ينقل المستخدم إلى سؤال آخر
+    _, summary = store.import_group(quiz_id, 'g1', [row('second question'), row('third question')], {})
+    assert summary['removed'] == 1
+    assert [q[0] for q in store.group_questions(grp_id)] == ids[1:]
+    assert progress(store, 1, quiz_id) == (grp_id, 1, 7)
+    assert store.count_due_reviews(1, quiz_id) == 0
+    assert store.search_questions('first', 10, 0)[0] == 0
+    assert store.quiz_overview()[0][9] == 2
+    _, summary = store.import_group(quiz_id, 'g1', [row('first question'), row('second question'),
+                                                    row('third question')], {})
+    assert summary['added'] == 1
+    assert [q[0] for q in store.group_questions(grp_id)] == ids
+    assert progress(store, 1, quiz_id) == (grp_id, 2, 7)
+    assert store.count_due_reviews(1, quiz_id) == 1
+
+def test_group_for_pdf(store):
+    quiz_id = store.create_quiz('Quiz')
+    store.import_group(quiz_id, 'g1', [row('with image', image_hash='h1'), row('plain')], {'h1': '/img/h1.png'})
+    grp_id = store.first_group(quiz_id)[0]
+    name, pdf_rows = store.group_for_pdf(grp_id)
+    assert name == 'g1'
+    assert [(r[0], r[7]) for r in pdf_rows] == [('with image', '/img/h1.png'), ('plain', None)]
+    assert store.group_for_pdf(999) == (None, [])
+
+def test_search(store):
+    make_quiz(store, stems=('capital of France', 'capital of Egypt', 'largest planet'))
+    total, found = store.search_questions('capital', 1, 0)
+    assert total == 2
+    assert len(found) == 1
+    assert tuple(found[0])[1:3] == ('Quiz', 'g1')
+    assert store.search_questions('capital egypt', 10, 0)[0] == 1
+    assert store.search_questions('missing', 10, 0) == (0, [])
+
+
+# التقدم والجلسات
+def test_progress(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    store.import_group(quiz_id, 'g2', [row('other')], {})
+    g2 = store.next_group(quiz_id, grp_id)[0]
+    assert store.load_session(1, quiz_id) is None
+    store.start_progress(1, quiz_id, grp_id, 7)
+    assert progress(store, 1, quiz_id) == (grp_id, 0, 7)
+    session = store.load_session(1, quiz_id)
+    assert session[:6] == (grp_id, 0, 7, 'g1', 0, 0)
+    assert [q[0] for q in session[6]] == ids
+    store.move_progress(1, quiz_id, g2)
+    assert progress(store, 1, quiz_id) == (g2, 0, 7)
+    store.delete_group(g2)
+    assert store.load_session(1, quiz_id) is None
+    store.clear_progress(1, quiz_id)
+    assert progress(store, 1, quiz_id) is None
+
+def test_evict_and_restore(store):
+    quiz_id, grp_id, _ = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    store.start_progress(2, quiz_id, grp_id, 8)
+    assert tuple(store.session_table_sizes()) == (2, 0)
+    assert store.evict_idle_batch(quiz_id, int(time.time()) + 10, 1, True) == 1
+    assert store.evict_idle_batch(quiz_id, int(time.time()) + 10, 10, False) == 1
+    assert tuple(store.session_table_sizes()) == (0, 1)
+    restored = [uid for uid in (1, 2) if store.restore_archived_session(uid, quiz_id)]
+    assert len(restored) == 1
+    assert tuple(store.session_table_sizes()) == (1, 0)
+    assert store.restore_archived_session(restored[0], quiz_id) is None
+
+def test_clear_progress_drops_archive(store):
+    quiz_id, grp_id, _ = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    store.evict_idle_batch(quiz_id, int(time.time()) + 10, 10, True)
+    store.clear_progress(1, quiz_id)
+    assert store.restore_archived_session(1, quiz_id) is None
+
+
+# الإجابات ولوحة المتصدرين
+def test_record_answer_counts_each_question_once(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    store.add_user(1, 'A', 'a')
+    store.start_progress(1, quiz_id, grp_id, 7)
+    assert store.record_answer(1, quiz_id, ids[0], 0, False) is True
+    assert store.record_answer(1, quiz_id, ids[0], 0, True) is False
+    assert progress(store, 1, quiz_id) == (grp_id, 1, 7)
+    assert tuple(store.user_rank(quiz_id, 1)) == (1, 0, 1)
+    # إعادة الاختبار تحتفظ بأفضل محاولة ولا تضخم عدد الإجابات
+    store.start_progress(1, quiz_id, grp_id, 9)
+    store.record_answer(1, quiz_id, ids[0], 0, True)
+    store.record_answer(1, quiz_id, ids[1], 1, True)
+    store.start_progress(1, quiz_id, grp_id, 10)
+    store.record_answer(1, quiz_id, ids[0], 0, False)
+    assert tuple(store.user_rank(quiz_id, 1)) == (1, 2, 2)
+    assert store.record_answer(2, quiz_id, ids[0], 0, True) is False
+
+def test_group_purge_subtracts_answers_from_scores(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    for idx, q_id in enumerate(ids):
+        store.record_answer(1, quiz_id, q_id, idx, idx != 1)
+    assert tuple(store.user_rank(quiz_id, 1)) == (1, 2, 3)
+    for table in ('answers', 'questions', 'progress'):
+        column = 'current_grp_id' if table == 'progress' else 'group_id'
+        while store.delete_batch(table, column, grp_id, 2):
+            pass
+    store.delete_group(grp_id)
+    assert tuple(store.user_rank(quiz_id, 1)) == (1, 0, 0)
+    # المجموعة المعاد رفعها تأخذ أرقاماً جديدة، فتُحتسب من جديد دون تضاعف
+    store.import_group(quiz_id, 'g1', [row('first question'), row('second question'), row('third question')], {})
+    grp_id = store.first_group(quiz_id)[0]
+    store.start_progress(1, quiz_id, grp_id, 7)
+    for idx, q in enumerate(store.group_questions(grp_id)):
+        store.record_answer(1, quiz_id, q[0], idx, True)
+    assert tuple(store.user_rank(quiz_id, 1)) == (1, 3, 3)
+
+def test_leaderboard(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    for uid, name in ((1, 'A'), (2, 'B'), (3, 'C')):
+        store.add_user(uid, name, name.lower())
+        store.start_progress(uid, quiz_id, grp_id, 7)
+    store.record_answer(1, quiz_id, ids[0], 0, True)
+    store.record_answer(2, quiz_id, ids[0], 0, True)
+    store.record_answer(2, quiz_id, ids[1], 1, True)
+    store.record_answer(3, quiz_id, ids[0], 0, False)
+    store.register_private_access(3, quiz_id)
+    assert rows(store.top_scores(quiz_id, 2)) == [(2, 'B', 'b', 2, 2), (1, 'A', 'a', 1, 1)]
+    assert rows(store.top_scores(quiz_id, 10, private_only=True)) == [(3, 'C', 'c', 0, 1)]
+    assert tuple(store.user_rank(quiz_id, 3)) == (3, 0, 1)
+    assert store.user_rank(quiz_id, 99) is None
+
+def test_reviews(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    now = int(time.time())
+    assert store.get_review(1, ids[0]) is None
+    assert store.next_due_review(1, quiz_id) is None
+    assert store.next_review_at(1, quiz_id) is None
+    store.start_progress(1, quiz_id, grp_id, 7)
+    store.save_review(1, quiz_id, ids[0], 0, 2.3, 0, now - 5)
+    store.save_review(1, quiz_id, ids[1], 86400, 2.5, 1, now + 3600)
+    assert tuple(store.get_review(1, ids[0])) == (0, 2.3, 0)
+    assert tuple(store.get_review(1, ids[0], due_before=now)) == (0, 2.3, 0)
+    assert store.get_review(1, ids[1], due_before=now) is None
+    assert store.count_due_reviews(1, quiz_id) == 1
+    due = tuple(store.next_due_review(1, quiz_id))
+    assert due[:2] == (ids[0], 'first question')
+    assert due[7:] == (0, 7)
+    assert store.next_review_at(1, quiz_id) == now - 5
+
+
+# الصور وذاكرة PDF والحذف على دفعات
+def test_images_and_pdf_cache(store):
+    quiz_id = store.create_quiz('Quiz')
+    store.import_group(quiz_id, 'g1', [row('with image', image_hash='h1')], {'h1': '/img/h1.png'})
+    store.import_group(quiz_id, 'g2', [row('same image', image_hash='h1')], {'h1': '/other.png'})
+    assert tuple(store.get_image('h1')) == ('/img/h1.png', None)
+    store.set_image_file_id('h1', 'FILE')
+    assert tuple(store.get_image('h1')) == ('/img/h1.png', 'FILE')
+    assert store.get_image('missing') is None
+    assert store.get_pdf_file_id('hash') is None
+    store.set_pdf_file_id('hash', 'PDF')
+    assert store.get_pdf_file_id('hash') == 'PDF'
+
+def test_delete_batch(store):
+    quiz_id, grp_id, ids = make_quiz(store)
+    store.start_progress(1, quiz_id, grp_id, 7)
+    store.record_answer(1, quiz_id, ids[0], 0, True)
+    store.save_review(1, quiz_id, ids[0], 0, 2.5, 0, 0)
+    assert store.delete_batch('reviews', 'group_id', grp_id, 10) == 1
+    assert store.delete_batch('answers', 'group_id', grp_id, 10) == 1
+    assert store.delete_batch('questions', 'group_id', grp_id, 2) == 2
+    assert store.delete_batch('questions', 'group_id', grp_id, 2) == 1
+    assert store.delete_batch('questions', 'group_id', grp_id, 2) == 0
+    assert store.delete_batch('progress', None, None, 10) == 1
+    assert progress(store, 1, quiz_id) is None
+
+
+# النسخ الاحتياطي والاستعادة
+def test_backup_and_restore(store, tmp_path):
+    quiz_id = store.create_quiz('Quiz')
+    dest = str(tmp_path / 'backup.db')
+    if not store.can_backup:
+        with pytest.raises(StorageError):
+            store.backup(dest, 60)
+        with pytest.raises(StorageError):
+            store.restore(dest)
+        return
+    store.backup(dest, 60)
+    store.update_quiz(quiz_id, name='Changed')
+    store.restore(dest)
+    store.init()
+    assert store.quiz_name(quiz_id) == 'Quiz'
@@ -1,20 +1,33 @@
+import time
+PROCESS_START = time.perf_counter()
 import os
 from dotenv import load_dotenv
 load_dotenv()
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 OWNER_ID = int(os.environ.get('OWNER_ID', 0))
-import sqlite3
 import logging
-import pandas as pd
 import io
 import datetime
 import secrets
+import random
+import asyncio
+import hashlib
+import json
+import zipfile
+import sys
+import heapq
+import functools
+import itertools
+import threading
+import traceback
+import contextvars
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, User
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from flask import Flask
-from threading import Thread
-import time
-from keep_alive import keep_alive
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+from storage import create_storage, StorageError
+
+IMPORT_SECONDS = time.perf_counter() - PROCESS_START
 
 # --- الإعدادات ----
 logging.basicConfig(
@@ -23,143 +36,216 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- خادم Flask للحفاظ على البوت نشطاً (اختياري، يمكن تعطيله) ---
-app_flask = Flask(__name__)
-
-@app_flask.route('/')
-def home():
-    return "Bot is Running!"
-
-@app_flask.route('/health')
-def health():
-    return "OK", 200
+# --- خادم HTTP للحفاظ على البوت نشطاً (يعمل على حلقة أحداث البوت نفسها) ---
+HTTP_PORT = int(os.environ.get('PORT', 5000))
+startup_metrics = {
+    'import_seconds': IMPORT_SECONDS,
+    'ready_seconds': None,
+    'first_update_seconds': None,
+}
 
-def run_flask():
+async def handle_http(reader, writer):
     try:
-        app_flask.run(host='0.0.0.0', port=5000)
-    except Exception as e:
-        logger.error(f"خطأ في تشغيل Flask: {e}")
-
-def keep_alive():
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info("تم تشغيل خادم Flask للحفاظ على البوت نشطاً")
-
-# --- قاعدة البيانات ---
-def get_db():
-    return sqlite3.connect('quiz_system.db', check_same_thread=False, timeout=20)
-
-def init_db():
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, full_name TEXT, username TEXT, joined_at TIMESTAMP)')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS quizzes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        is_active INTEGER DEFAULT 0,
-        private_token TEXT UNIQUE,
-        max_users INTEGER DEFAULT 0,
-        used_users INTEGER DEFAULT 0
-    )''')
-
-    c.execute('CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY AUTOINCREMENT, quiz_id INTEGER, file_name TEXT)')
-    c.execute('''CREATE TABLE IF NOT EXISTS questions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        quiz_id INTEGER,
-        group_id INTEGER,
-        stem TEXT,
-        a TEXT,
-        b TEXT,
-        c TEXT,
-        d TEXT,
-        correct TEXT,
-        explanation TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS progress (
-        user_id INTEGER,
-        quiz_id INTEGER,
-        current_grp_id INTEGER,
-        current_q_idx INTEGER DEFAULT 0,
-        PRIMARY KEY (user_id, quiz_id)
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS private_access (
-        user_id INTEGER,
-        quiz_id INTEGER,
-        accessed_at TIMESTAMP,
-        PRIMARY KEY (user_id, quiz_id)
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )''')
-
-    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('required_channel', ''))
-    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('channel_link', ''))
-    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('bot_active', '1'))
-    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('show_channel_link', '1'))
-
-    try:
-        c.execute("SELECT fail_count FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN fail_count INTEGER DEFAULT 0")
-            conn.commit()
-            logger.info("تم إضافة عمود fail_count لجدول المستخدمين")
-        except sqlite3.OperationalError:
-            pass
-
-    try:
-        c.execute("SELECT private_token FROM quizzes LIMIT 1")
-    except sqlite3.OperationalError:
-        try:
-            c.execute("ALTER TABLE quizzes ADD COLUMN private_token TEXT")
-            conn.commit()
-            logger.info("تم إضافة عمود private_token")
-        except sqlite3.OperationalError:
-            pass
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else '/'
+        content_type = 'text/plain; charset=utf-8'
+        if path == '/':
+            status, body = '200 OK', "Bot is Running!"
+        elif path == '/health':
+            status, body = '200 OK', "OK"
+        elif path == '/metrics':
+            status, body = '200 OK', json.dumps(startup_metrics)
+            content_type = 'application/json'
+        else:
+            status, body = '404 Not Found', "Not Found"
+        payload = body.encode('utf-8')
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
 
+async def on_startup(app):
     try:
-        c.execute("SELECT max_users FROM quizzes LIMIT 1")
-    except sqlite3.OperationalError:
+        app.bot_data['http_server'] = await asyncio.start_server(handle_http, '0.0.0.0', HTTP_PORT)
+        logger.info(f"تم تشغيل خادم HTTP للحفاظ على البوت نشطاً على المنفذ {HTTP_PORT}")
+    except OSError as e:
+        logger.error(f"خطأ في تشغيل خادم HTTP: {e}")
+    if DIAGNOSTICS:
+        start_diagnostics(app)
+    startup_metrics['ready_seconds'] = time.perf_counter() - PROCESS_START
+    logger.info(f"زمن الاستيراد: {IMPORT_SECONDS:.2f} ث | زمن الجاهزية: {startup_metrics['ready_seconds']:.2f} ث")
+
+async def on_shutdown(app):
+    global pdf_pool
+    stop_diagnostics(app)
+    server = app.bot_data.pop('http_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    if pdf_pool is not None:
+        pdf_pool.shutdown(wait=False)
+        pdf_pool = None
+    store.close()
+
+async def track_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if startup_metrics['first_update_seconds'] is None:
+        startup_metrics['first_update_seconds'] = time.perf_counter() - PROCESS_START
+        logger.info(f"أول تحديث بعد {startup_metrics['first_update_seconds']:.2f} ث من بدء التشغيل")
+
+# --- التشخيص: تأخر حلقة الأحداث والمعالجات البطيئة ---
+DIAGNOSTICS = os.environ.get('DIAGNOSTICS', '0') == '1'
+LOOP_LAG_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', 0.5))
+SLOW_HANDLER_THRESHOLD = float(os.environ.get('SLOW_HANDLER_THRESHOLD', 1.0))
+SLOW_HANDLER_KEEP = 10
+diagnostics = {
+    'handled': 0,
+    'max_lag': 0.0,
+    'lag_events': 0,
+    'last_beat': None,
+    'stalls': deque(maxlen=5),
+    'slowest': [],
+}
+query_counter = contextvars.ContextVar('query_counter', default=None)
+
+# يُستدعى من sqlite3 لكل عبارة منفذة؛ asyncio.to_thread ينسخ السياق فتُحسب استعلامات الخيوط أيضاً
+def count_query(_statement):
+    counter = query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+async def loop_heartbeat():
+    while True:
+        started = time.monotonic()
+        diagnostics['last_beat'] = started
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.monotonic() - started - LOOP_LAG_INTERVAL
+        diagnostics['max_lag'] = max(diagnostics['max_lag'], lag)
+        if lag > LOOP_LAG_THRESHOLD:
+            diagnostics['lag_events'] += 1
+            logger.warning(f"تأخرت حلقة الأحداث {lag:.2f} ث")
+
+# خيط منفصل يلتقط مكدس خيط الحلقة أثناء توقفها، أي في لحظة الحجب نفسها
+def loop_watchdog(loop_thread_id, stop_event):
+    stalled_beat = None
+    while not stop_event.wait(LOOP_LAG_INTERVAL):
+        beat = diagnostics['last_beat']
+        if beat is None:
+            continue
+        blocked = time.monotonic() - beat
+        if blocked <= LOOP_LAG_THRESHOLD + LOOP_LAG_INTERVAL:
+            continue
+        if stalled_beat != beat:
+            stalled_beat = beat
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            diagnostics['stalls'].append({'at': datetime.datetime.now(), 'blocked': blocked, 'stack': stack})
+        else:
+            diagnostics['stalls'][-1]['blocked'] = blocked
+
+def start_diagnostics(app):
+    stop_event = threading.Event()
+    threading.Thread(target=loop_watchdog, args=(threading.get_ident(), stop_event), daemon=True).start()
+    app.bot_data['diagnostics'] = (asyncio.get_running_loop().create_task(loop_heartbeat()), stop_event)
+    logger.info("تم تفعيل وضع التشخيص")
+
+def stop_diagnostics(app):
+    running = app.bot_data.pop('diagnostics', None)
+    if running:
+        task, stop_event = running
+        task.cancel()
+        stop_event.set()
+
+def update_label(update):
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query and update.callback_query.data:
+        parts = update.callback_query.data.split('_')
+        return 'cb:' + '_'.join(itertools.takewhile(lambda p: not p.lstrip('-').isdigit(), parts))
+    if update.message:
+        if update.message.text and update.message.text.startswith('/'):
+            return update.message.text.split()[0]
+        if update.message.document:
+            return 'document'
+        return 'text'
+    return 'other'
+
+def record_handler_timing(name, label, elapsed, queries):
+    diagnostics['handled'] += 1
+    entry = (elapsed, label, name, queries, datetime.datetime.now())
+    slowest = diagnostics['slowest']
+    if len(slowest) < SLOW_HANDLER_KEEP:
+        heapq.heappush(slowest, entry)
+    elif elapsed > slowest[0][0]:
+        heapq.heapreplace(slowest, entry)
+    if elapsed > SLOW_HANDLER_THRESHOLD:
+        logger.warning(f"معالج بطيء: {name} ({label}) استغرق {elapsed:.2f} ث و {queries} استعلام")
+
+def timed(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not DIAGNOSTICS:
+            return await callback(update, context)
+        counter = [0]
+        token = query_counter.set(counter)
+        started = time.perf_counter()
         try:
-            c.execute("ALTER TABLE quizzes ADD COLUMN max_users INTEGER DEFAULT 0")
-            c.execute("ALTER TABLE quizzes ADD COLUMN used_users INTEGER DEFAULT 0")
-            conn.commit()
-            logger.info("تم إضافة أعمدة التحكم في عدد المستخدمين")
-        except sqlite3.OperationalError:
-            pass
-
-    conn.close()
-    logger.info("تم تهيئة قاعدة البيانات بنجاح")
+            return await callback(update, context)
+        finally:
+            query_counter.reset(token)
+            record_handler_timing(callback.__name__, update_label(update), time.perf_counter() - started, counter[0])
+    return wrapper
+
+def format_diagnostics():
+    if not DIAGNOSTICS:
+        return "🩺 وضع التشخيص معطل.\nلتفعيله شغّل البوت مع المتغير DIAGNOSTICS=1"
+    lines = [
+        "🩺 التشخيص:",
+        f"• التحديثات المقاسة: {diagnostics['handled']}",
+        f"• أقصى تأخر لحلقة الأحداث: {diagnostics['max_lag'] * 1000:.0f} مللي ث",
+        f"• مرات التأخر فوق {LOOP_LAG_THRESHOLD} ث: {diagnostics['lag_events']}",
+        "",
+        "🐢 أبطأ المعالجات:",
+    ]
+    slowest = sorted(diagnostics['slowest'], reverse=True)
+    for n, (elapsed, label, name, queries, at) in enumerate(slowest, start=1):
+        lines.append(f"{n}. {elapsed:.2f} ث | {label} | {name} | {queries} استعلام | {at:%H:%M:%S}")
+    if not slowest:
+        lines.append("لا توجد قياسات بعد.")
+    if diagnostics['stalls']:
+        stall = diagnostics['stalls'][-1]
+        stack_tail = ''.join(stall['stack'].splitlines(keepends=True)[-12:])
+        lines += ["", f"⛔ آخر توقف للحلقة ({stall['blocked']:.2f} ث) في {stall['at']:%H:%M:%S}:", stack_tail]
+    return '\n'.join(lines)[:4000]
+
+# --- التخزين ---
+# STORAGE_ENGINE=memory يشغّل البوت بلا قرص، للتجارب وقياس منطق المعالجات فقط (البيانات تضيع عند الإيقاف)
+DB_PATH = os.environ.get('DB_PATH', 'quiz_system.db')
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'sqlite')
+store = create_storage(STORAGE_ENGINE, DB_PATH, trace_callback=count_query if DIAGNOSTICS else None)
 
 # --- دوال مساعدة للإعدادات ---
 def get_setting(key: str) -> str:
-    conn = get_db()
-    try:
-        result = conn.execute('SELECT value FROM settings WHERE key=?', (key,)).fetchone()
-        return result[0] if result else ''
-    finally:
-        conn.close()
+    return store.get_setting(key)
 
 def update_setting(key: str, value: str):
-    conn = get_db()
-    try:
-        conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-        conn.commit()
-    finally:
-        conn.close()
+    store.set_setting(key, value)
 
 # --- وظائف المساعدة للرابط الخاص ---
-def can_access_private(user_id, quiz_id, conn):
-    quiz = conn.execute('SELECT max_users, used_users FROM quizzes WHERE id=?', (quiz_id,)).fetchone()
-    if not quiz:
+def can_access_private(user_id, quiz_id):
+    status = store.private_access_status(user_id, quiz_id)
+    if not status:
         return False, "الاختبار غير موجود"
-    max_users, used_users = quiz
-    existing = conn.execute('SELECT 1 FROM private_access WHERE user_id=? AND quiz_id=?', (user_id, quiz_id)).fetchone()
-    if existing:
+    max_users, used_users, registered = status
+    if registered:
         return True, "مسموح (مسجل مسبقاً)"
     if max_users == 0:
         return True, "مسموح (غير محدود)"
@@ -168,13 +254,185 @@ def can_access_private(user_id, quiz_id, conn):
     else:
         return False, f"عذراً، العدد الأقصى للمستخدمين لهذا الرابط هو {max_users} وقد اكتمل."
 
-def register_private_access(user_id, quiz_id, conn):
-    conn.execute('INSERT OR IGNORE INTO private_access (user_id, quiz_id, accessed_at) VALUES (?,?,?)',
-                 (user_id, quiz_id, datetime.datetime.now()))
-    conn.execute('''UPDATE quizzes SET used_users = (
-        SELECT COUNT(*) FROM private_access WHERE quiz_id=?
-    ) WHERE id=?''', (quiz_id, quiz_id))
-    conn.commit()
+# --- الحذف على دفعات في الخلفية ---
+PURGE_BATCH_SIZE = 500
+PURGE_PAUSE_SECONDS = 0.05
+PURGE_REPORT_EVERY = 2.0
+running_purges = set()
+
+def quiz_purge_steps(quiz_id):
+    return [
+        ("الأسئلة", 'questions', 'quiz_id', quiz_id),
+        ("المجموعات", 'groups', 'quiz_id', quiz_id),
+        ("جدول المراجعة", 'reviews', 'quiz_id', quiz_id),
+        ("لوحة المتصدرين", 'scores', 'quiz_id', quiz_id),
+        ("سجل الإجابات", 'answers', 'quiz_id', quiz_id),
+        ("سجلات التقدم", 'progress', 'quiz_id', quiz_id),
+        ("أرشيف الجلسات", 'progress_archive', 'quiz_id', quiz_id),
+        ("الوصول الخاص", 'private_access', 'quiz_id', quiz_id),
+        ("الاختبار", 'quizzes', 'id', quiz_id),
+    ]
+
+def group_purge_steps(grp_id):
+    return [
+        ("جدول المراجعة", 'reviews', 'group_id', grp_id),
+        ("سجل الإجابات", 'answers', 'group_id', grp_id),
+        ("الأسئلة", 'questions', 'group_id', grp_id),
+        ("سجلات التقدم", 'progress', 'current_grp_id', grp_id),
+    ]
+
+def progress_purge_steps(quiz_id=None):
+    if quiz_id is None:
+        return [("سجلات التقدم", 'progress', None, None),
+                ("أرشيف الجلسات", 'progress_archive', None, None)]
+    return [("سجلات التقدم", 'progress', 'quiz_id', quiz_id),
+            ("أرشيف الجلسات", 'progress_archive', 'quiz_id', quiz_id)]
+
+async def edit_status(msg, text):
+    try:
+        await msg.edit_text(text)
+    except Exception:
+        pass
+
+async def run_purge(key, steps, status_msg, title):
+    """ينفذ خطوات الحذف دفعة بعد دفعة خارج حلقة الأحداث ويبلغ المشرف بالتقدم."""
+    total = 0
+    last_report = time.monotonic()
+    try:
+        for label, table, column, value in steps:
+            while True:
+                deleted = await asyncio.to_thread(store.delete_batch, table, column, value, PURGE_BATCH_SIZE)
+                total += deleted
+                if time.monotonic() - last_report >= PURGE_REPORT_EVERY:
+                    last_report = time.monotonic()
+                    await edit_status(status_msg, f"⏳ {title}\nجاري حذف {label}... (تم حذف {total} صف حتى الآن)")
+                if deleted < PURGE_BATCH_SIZE:
+                    break
+                await asyncio.sleep(PURGE_PAUSE_SECONDS)
+        await edit_status(status_msg, f"✅ {title}\nاكتمل الحذف: {total} صف.")
+    except Exception as e:
+        logger.exception(f"خطأ أثناء الحذف في الخلفية ({key})")
+        await edit_status(status_msg, f"❌ توقف الحذف بعد {total} صف: {e}")
+    finally:
+        running_purges.discard(key)
+
+async def start_purge(context, key, steps, status_msg, title):
+    if key in running_purges:
+        await edit_status(status_msg, "⏳ عملية حذف مماثلة قيد التنفيذ بالفعل.")
+        return
+    running_purges.add(key)
+    await edit_status(status_msg, f"⏳ {title}\nبدأ الحذف في الخلفية...")
+    context.application.create_task(run_purge(key, steps, status_msg, title))
+
+# --- مخزن الصور (معنون بالمحتوى) ---
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', 'image_store')
+PHOTO_CAPTION_LIMIT = 1024
+
+# الصور المتطابقة تحصل على نفس البصمة، فتُحفظ مرة واحدة مهما تكررت
+def save_image_bytes(data, ext):
+    sha = hashlib.sha256(data).hexdigest()
+    ext = ext.lower() if ext.startswith('.') else f".{ext.lower()}"
+    folder = os.path.join(IMAGE_STORE_DIR, sha[:2])
+    path = os.path.join(folder, f"{sha}{ext}")
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return sha, path
+
+# --- تصدير المجموعات إلى PDF ---
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', 'pdf_cache')
+PDF_FONT_PATH = os.environ.get('PDF_FONT_PATH', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+pdf_pool = None
+pdf_locks = {}
+
+def get_pdf_pool():
+    global pdf_pool
+    if pdf_pool is None:
+        pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return pdf_pool
+
+def pdf_content_hash(title, rows):
+    payload = json.dumps([title, rows], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def is_option_text(text):
+    return text is not None and str(text).strip() != '' and str(text).strip().lower() != 'nan'
+
+# تعمل داخل عملية منفصلة، لذلك تستقبل بيانات بسيطة فقط ولا تلمس قاعدة البيانات
+def render_group_pdf(title, rows, out_path, font_path):
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_font('quiz', fname=font_path)
+    pdf.set_text_shaping(True)
+    pdf.add_page()
+
+    def write(text, size=11, gap=7):
+        pdf.set_font('quiz', size=size)
+        pdf.multi_cell(0, gap, str(text), align='R', new_x='LMARGIN', new_y='NEXT')
+
+    write(title, size=16, gap=10)
+    pdf.ln(4)
+    for n, (stem, a, b, c, d, correct, explanation, image_path) in enumerate(rows, start=1):
+        write(f"{n}. {stem}", size=12)
+        if image_path and os.path.exists(image_path):
+            pdf.image(image_path, w=min(120, pdf.epw))
+            pdf.ln(2)
+        for letter, text in (('A', a), ('B', b), ('C', c), ('D', d)):
+            if is_option_text(text):
+                write(f"{letter}) {text}")
+        write(f"✔ الإجابة الصحيحة: {correct}")
+        if is_option_text(explanation):
+            write(f"💡 الشرح: {explanation}", size=10)
+        pdf.ln(4)
+
+    tmp_path = f"{out_path}.tmp"
+    pdf.output(tmp_path)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+async def send_group_pdf(context, chat_id, grp_id):
+    title, rows = await asyncio.to_thread(store.group_for_pdf, grp_id)
+    if not rows:
+        await context.bot.send_message(chat_id=chat_id, text="⚠️ هذه المجموعة لا تحتوي على أسئلة.")
+        return
+    content_hash = pdf_content_hash(title, rows)
+    filename = f"{title}.pdf"
+
+    # كل بصمة لها قفل وعدّاد للمنتظرين؛ يُزال القفل فقط عندما لا يبقى أحد يستخدمه
+    entry = pdf_locks.setdefault(content_hash, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            file_id = store.get_pdf_file_id(content_hash)
+            if file_id:
+                try:
+                    await context.bot.send_document(chat_id=chat_id, document=file_id, filename=filename)
+                    return
+                except Exception as e:
+                    logger.warning(f"تعذر إعادة استخدام file_id للملف {filename}: {e}")
+
+            out_path = os.path.join(PDF_CACHE_DIR, f"{content_hash}.pdf")
+            if not os.path.exists(out_path):
+                os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(get_pdf_pool(), render_group_pdf, title, rows, out_path, PDF_FONT_PATH)
+
+            with open(out_path, 'rb') as f:
+                msg = await context.bot.send_document(chat_id=chat_id, document=f, filename=filename)
+            store.set_pdf_file_id(content_hash, msg.document.file_id)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            pdf_locks.pop(content_hash, None)
+
+def can_download_group(user_id, grp_id):
+    return user_id == OWNER_ID or store.group_visible_to(user_id, grp_id)
 
 # --- دالة التحقق من الاشتراك (معدلة لاستقبال كائن user) ---
 async def check_subscription(user: User, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -224,26 +482,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("البوت تحت الصيانة، حاول مرة اخرى لاحقاّ.")
         return
 
-    conn = get_db()
-
-    existing = conn.execute('SELECT 1 FROM users WHERE user_id=?', (user.id,)).fetchone()
-    if not existing:
-        conn.execute('INSERT INTO users (user_id, full_name, username, joined_at) VALUES (?,?,?,?)',
-                     (user.id, user.full_name, user.username, datetime.datetime.now()))
-        conn.commit()
-        count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    if store.add_user(user.id, user.full_name, user.username):
+        count = store.count_users()
         msg = (f"🔔 عضو جديد انضم:\n👤 الاسم: {user.full_name}\n🆔 الآيدي: `{user.id}`\n🔗 يوزر: @{user.username or 'None'}\n🔢 التسلسل: {count}")
         await context.bot.send_message(chat_id=OWNER_ID, text=msg, parse_mode='Markdown')
 
     if context.args:
         token = context.args[0]
-        quiz = conn.execute('SELECT id, name, max_users, used_users FROM quizzes WHERE private_token=?', (token,)).fetchone()
+        quiz = store.find_quiz_by_token(token)
         if quiz:
-            quiz_id, quiz_name, max_users, used_users = quiz
-            allowed, msg = can_access_private(user.id, quiz_id, conn)
+            quiz_id, quiz_name = quiz
+            allowed, msg = can_access_private(user.id, quiz_id)
             if allowed:
                 if not await check_subscription(user, context):
-                    conn.close()
                     channel_link = get_setting('channel_link')
                     show_link = get_setting('show_channel_link')
                     keyboard = []
@@ -255,107 +506,427 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
                     )
                     return
-                register_private_access(user.id, quiz_id, conn)
-                conn.close()
+                store.register_private_access(user.id, quiz_id)
                 await update.message.reply_text(f"🔑 تم منحك وصولاً خاصاً لاختبار: **{quiz_name}**", parse_mode='Markdown')
                 return await send_next_ui(update, context, user.id, quiz_id, reset_progress=False)
             else:
-                conn.close()
                 await update.message.reply_text(f"❌ {msg}")
                 return
         else:
-            conn.close()
             await update.message.reply_text("❌ رابط غير صالح.")
             return
 
-    quizzes = conn.execute('SELECT id, name FROM quizzes WHERE is_active=1').fetchall()
-    conn.close()
+    quizzes = store.active_quizzes()
     if not quizzes:
         await update.message.reply_text("👋 لا توجد اختبارات نشطة حالياً.")
     else:
         btns = [[InlineKeyboardButton(q[1], callback_data=f"startquiz_{q[0]}")] for q in quizzes]
         await update.message.reply_text("📚 الاختبارات المتاحة:", reply_markup=InlineKeyboardMarkup(btns))
 
-# --- منطق الأسئلة المتسلسل ---
-async def get_question_data(user_id, quiz_id, reset=False):
-    conn = get_db()
+# --- انتهاء صلاحية الجلسات الخاملة وأرشفتها ---
+SESSION_TTL_DAYS = int(os.environ.get('SESSION_TTL_DAYS', 30))
+SESSION_EVICTION_INTERVAL = int(os.environ.get('SESSION_EVICTION_INTERVAL', 3600))
+SESSION_EVICTION_BATCH = 500
+SESSION_ARCHIVE = os.environ.get('SESSION_ARCHIVE', '1') == '1'
+session_metrics = {
+    'runs': 0,
+    'evicted_total': 0,
+    'last_evicted': 0,
+    'last_run': None,
+    'last_duration': 0.0,
+    'progress_rows': 0,
+    'archive_rows': 0,
+}
+
+async def evict_idle_sessions(context: ContextTypes.DEFAULT_TYPE):
+    started = time.monotonic()
+    evicted = 0
+    quizzes = await asyncio.to_thread(store.quiz_ttls)
+    now = int(time.time())
+    for quiz_id, ttl_days in quizzes:
+        cutoff = now - (ttl_days or SESSION_TTL_DAYS) * 86400
+        while True:
+            n = await asyncio.to_thread(store.evict_idle_batch, quiz_id, cutoff, SESSION_EVICTION_BATCH, SESSION_ARCHIVE)
+            evicted += n
+            if n < SESSION_EVICTION_BATCH:
+                break
+            await asyncio.sleep(PURGE_PAUSE_SECONDS)
+
+    progress_rows, archive_rows = await asyncio.to_thread(store.session_table_sizes)
+    session_metrics['runs'] += 1
+    session_metrics['evicted_total'] += evicted
+    session_metrics['last_evicted'] = evicted
+    session_metrics['last_run'] = datetime.datetime.now()
+    session_metrics['last_duration'] = time.monotonic() - started
+    session_metrics['progress_rows'] = progress_rows
+    session_metrics['archive_rows'] = archive_rows
+    if evicted:
+        logger.info(f"تمت أرشفة {evicted} جلسة خاملة")
+
+def format_session_metrics():
+    last_run = session_metrics['last_run']
+    last_run_text = (f"{last_run:%Y-%m-%d %H:%M} ({session_metrics['last_duration']:.1f} ث)"
+                     if last_run else "لم يتم التشغيل بعد")
+    return (f"📊 **الجلسات:**\n"
+            f"• مدة الخمول الافتراضية: {SESSION_TTL_DAYS} يوم\n"
+            f"• الوضع: {'أرشفة' if SESSION_ARCHIVE else 'حذف'}\n"
+            f"• آخر تشغيل: {last_run_text}\n"
+            f"• عدد مرات التشغيل: {session_metrics['runs']}\n"
+            f"• المُزالة في آخر تشغيل: {session_metrics['last_evicted']}\n"
+            f"• إجمالي المُزالة: {session_metrics['evicted_total']}\n"
+            f"• حجم جدول التقدم: {session_metrics['progress_rows']}\n"
+            f"• حجم الأرشيف: {session_metrics['archive_rows']}")
+
+# --- النسخ الاحتياطي الحي لقاعدة البيانات ---
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 6 * 3600))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+BACKUP_TIMEOUT = int(os.environ.get('BACKUP_TIMEOUT', 600))
+BACKUP_SEND_LIMIT = 50 * 1024 * 1024
+RESTORE_FROM_BACKUP = os.environ.get('RESTORE_FROM_BACKUP', '')
+backup_lock = threading.Lock()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# أسماء النسخ تحمل الوقت، فالترتيب الأبجدي هو الترتيب الزمني
+def list_backups():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = sorted(n for n in os.listdir(BACKUP_DIR) if n.startswith('quiz_system-') and n.endswith('.db'))
+    return [os.path.join(BACKUP_DIR, n) for n in names]
+
+def read_backup_checksum(path):
     try:
-        if reset:
-            conn.execute('DELETE FROM progress WHERE user_id=? AND quiz_id=?', (user_id, quiz_id))
-            conn.commit()
-            prog = None
-        else:
-            prog = conn.execute('SELECT current_grp_id, current_q_idx FROM progress WHERE user_id=? AND quiz_id=?', (user_id, quiz_id)).fetchone()
-
-        if not prog:
-            first_grp = conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=? ORDER BY id LIMIT 1', (quiz_id,)).fetchone()
-            if not first_grp:
-                return None, None, None, None
-            conn.execute('INSERT OR REPLACE INTO progress (user_id, quiz_id, current_grp_id, current_q_idx) VALUES (?,?,?,0)',
-                         (user_id, quiz_id, first_grp[0]))
-            conn.commit()
-            grp_id, idx, grp_name = first_grp[0], 0, first_grp[1]
-        else:
-            grp_id, idx = prog
-            grp_name = conn.execute('SELECT file_name FROM groups WHERE id=?', (grp_id,)).fetchone()[0]
-
-        questions = conn.execute('SELECT * FROM questions WHERE group_id=? ORDER BY id', (grp_id,)).fetchall()
-        return questions, grp_id, idx, grp_name
+        with open(f"{path}.sha256", encoding='utf-8') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def verify_backup(path):
+    expected = read_backup_checksum(path)
+    return expected is not None and os.path.exists(path) and file_sha256(path) == expected
+
+# تعمل في خيط منفصل؛ النسخة تُكتب في ملف مؤقت ولا تظهر باسمها النهائي إلا بعد اكتمالها وفحصها.
+# لا تنتظر نسخة جارية: الطلب الثاني يفشل فوراً بدل أن يحجز خيطاً آخر من مجمع to_thread
+def create_backup():
+    if not backup_lock.acquire(blocking=False):
+        raise StorageError("هناك نسخة احتياطية أخرى قيد التنفيذ")
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        name = f"quiz_system-{datetime.datetime.now():%Y%m%d-%H%M%S}.db"
+        path = os.path.join(BACKUP_DIR, name)
+        tmp_path = f"{path}.tmp"
+        try:
+            store.backup(tmp_path, BACKUP_TIMEOUT)
+            sha = file_sha256(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with open(f"{path}.sha256", 'w', encoding='utf-8') as f:
+            f.write(f"{sha}  {name}\n")
+        for old in list_backups()[:-BACKUP_KEEP]:
+            for victim in (old, f"{old}.sha256"):
+                if os.path.exists(victim):
+                    os.remove(victim)
+        return path, sha
     finally:
-        conn.close()
+        backup_lock.release()
+
+async def run_backup(context: ContextTypes.DEFAULT_TYPE):
+    started = time.monotonic()
+    try:
+        path, sha = await asyncio.to_thread(create_backup)
+        logger.info(f"تم إنشاء نسخة احتياطية {path} ({os.path.getsize(path)} بايت) خلال {time.monotonic() - started:.1f} ث")
+    except Exception:
+        logger.exception("فشل إنشاء النسخة الاحتياطية")
+
+# /backup يرسل آخر نسخة، و /backup now ينشئ نسخة جديدة أولاً
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        return
+    if not store.can_backup:
+        await update.message.reply_text(f"⚠️ النسخ الاحتياطي غير مدعوم في محرك التخزين الحالي ({store.name}).")
+        return
+    backups = list_backups()
+    if not backups or (context.args and context.args[0] == 'now'):
+        await update.message.reply_text("⏳ جاري إنشاء نسخة احتياطية...")
+        try:
+            await asyncio.to_thread(create_backup)
+        except Exception as e:
+            logger.exception("فشل إنشاء النسخة الاحتياطية")
+            await update.message.reply_text(f"❌ تعذر إنشاء النسخة الاحتياطية: {e}")
+            return
+        backups = list_backups()
+    path = backups[-1]
+    size = os.path.getsize(path)
+    if size > BACKUP_SEND_LIMIT:
+        await update.message.reply_text(f"⚠️ حجم النسخة ({size // (1024 * 1024)} ميغابايت) يتجاوز حد الإرسال في تيليجرام.\nالمسار على الخادم: {path}")
+        return
+    with open(path, 'rb') as f:
+        await context.bot.send_document(chat_id=OWNER_ID, document=f, filename=os.path.basename(path),
+                                        caption=f"💾 {os.path.basename(path)}\nSHA-256: {read_backup_checksum(path)}")
+
+# RESTORE_FROM_BACKUP=latest أو مسار ملف: تُستعاد النسخة قبل تهيئة القاعدة بعد التحقق من بصمتها.
+# تُسجل قيمة المتغير بعد نجاح الاستعادة، فلا تُستبدل القاعدة الحية مجدداً مع كل إعادة تشغيل للحاوية
+def restore_from_backup(source):
+    marker = f"{DB_PATH}.restored"
+    if os.path.exists(marker):
+        with open(marker, encoding='utf-8') as f:
+            if f.read().strip() == source:
+                logger.info(f"تمت الاستعادة من {source} مسبقاً؛ احذف المتغير RESTORE_FROM_BACKUP أو الملف {marker} لإعادتها")
+                return False
+    path = (list_backups() or [None])[-1] if source == 'latest' else source
+    if not path or not os.path.exists(path):
+        logger.error(f"لم يتم العثور على نسخة احتياطية للاستعادة ({source})")
+        return False
+    if not verify_backup(path):
+        logger.error(f"بصمة النسخة {path} غير مطابقة أو مفقودة، تم إلغاء الاستعادة")
+        return False
+    try:
+        store.restore(path)
+    except StorageError as e:
+        logger.error(f"تعذرت الاستعادة: {e}")
+        return False
+    with open(marker, 'w', encoding='utf-8') as f:
+        f.write(source)
+    logger.info(f"تمت استعادة قاعدة البيانات من {path}")
+    return True
 
-async def send_next_ui(update, context, user_id, quiz_id, prev_feedback="", reset_progress=False, use_callback=None):
-    questions, grp_id, idx, grp_name = await get_question_data(user_id, quiz_id, reset=reset_progress)
+# --- منطق الأسئلة المتسلسل ---
+# ترتيب الأسئلة والخيارات مشتق من بذرة واحدة مخزنة في سجل التقدم، فلا تُخزن أي قائمة مرتبة
+def new_session_seed():
+    return secrets.randbits(31) or 1
+
+def seeded_order(seed, salt, n):
+    order = list(range(n))
+    random.Random(f"{seed}:{salt}").shuffle(order)
+    return order
+
+# ترتيب أسئلة المجموعة يُحسب مرة لكل جلسة بدل إعادة خلط القائمة كلها مع كل ضغطة
+@functools.lru_cache(maxsize=1024)
+def group_order(seed, grp_id, n):
+    return tuple(seeded_order(seed, f"g{grp_id}", n))
+
+# تعيد الخيارات بترتيب العرض: (الحرف المعروض، الحرف الأصلي، النص)
+def displayed_options(q_id, a, b, c, d, seed, shuffle):
+    present = [(letter, str(text)) for letter, text in zip('ABCD', (a, b, c, d)) if is_option_text(text)]
+    if not shuffle or not seed:
+        return [(letter, letter, text) for letter, text in present]
+    order = seeded_order(seed, f"q{q_id}", len(present))
+    return [('ABCD'[pos], present[i][0], present[i][1]) for pos, i in enumerate(order)]
+
+def to_original_letter(options, shown):
+    for display, original, _ in options:
+        if display == shown:
+            return original
+    return shown
+
+def to_display_letter(options, original):
+    for display, orig, _ in options:
+        if orig == original:
+            return display
+    return original
+
+async def get_question_data(user_id, quiz_id, reset=False):
+    if reset:
+        store.clear_progress(user_id, quiz_id)
+        session = None
+    else:
+        # المسار المعتاد (جلسة قائمة) يكلف استدعاءً واحداً للتخزين
+        session = store.load_session(user_id, quiz_id)
+        if session is None and store.restore_archived_session(user_id, quiz_id):
+            session = store.load_session(user_id, quiz_id)
+
+    # قد تكون المجموعة حُذفت بينما ينتظر سجل التقدم دوره في الحذف على دفعات
+    if session is None:
+        first_grp = store.first_group(quiz_id)
+        if not first_grp:
+            return None, None, None, None, 0, (0, 0)
+        seed = new_session_seed()
+        store.start_progress(user_id, quiz_id, first_grp[0], seed)
+        return store.group_questions(first_grp[0]), first_grp[0], 0, first_grp[1], seed, store.quiz_shuffle(quiz_id)
+    grp_id, idx, seed, grp_name, shuffle_q, shuffle_o, questions = session
+    return questions, grp_id, idx, grp_name, seed, (shuffle_q, shuffle_o)
+
+def is_callback_mode(update, use_callback):
+    return (use_callback is None and update.callback_query) or use_callback is True
+
+async def show_text(update, context, user_id, text, reply_markup=None, use_callback=None):
+    if is_callback_mode(update, use_callback):
+        if not update.callback_query.message.photo:
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+            return
+        # لا يمكن تحويل رسالة صورة إلى نص، فنزيل أزرارها ونرسل رسالة جديدة
+        await update.callback_query.message.edit_reply_markup(reply_markup=None)
+    await context.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def show_photo_question(update, context, user_id, image_hash, caption, reply_markup, prev_feedback="", use_callback=None):
+    if prev_feedback:
+        await show_text(update, context, user_id, prev_feedback, use_callback=use_callback)
+    elif is_callback_mode(update, use_callback):
+        await update.callback_query.message.edit_reply_markup(reply_markup=None)
+
+    image = store.get_image(image_hash)
+    if not image:
+        await context.bot.send_message(chat_id=user_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
+        return
+    path, file_id = image
+    fits = len(caption) <= PHOTO_CAPTION_LIMIT
+    photo_kwargs = dict(chat_id=user_id, caption=caption if fits else None,
+                        reply_markup=reply_markup if fits else None, parse_mode='Markdown')
+    sent = False
+    if file_id:
+        try:
+            await context.bot.send_photo(photo=file_id, **photo_kwargs)
+            sent = True
+        except Exception as e:
+            logger.warning(f"تعذر إعادة استخدام file_id للصورة {image_hash}: {e}")
+
+    if not sent:
+        # لا file_id صالح: نرفع الصورة من القرص ونحدّث file_id المخزن
+        if not os.path.exists(path):
+            logger.warning(f"ملف الصورة غير موجود: {path}")
+            await context.bot.send_message(chat_id=user_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
+            return
+        with open(path, 'rb') as f:
+            msg = await context.bot.send_photo(photo=f, **photo_kwargs)
+        store.set_image_file_id(image_hash, msg.photo[-1].file_id)
+    if not fits:
+        await context.bot.send_message(chat_id=user_id, text=caption, reply_markup=reply_markup, parse_mode='Markdown')
+
+def pick_question(questions, grp_id, idx, seed, shuffle_q):
+    if shuffle_q and seed:
+        return questions[group_order(seed, grp_id, len(questions))[idx]]
+    return questions[idx]
+
+# session: بيانات جلسة محمّلة مسبقاً (كما تعيدها get_question_data) لتجنب قراءتها مرة أخرى
+async def send_next_ui(update, context, user_id, quiz_id, prev_feedback="", reset_progress=False, use_callback=None,
+                       session=None):
+    if session is None:
+        session = await get_question_data(user_id, quiz_id, reset=reset_progress)
+    questions, grp_id, idx, grp_name, seed, (shuffle_q, shuffle_o) = session
 
     if questions is None:
         msg = update.callback_query.message if update.callback_query else update.message
         return await msg.reply_text("⚠️ هذا الاختبار لا يحتوي على ملفات أسئلة.")
 
     if idx >= len(questions):
-        conn = get_db()
-        try:
-            next_grp = conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=? AND id > ? ORDER BY id LIMIT 1', (quiz_id, grp_id)).fetchone()
-        finally:
-            conn.close()
+        next_grp = store.next_group(quiz_id, grp_id)
+        due_reviews = store.count_due_reviews(user_id, quiz_id)
+        review_btn = [InlineKeyboardButton(f"🔁 مراجعة أخطائي ({due_reviews})", callback_data=f"review_{quiz_id}")]
 
         if next_grp:
             text = f"{prev_feedback}\n\n📦 **انتهت المجموعة الحالية.**\nماذا تريد أن تفعل؟" if prev_feedback else "📦 **انتهت المجموعة الحالية.**\nماذا تريد أن تفعل؟"
             keyboard = [
                 [InlineKeyboardButton("❌ إنهاء الاختبار", callback_data=f"quit_{quiz_id}")],
-                [InlineKeyboardButton(f"➡️ اكمال {next_grp[1]}", callback_data=f"continue_{quiz_id}_{next_grp[0]}")]
+                [InlineKeyboardButton(f"➡️ اكمال {next_grp[1]}", callback_data=f"continue_{quiz_id}_{next_grp[0]}")],
+                [InlineKeyboardButton("📄 تحميل المجموعة PDF", callback_data=f"pdf_{grp_id}")]
             ]
-            if (use_callback is None and update.callback_query) or use_callback is True:
-                await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-            else:
-                await context.bot.send_message(chat_id=user_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+            if due_reviews:
+                keyboard.insert(2, review_btn)
+            await show_text(update, context, user_id, text, InlineKeyboardMarkup(keyboard), use_callback)
             return
         else:
             final = f"{prev_feedback}\n\n🎉 **تم الانتهاء من كافة أسئلة الاختبار!**"
-            if (use_callback is None and update.callback_query) or use_callback is True:
-                await update.callback_query.edit_message_text(final, parse_mode='Markdown')
-            else:
-                await context.bot.send_message(chat_id=user_id, text=final, parse_mode='Markdown')
+            keyboard = [[InlineKeyboardButton("📄 تحميل المجموعة PDF", callback_data=f"pdf_{grp_id}")]]
+            if due_reviews:
+                keyboard.insert(0, review_btn)
+            await show_text(update, context, user_id, final, InlineKeyboardMarkup(keyboard), use_callback)
             return
 
-    q = questions[idx]
     total_questions = len(questions)
+    q = pick_question(questions, grp_id, idx, seed, shuffle_q)
     header = f"📂 **المجموعة: {grp_name}**\n" if idx == 0 else ""
-    full_text = f"{prev_feedback}\n\n{header}❓ **السؤال {idx+1}/{total_questions}:**\n{q[3]}"
+    question_text = f"{header}❓ **السؤال {idx+1}/{total_questions}:**\n{q[3]}"
 
-    btns = []
-    options = [('A', q[4]), ('B', q[5]), ('C', q[6]), ('D', q[7])]
-    for letter, text in options:
-        if text and isinstance(text, str) and text.strip() and text.strip().lower() != 'nan':
-            btns.append([InlineKeyboardButton(f"{letter}) {text}", callback_data=f"ans_{letter}_{quiz_id}_{q[0]}")])
-        elif text and not isinstance(text, str):
-            str_text = str(text).strip()
-            if str_text and str_text.lower() != 'nan':
-                btns.append([InlineKeyboardButton(f"{letter}) {str_text}", callback_data=f"ans_{letter}_{quiz_id}_{q[0]}")])
-
-    if (use_callback is None and update.callback_query) or use_callback is True:
-        await update.callback_query.edit_message_text(full_text, reply_markup=InlineKeyboardMarkup(btns), parse_mode='Markdown')
+    btns = [[InlineKeyboardButton(f"{letter}) {text}", callback_data=f"ans_{letter}_{quiz_id}_{q[0]}")]
+            for letter, _, text in displayed_options(q[0], q[4], q[5], q[6], q[7], seed, shuffle_o)]
+
+    if q[10]:
+        await show_photo_question(update, context, user_id, q[10], question_text, InlineKeyboardMarkup(btns),
+                                  prev_feedback, use_callback)
     else:
-        await context.bot.send_message(chat_id=user_id, text=full_text, reply_markup=InlineKeyboardMarkup(btns), parse_mode='Markdown')
+        await show_text(update, context, user_id, f"{prev_feedback}\n\n{question_text}", InlineKeyboardMarkup(btns), use_callback)
+
+# --- وضع المراجعة المتباعدة للأسئلة الخاطئة ---
+REVIEW_RETRY_SECONDS = 600
+REVIEW_FIRST_INTERVAL = 24 * 3600
+REVIEW_MIN_EASE = 1.3
+REVIEW_MAX_EASE = 3.0
+
+# الخطأ يعيد السؤال إلى بداية الجدول ويخفض معامل السهولة
+def record_review_miss(user_id, quiz_id, q_id, delay=0):
+    row = store.get_review(user_id, q_id)
+    ease = max(REVIEW_MIN_EASE, row[1] - 0.2) if row else 2.5
+    store.save_review(user_id, quiz_id, q_id, 0, ease, 0, int(time.time()) + delay)
+
+# الإجابة الصحيحة في المراجعة تباعد الموعد التالي بضرب الفاصل في معامل السهولة
+def record_review_hit(user_id, quiz_id, q_id):
+    row = store.get_review(user_id, q_id)
+    if not row:
+        return
+    interval, ease, reps = row
+    interval = REVIEW_FIRST_INTERVAL if interval == 0 else int(interval * ease)
+    store.save_review(user_id, quiz_id, q_id, interval, min(REVIEW_MAX_EASE, ease + 0.1), reps + 1,
+                      int(time.time()) + interval)
+
+async def send_review_ui(update, context, user_id, quiz_id, prev_feedback="", use_callback=None):
+    q = store.next_due_review(user_id, quiz_id)
+
+    if not q:
+        upcoming = store.next_review_at(user_id, quiz_id)
+        text = "🎉 **لا توجد أسئلة مستحقة للمراجعة الآن.**"
+        if upcoming:
+            text += f"\n⏰ المراجعة القادمة: {datetime.datetime.fromtimestamp(upcoming):%Y-%m-%d %H:%M}"
+        if prev_feedback:
+            text = f"{prev_feedback}\n\n{text}"
+        keyboard = [[InlineKeyboardButton("❌ إنهاء", callback_data=f"quit_{quiz_id}")]]
+        await show_text(update, context, user_id, text, InlineKeyboardMarkup(keyboard), use_callback)
+        return
+
+    q_id, stem, a, b, c, d, image_hash, shuffle_o, seed = q
+    question_text = f"🔁 **مراجعة:**\n{stem}"
+    btns = [[InlineKeyboardButton(f"{letter}) {text}", callback_data=f"rans_{letter}_{quiz_id}_{q_id}")]
+            for letter, _, text in displayed_options(q_id, a, b, c, d, seed, shuffle_o)]
+    btns.append([InlineKeyboardButton("❌ إنهاء المراجعة", callback_data=f"quit_{quiz_id}")])
+
+    if image_hash:
+        await show_photo_question(update, context, user_id, image_hash, question_text, InlineKeyboardMarkup(btns),
+                                  prev_feedback, use_callback)
+    else:
+        await show_text(update, context, user_id, f"{prev_feedback}\n\n{question_text}", InlineKeyboardMarkup(btns), use_callback)
+
+# --- لوحة المتصدرين ---
+LEADERBOARD_SIZE = 10
+ADMIN_LEADERBOARD_SIZE = 20
+MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+def format_leaderboard(rows, show_usernames=False):
+    lines = []
+    for pos, (uid, full_name, username, correct, answered) in enumerate(rows, start=1):
+        name = full_name or str(uid)
+        if show_usernames and username:
+            name += f" (@{username})"
+        lines.append(f"{MEDALS.get(pos, f'{pos}.')} {name} — {correct}/{answered}")
+    return '\n'.join(lines) if lines else "لا توجد نتائج بعد."
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not await is_bot_active_for_user(user_id):
+        await update.message.reply_text("البوت تحت الصيانة، حاول مرة اخرى لاحقاّ.")
+        return
+    quizzes = store.visible_quizzes(user_id)
+    if not quizzes:
+        await update.message.reply_text("🏆 لا توجد اختبارات متاحة حالياً.")
+        return
+    btns = [[InlineKeyboardButton(f"🏆 {q[1]}", callback_data=f"top_{q[0]}")] for q in quizzes]
+    await update.message.reply_text("🏆 اختر الاختبار لعرض المتصدرين:", reply_markup=InlineKeyboardMarkup(btns))
 
 # --- معالج الكول باك الجديد لتأكيد البريد ---
 async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -371,25 +942,19 @@ async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DE
 
         await query.edit_message_text("⏳ جاري الإرسال... قد يستغرق هذا دقيقة.")
 
-        conn = get_db()
-        users = conn.execute('SELECT user_id FROM users').fetchall()
+        users = store.list_user_ids()
         total = len(users)
-        success = 0
-        died = 0
+        results = []
 
-        for (uid,) in users:
+        for uid in users:
             try:
                 await context.bot.send_message(chat_id=uid, text=broadcast_text)
-                success += 1
-                conn.execute('UPDATE users SET fail_count = 0 WHERE user_id = ?', (uid,))
+                results.append((uid, True))
             except Exception:
-                conn.execute('UPDATE users SET fail_count = fail_count + 1 WHERE user_id = ?', (uid,))
-                fail = conn.execute('SELECT fail_count FROM users WHERE user_id = ?', (uid,)).fetchone()
-                if fail and fail[0] >= 2:
-                    died += 1
+                results.append((uid, False))
 
-        conn.commit()
-        conn.close()
+        success = sum(1 for _, ok in results if ok)
+        died = store.record_deliveries(results)
 
         report = (
             f"📢 **تقرير الإرسال الجماعي:**\n\n"
@@ -408,297 +973,422 @@ async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DE
 async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
-    conn = get_db()
     user_id = query.from_user.id
     user = query.from_user
 
-    try:
-        if user_id != OWNER_ID:
-            if not await is_bot_active_for_user(user_id):
-                await query.answer("⛔ البوت متوقف حالياً.", show_alert=True)
-                return
+    if user_id != OWNER_ID:
+        if not await is_bot_active_for_user(user_id):
+            await query.answer("⛔ البوت متوقف حالياً.", show_alert=True)
+            return
 
-        if data.startswith('startquiz_'):
-            quiz_id = int(data.split('_')[1])
+    if data.startswith('startquiz_'):
+        quiz_id = int(data.split('_')[1])
+        if not await check_subscription(user, context):
+            channel_link = get_setting('channel_link')
+            show_link = get_setting('show_channel_link')
+            keyboard = []
+            if show_link == '1' and channel_link:
+                keyboard.append([InlineKeyboardButton("📢 اشترك في القناة", url=channel_link)])
+            await query.edit_message_text(
+                "❌ عذراً، للوصول إلى هذا الاختبار يجب أن تكون مشتركاً في قناتنا أولاً.\n"
+                "يرجى الاشتراك ثم حاول مرة أخرى.",
+                reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+            )
+            await query.answer()
+            return
+        await send_next_ui(update, context, user_id, quiz_id, reset_progress=True, use_callback=True)
+
+    elif data.startswith('ans_'):
+        parts = data.split('_')
+        choice = parts[1]
+        quiz_id = int(parts[2])
+        q_id = int(parts[3])
+        questions, grp_id, idx, grp_name, seed, (shuffle_q, shuffle_o) = await get_question_data(user_id, quiz_id)
+        # الضغط المزدوج وأزرار الرسائل القديمة (بعد إعادة البدء مثلاً) لا تُحتسب إلا على السؤال الحالي
+        q = pick_question(questions, grp_id, idx, seed, shuffle_q) if questions and idx < len(questions) else None
+        if not q or q[0] != q_id:
+            await query.answer("⚠️ هذا السؤال لم يعد السؤال الحالي.", show_alert=True)
+            return
+        options = displayed_options(q_id, q[4], q[5], q[6], q[7], seed, shuffle_o)
+        is_correct = to_original_letter(options, choice) == q[8]
+        if not store.record_answer(user_id, quiz_id, q_id, idx, is_correct):
+            await query.answer("⚠️ هذا السؤال لم يعد السؤال الحالي.", show_alert=True)
+            return
+        if not is_correct:
+            record_review_miss(user_id, quiz_id, q_id)
+        icon = "✅" if is_correct else "❌"
+        feedback = (f"**السؤال السابق:** {q[3]}\n"
+                    f"{icon} **إجابتك:** {choice} | **الصح:** {to_display_letter(options, q[8])}\n"
+                    f"💡 **الشرح:** {q[9]}")
+        await send_next_ui(update, context, user_id, quiz_id, prev_feedback=feedback, use_callback=True,
+                           session=(questions, grp_id, idx + 1, grp_name, seed, (shuffle_q, shuffle_o)))
+
+    elif data.startswith('review_'):
+        quiz_id = int(data.split('_')[1])
+        if not await check_subscription(user, context):
+            await query.answer("❌ يجب الاشتراك في القناة أولاً.", show_alert=True)
+            return
+        await send_review_ui(update, context, user_id, quiz_id, use_callback=True)
+        await query.answer()
+
+    elif data.startswith('rans_'):
+        parts = data.split('_')
+        choice = parts[1]
+        quiz_id = int(parts[2])
+        q_id = int(parts[3])
+        # الإجابة تُطبق فقط إذا كان موعد مراجعة السؤال قد حان؛ بعدها يُجدول من جديد فتُرفض الضغطة المكررة
+        if not store.get_review(user_id, q_id, due_before=int(time.time())):
+            await query.answer("⚠️ هذا السؤال لم يعد السؤال الحالي.", show_alert=True)
+            return
+        q = store.answer_context(user_id, q_id)
+        if not q:
+            await query.answer("⚠️ هذا السؤال لم يعد موجوداً.", show_alert=True)
+            return
+        options = displayed_options(q_id, q[3], q[4], q[5], q[6], q[8], q[7])
+        is_correct = to_original_letter(options, choice) == q[1]
+        if is_correct:
+            record_review_hit(user_id, quiz_id, q_id)
+        else:
+            record_review_miss(user_id, quiz_id, q_id, delay=REVIEW_RETRY_SECONDS)
+        icon = "✅" if is_correct else "❌"
+        feedback = (f"**السؤال السابق:** {q[0]}\n"
+                    f"{icon} **إجابتك:** {choice} | **الصح:** {to_display_letter(options, q[1])}\n"
+                    f"💡 **الشرح:** {q[2]}")
+        await send_review_ui(update, context, user_id, quiz_id, prev_feedback=feedback, use_callback=True)
+
+    elif data.startswith('top_'):
+        quiz_id = int(data.split('_')[1])
+        quiz_name = store.quiz_name(quiz_id)
+        # نفس شرط /top: الاختبار مفعل أو للمستخدم وصول خاص، فلا تكشف بيانات مزورة أسماء متصدري اختبار خاص
+        if quiz_name is None or not store.quiz_visible_to(user_id, quiz_id):
+            await query.answer("⚠️ الاختبار غير موجود.", show_alert=True)
+            return
+        text = f"🏆 المتصدرون في: {quiz_name}\n\n{format_leaderboard(store.top_scores(quiz_id, LEADERBOARD_SIZE))}"
+        mine = store.user_rank(quiz_id, user_id)
+        if mine:
+            text += f"\n\n📍 ترتيبك: {mine[0]} — {mine[1]}/{mine[2]}"
+        await query.message.reply_text(text)
+        await query.answer()
+
+    elif data.startswith('admtop_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[1])
+        text = (f"🏆 المتصدرون (الكل):\n{format_leaderboard(store.top_scores(quiz_id, ADMIN_LEADERBOARD_SIZE), True)}\n\n"
+                f"🔑 المتصدرون (الرابط الخاص):\n"
+                f"{format_leaderboard(store.top_scores(quiz_id, ADMIN_LEADERBOARD_SIZE, private_only=True), True)}")
+        await query.message.reply_text(text)
+        await query.answer()
+
+    elif data.startswith('quit_'):
+        quiz_id = int(data.split('_')[1])
+        await show_text(update, context, user_id, "✅ **تم إنهاء الاختبار.** شكراً لمشاركتك!", use_callback=True)
+        await query.answer()
+
+    elif data.startswith('continue_'):
+        try:
+            parts = data.split('_')
+            quiz_id = int(parts[1])
+            next_grp_id = int(parts[2])
             if not await check_subscription(user, context):
-                conn.close()
                 channel_link = get_setting('channel_link')
                 show_link = get_setting('show_channel_link')
                 keyboard = []
                 if show_link == '1' and channel_link:
                     keyboard.append([InlineKeyboardButton("📢 اشترك في القناة", url=channel_link)])
                 await query.edit_message_text(
-                    "❌ عذراً، للوصول إلى هذا الاختبار يجب أن تكون مشتركاً في قناتنا أولاً.\n"
+                    "❌ عذراً، للاستمرار في الاختبار يجب أن تكون مشتركاً في قناتنا.\n"
                     "يرجى الاشتراك ثم حاول مرة أخرى.",
                     reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
                 )
                 await query.answer()
                 return
-            conn.close()
-            await send_next_ui(update, context, user_id, quiz_id, reset_progress=True, use_callback=True)
-
-        elif data.startswith('ans_'):
-            parts = data.split('_')
-            choice = parts[1]
-            quiz_id = int(parts[2])
-            q_id = int(parts[3])
-            q = conn.execute('SELECT stem, correct, explanation FROM questions WHERE id=?', (q_id,)).fetchone()
-            conn.execute('UPDATE progress SET current_q_idx = current_q_idx + 1 WHERE user_id=? AND quiz_id=?',
-                         (user_id, quiz_id))
-            conn.commit()
-            conn.close()
-            icon = "✅" if choice == q[1] else "❌"
-            feedback = (f"**السؤال السابق:** {q[0]}\n"
-                        f"{icon} **إجابتك:** {choice} | **الصح:** {q[1]}\n"
-                        f"💡 **الشرح:** {q[2]}")
-            await send_next_ui(update, context, user_id, quiz_id, prev_feedback=feedback, use_callback=True)
-
-        elif data.startswith('quit_'):
-            quiz_id = int(data.split('_')[1])
-            await query.message.edit_text("✅ **تم إنهاء الاختبار.** شكراً لمشاركتك!", parse_mode='Markdown')
-            await query.answer()
-
-        elif data.startswith('continue_'):
-            try:
-                parts = data.split('_')
-                quiz_id = int(parts[1])
-                next_grp_id = int(parts[2])
-                if not await check_subscription(user, context):
-                    conn.close()
-                    channel_link = get_setting('channel_link')
-                    show_link = get_setting('show_channel_link')
-                    keyboard = []
-                    if show_link == '1' and channel_link:
-                        keyboard.append([InlineKeyboardButton("📢 اشترك في القناة", url=channel_link)])
-                    await query.edit_message_text(
-                        "❌ عذراً، للاستمرار في الاختبار يجب أن تكون مشتركاً في قناتنا.\n"
-                        "يرجى الاشتراك ثم حاول مرة أخرى.",
-                        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-                    )
-                    await query.answer()
-                    return
-                conn.execute('UPDATE progress SET current_grp_id=?, current_q_idx=0 WHERE user_id=? AND quiz_id=?',
-                             (next_grp_id, user_id, quiz_id))
-                conn.commit()
-                conn.close()
-                await query.message.delete()
-                await send_next_ui(update, context, user_id, quiz_id, use_callback=False)
-                await query.answer()
-            except Exception as e:
-                logging.exception("خطأ في continue_")
-                await query.answer(f"حدث خطأ: {str(e)}", show_alert=True)
-
-        elif data.startswith('tog_'):
-            quiz_id = int(data.split('_')[1])
-            conn.execute('UPDATE quizzes SET is_active = 1 - is_active WHERE id=?', (quiz_id,))
-            conn.commit()
-            await query.answer("🔄 تم تحديث حالة الظهور")
-
-        elif data.startswith('newpriv_'):
-            try:
-                quiz_id = int(data.split('_')[1])
-                token = secrets.token_urlsafe(8)
-                conn.execute('UPDATE quizzes SET private_token=? WHERE id=?', (token, quiz_id))
-                conn.commit()
-                bot_user = await context.bot.get_me()
-                username = bot_user.username
-                link = f"https://t.me/{username}?start={token}"
-                await query.message.reply_text(f"🔗 رابط خاص جديد:\n`{link}`", parse_mode='Markdown')
-                await query.answer("✅ تم توليد رابط جديد")
-            except Exception as e:
-                logging.exception("خطأ في معالجة newpriv")
-                await query.answer(f"❌ حدث خطأ: {str(e)}", show_alert=True)
-
-        elif data.startswith('setmax_'):
-            quiz_id = int(data.split('_')[1])
-            context.user_data['awaiting_max'] = quiz_id
-            await query.message.reply_text("📝 أرسل العدد الأقصى للمستخدمين (0 يعني غير محدود):")
-            await query.answer()
-
-        elif data.startswith('showpriv_'):
-            quiz_id = int(data.split('_')[1])
-            users = conn.execute('''SELECT u.user_id, u.full_name, u.username, p.accessed_at
-                                     FROM private_access p
-                                     JOIN users u ON u.user_id = p.user_id
-                                     WHERE p.quiz_id=?''', (quiz_id,)).fetchall()
-            if not users:
-                await query.message.reply_text("👥 لا يوجد مستخدمين خاصين حتى الآن.")
-            else:
-                msg = "📋 قائمة المستخدمين الخاصين:\n"
-                for u in users:
-                    msg += f"• {u[1]} (@{u[2]}) - {u[3]}\n"
-                await query.message.reply_text(msg)
-            await query.answer()
-
-        elif data.startswith('clearpriv_'):
-            quiz_id = int(data.split('_')[1])
-            keyboard = [[
-                InlineKeyboardButton("✅ نعم، احذف", callback_data=f"confirm_clear_{quiz_id}"),
-                InlineKeyboardButton("❌ إلغاء", callback_data="cancel_clear")
-            ]]
-            await query.message.reply_text("⚠️ هل أنت متأكد من حذف جميع المستخدمين الخاصين لهذا الاختبار؟",
-                                           reply_markup=InlineKeyboardMarkup(keyboard))
-            await query.answer()
-
-        elif data.startswith('confirm_clear_'):
-            quiz_id = int(data.split('_')[2])
-            conn.execute('DELETE FROM private_access WHERE quiz_id=?', (quiz_id,))
-            conn.execute('UPDATE quizzes SET used_users=0 WHERE id=?', (quiz_id,))
-            conn.commit()
-            await query.message.edit_text("✅ تم مسح قائمة المستخدمين الخاصين.")
-            await query.answer()
-
-        elif data == 'cancel_clear':
+            store.move_progress(user_id, quiz_id, next_grp_id)
             await query.message.delete()
+            await send_next_ui(update, context, user_id, quiz_id, use_callback=False)
             await query.answer()
+        except Exception as e:
+            logging.exception("خطأ في continue_")
+            await query.answer(f"حدث خطأ: {str(e)}", show_alert=True)
 
-        elif data.startswith('up_'):
-            quiz_id = int(data.split('_')[1])
-            context.user_data['up_id'] = quiz_id
-            await query.message.reply_text("📥 أرسل ملف الإكسل الآن:")
-            await query.answer()
-
-        elif data.startswith('showf_'):
-            quiz_id = int(data.split('_')[1])
-            grps = conn.execute('SELECT id, file_name FROM groups WHERE quiz_id=?', (quiz_id,)).fetchall()
-            for g in grps:
-                btn = [[InlineKeyboardButton(f"🗑 حذف {g[1]}", callback_data=f"delgrp_{g[0]}")]]
-                await context.bot.send_message(chat_id=OWNER_ID, text=f"📄 ملف: {g[1]}", reply_markup=InlineKeyboardMarkup(btn))
-            await query.answer()
-
-        elif data.startswith('delgrp_'):
-            grp_id = int(data.split('_')[1])
-            conn.execute('DELETE FROM questions WHERE group_id=?', (grp_id,))
-            conn.execute('DELETE FROM groups WHERE id=?', (grp_id,))
-            conn.commit()
-            await query.message.delete()
+    elif data.startswith('pdf_'):
+        grp_id = int(data.split('_')[1])
+        if not can_download_group(user_id, grp_id):
+            await query.answer("⛔ لا يمكنك تحميل هذه المجموعة.", show_alert=True)
+            return
+        await query.answer("⏳ جاري تجهيز ملف PDF...")
+        try:
+            await send_group_pdf(context, user_id, grp_id)
+        except Exception as e:
+            logging.exception("خطأ في تصدير PDF")
+            await context.bot.send_message(chat_id=user_id, text=f"❌ تعذر تجهيز ملف PDF: {e}")
 
-        elif data.startswith('delquiz_'):
-            quiz_id = int(data.split('_')[1])
-            keyboard = [[
-                InlineKeyboardButton("✅ نعم، احذف الاختبار", callback_data=f"confirm_delquiz_{quiz_id}"),
-                InlineKeyboardButton("❌ إلغاء", callback_data="cancel_delquiz")
-            ]]
-            await query.message.reply_text("⚠️ هل أنت متأكد من حذف هذا الاختبار بالكامل؟\nسيتم حذف جميع المجموعات والأسئلة وتقدم المستخدمين والوصول الخاص.",
-                                           reply_markup=InlineKeyboardMarkup(keyboard))
-            await query.answer()
+    elif data.startswith('srch_'):
+        if user_id != OWNER_ID:
+            return
+        text = context.user_data.get('search_query')
+        if not text:
+            await query.answer("⚠️ انتهت جلسة البحث، أعد إرسال /search", show_alert=True)
+            return
+        msg, markup = render_search_page(text, int(data.split('_')[1]))
+        await query.edit_message_text(msg, reply_markup=markup)
+        await query.answer()
 
-        elif data.startswith('confirm_delquiz_'):
-            quiz_id = int(data.split('_')[2])
-            conn.execute('DELETE FROM questions WHERE quiz_id=?', (quiz_id,))
-            conn.execute('DELETE FROM groups WHERE quiz_id=?', (quiz_id,))
-            conn.execute('DELETE FROM progress WHERE quiz_id=?', (quiz_id,))
-            conn.execute('DELETE FROM private_access WHERE quiz_id=?', (quiz_id,))
-            conn.execute('DELETE FROM quizzes WHERE id=?', (quiz_id,))
-            conn.commit()
-            await query.message.edit_text("✅ تم حذف الاختبار وجميع بياناته.")
-            await query.answer()
+    elif data.startswith('editq_'):
+        if user_id != OWNER_ID:
+            return
+        text, markup = render_question_editor(int(data.split('_')[1]))
+        await query.message.reply_text(text, reply_markup=markup)
+        await query.answer()
 
-        elif data == 'cancel_delquiz':
-            await query.message.delete()
+    elif data.startswith('editqf_'):
+        if user_id != OWNER_ID:
+            return
+        _, qid, field = data.split('_', 2)
+        if field not in QUESTION_FIELDS:
             await query.answer()
+            return
+        context.user_data['awaiting_qedit'] = (int(qid), field)
+        await query.message.reply_text(f"✏️ أرسل القيمة الجديدة لـ {QUESTION_FIELDS[field]} في السؤال #{qid}:")
+        await query.answer()
 
-        elif data.startswith('editname_'):
+    elif data.startswith('shufq_') or data.startswith('shufo_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[1])
+        column = 'shuffle_questions' if data.startswith('shufq_') else 'shuffle_options'
+        store.toggle_quiz_flag(quiz_id, column)
+        row = next((q for q in store.quiz_overview() if q[0] == quiz_id), None)
+        if row:
+            text, markup = render_quiz_card(row)
+            await query.edit_message_text(text, reply_markup=markup, parse_mode='Markdown')
+        await query.answer("🔀 تم تحديث إعداد الخلط")
+
+    elif data.startswith('tog_'):
+        quiz_id = int(data.split('_')[1])
+        store.toggle_quiz_flag(quiz_id, 'is_active')
+        await query.answer("🔄 تم تحديث حالة الظهور")
+
+    elif data.startswith('newpriv_'):
+        try:
             quiz_id = int(data.split('_')[1])
-            context.user_data['awaiting_newname'] = quiz_id
-            await query.message.reply_text("✏️ أرسل الاسم الجديد للاختبار:")
-            await query.answer()
-
-        elif data == 'set_channel_id':
-            context.user_data['awaiting_channel_id'] = True
-            await query.message.reply_text("📝 أرسل معرف القناة (مثال: @my_channel أو -1001234567890):")
-            await query.answer()
-
-        elif data == 'set_channel_link':
-            context.user_data['awaiting_channel_link'] = True
-            await query.message.reply_text("🔗 أرسل رابط القناة (مثال: https://t.me/my_channel):")
-            await query.answer()
-
-        elif data == 'clear_channel':
-            update_setting('required_channel', '')
-            update_setting('channel_link', '')
-            await query.message.edit_text("✅ تم إلغاء فرض الاشتراك في القناة.")
-            await query.answer()
-
-        elif data == 'toggle_show_link':
-            current = get_setting('show_channel_link')
-            new_value = '0' if current == '1' else '1'
-            update_setting('show_channel_link', new_value)
-            status = "مفعل ✅" if new_value == '1' else "معطل ❌"
-            await query.message.edit_text(
-                f"🔗 تم تغيير حالة إظهار رابط القناة إلى: {status}",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("رجوع", callback_data="back_to_channel_settings")
-                ]])
-            )
-            await query.answer()
-
-        elif data == 'back_to_channel_settings':
-            current_channel = get_setting('required_channel')
-            current_link = get_setting('channel_link')
-            show_link = get_setting('show_channel_link')
-            channel_display = current_channel if current_channel else 'غير محدد'
-            link_display = current_link if current_link else 'غير محدد'
-            show_status = "مفعل ✅" if show_link == '1' else "معطل ❌"
-
-            settings_text = (
-                f"🔧 **إعدادات القناة الإجبارية:**\n"
-                f"• معرف القناة: {channel_display}\n"
-                f"• رابط القناة: {link_display}\n"
-                f"• إظهار الرابط للمستخدمين: {show_status}\n"
-            )
-
-            settings_buttons = [
-                [InlineKeyboardButton("✏️ تغيير معرف القناة", callback_data="set_channel_id")],
-                [InlineKeyboardButton("🔗 تغيير رابط القناة", callback_data="set_channel_link")],
-                [InlineKeyboardButton("🗑️ إلغاء فرض القناة", callback_data="clear_channel")],
-                [InlineKeyboardButton(f"👁️ إظهار الرابط: {show_status}", callback_data="toggle_show_link")]
-            ]
-            await query.message.edit_text(
-                settings_text,
-                reply_markup=InlineKeyboardMarkup(settings_buttons),
-                parse_mode='Markdown'
-            )
-            await query.answer()
+            token = secrets.token_urlsafe(8)
+            store.update_quiz(quiz_id, private_token=token)
+            bot_user = await context.bot.get_me()
+            username = bot_user.username
+            link = f"https://t.me/{username}?start={token}"
+            await query.message.reply_text(f"🔗 رابط خاص جديد:\n`{link}`", parse_mode='Markdown')
+            await query.answer("✅ تم توليد رابط جديد")
+        except Exception as e:
+            logging.exception("خطأ في معالجة newpriv")
+            await query.answer(f"❌ حدث خطأ: {str(e)}", show_alert=True)
 
-        elif data == 'toggle_bot':
-            current = get_setting('bot_active')
-            new_value = '0' if current == '1' else '1'
-            update_setting('bot_active', new_value)
-            status_text = "نشط ✅" if new_value == '1' else "متوقف ⛔"
-            await query.message.edit_text(
-                f"⚡ تم تغيير حالة البوت إلى: {status_text}",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("رجوع", callback_data="back_to_bot_settings")
-                ]])
-            )
-            await query.answer()
+    elif data.startswith('setttl_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[1])
+        context.user_data['awaiting_ttl'] = quiz_id
+        await query.message.reply_text(f"⏳ أرسل عدد الأيام التي تُؤرشف بعدها الجلسات الخاملة (0 يعني الافتراضي {SESSION_TTL_DAYS}):")
+        await query.answer()
+
+    elif data.startswith('setmax_'):
+        quiz_id = int(data.split('_')[1])
+        context.user_data['awaiting_max'] = quiz_id
+        await query.message.reply_text("📝 أرسل العدد الأقصى للمستخدمين (0 يعني غير محدود):")
+        await query.answer()
+
+    elif data.startswith('showpriv_'):
+        quiz_id = int(data.split('_')[1])
+        users = store.private_users(quiz_id)
+        if not users:
+            await query.message.reply_text("👥 لا يوجد مستخدمين خاصين حتى الآن.")
+        else:
+            msg = "📋 قائمة المستخدمين الخاصين:\n"
+            for u in users:
+                msg += f"• {u[1]} (@{u[2]}) - {u[3]}\n"
+            await query.message.reply_text(msg)
+        await query.answer()
+
+    elif data.startswith('clearpriv_'):
+        quiz_id = int(data.split('_')[1])
+        keyboard = [[
+            InlineKeyboardButton("✅ نعم، احذف", callback_data=f"confirm_clear_{quiz_id}"),
+            InlineKeyboardButton("❌ إلغاء", callback_data="cancel_clear")
+        ]]
+        await query.message.reply_text("⚠️ هل أنت متأكد من حذف جميع المستخدمين الخاصين لهذا الاختبار؟",
+                                       reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.answer()
+
+    elif data.startswith('confirm_clear_'):
+        quiz_id = int(data.split('_')[2])
+        store.clear_private_access(quiz_id)
+        await query.message.edit_text("✅ تم مسح قائمة المستخدمين الخاصين.")
+        await query.answer()
+
+    elif data == 'cancel_clear':
+        await query.message.delete()
+        await query.answer()
+
+    elif data.startswith('up_'):
+        quiz_id = int(data.split('_')[1])
+        context.user_data['up_id'] = quiz_id
+        await query.message.reply_text("📥 أرسل ملف الإكسل الآن، أو أرشيف ZIP يحتوي الملف مع الصور المذكورة في عمود Image:")
+        await query.answer()
+
+    elif data.startswith('showf_'):
+        quiz_id = int(data.split('_')[1])
+        grps = store.list_groups(quiz_id)
+        for g in grps:
+            btn = [[InlineKeyboardButton(f"🗑 حذف {g[1]}", callback_data=f"delgrp_{g[0]}"),
+                    InlineKeyboardButton("📄 تحميل PDF", callback_data=f"pdf_{g[0]}")]]
+            await context.bot.send_message(chat_id=OWNER_ID, text=f"📄 ملف: {g[1]}", reply_markup=InlineKeyboardMarkup(btn))
+        await query.answer()
+
+    elif data.startswith('delgrp_'):
+        if user_id != OWNER_ID:
+            return
+        grp_id = int(data.split('_')[1])
+        # حذف صف المجموعة أولاً يخفيها فوراً، ثم تحذف أسئلتها على دفعات
+        store.delete_group(grp_id)
+        await start_purge(context, f"grp_{grp_id}", group_purge_steps(grp_id),
+                          query.message, "حذف ملف الأسئلة")
+        await query.answer()
+
+    elif data.startswith('delquiz_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[1])
+        keyboard = [[
+            InlineKeyboardButton("✅ نعم، احذف الاختبار", callback_data=f"confirm_delquiz_{quiz_id}"),
+            InlineKeyboardButton("❌ إلغاء", callback_data="cancel_delquiz")
+        ]]
+        await query.message.reply_text("⚠️ هل أنت متأكد من حذف هذا الاختبار بالكامل؟\nسيتم حذف جميع المجموعات والأسئلة وتقدم المستخدمين والوصول الخاص.",
+                                       reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.answer()
+
+    elif data.startswith('confirm_delquiz_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[2])
+        # إخفاء الاختبار وإبطال رابطه الخاص حتى لا يدخله أحد أثناء الحذف
+        store.update_quiz(quiz_id, is_active=0, private_token=None)
+        await start_purge(context, f"quiz_{quiz_id}", quiz_purge_steps(quiz_id),
+                          query.message, "حذف الاختبار وجميع بياناته")
+        await query.answer()
+
+    elif data.startswith('resetprog_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[1])
+        keyboard = [[
+            InlineKeyboardButton("✅ نعم، صفّر التقدم", callback_data=f"confirm_resetprog_{quiz_id}"),
+            InlineKeyboardButton("❌ إلغاء", callback_data="cancel_clear")
+        ]]
+        await query.message.reply_text("⚠️ هل أنت متأكد من تصفير تقدم جميع المستخدمين في هذا الاختبار؟",
+                                       reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.answer()
+
+    elif data.startswith('confirm_resetprog_'):
+        if user_id != OWNER_ID:
+            return
+        quiz_id = int(data.split('_')[2])
+        await start_purge(context, f"progress_{quiz_id}", progress_purge_steps(quiz_id),
+                          query.message, "تصفير تقدم الاختبار")
+        await query.answer()
+
+    elif data == 'cancel_delquiz':
+        await query.message.delete()
+        await query.answer()
+
+    elif data.startswith('editname_'):
+        quiz_id = int(data.split('_')[1])
+        context.user_data['awaiting_newname'] = quiz_id
+        await query.message.reply_text("✏️ أرسل الاسم الجديد للاختبار:")
+        await query.answer()
+
+    elif data == 'set_channel_id':
+        context.user_data['awaiting_channel_id'] = True
+        await query.message.reply_text("📝 أرسل معرف القناة (مثال: @my_channel أو -1001234567890):")
+        await query.answer()
+
+    elif data == 'set_channel_link':
+        context.user_data['awaiting_channel_link'] = True
+        await query.message.reply_text("🔗 أرسل رابط القناة (مثال: https://t.me/my_channel):")
+        await query.answer()
+
+    elif data == 'clear_channel':
+        update_setting('required_channel', '')
+        update_setting('channel_link', '')
+        await query.message.edit_text("✅ تم إلغاء فرض الاشتراك في القناة.")
+        await query.answer()
+
+    elif data == 'toggle_show_link':
+        current = get_setting('show_channel_link')
+        new_value = '0' if current == '1' else '1'
+        update_setting('show_channel_link', new_value)
+        status = "مفعل ✅" if new_value == '1' else "معطل ❌"
+        await query.message.edit_text(
+            f"🔗 تم تغيير حالة إظهار رابط القناة إلى: {status}",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("رجوع", callback_data="back_to_channel_settings")
+            ]])
+        )
+        await query.answer()
+
+    elif data == 'back_to_channel_settings':
+        current_channel = get_setting('required_channel')
+        current_link = get_setting('channel_link')
+        show_link = get_setting('show_channel_link')
+        channel_display = current_channel if current_channel else 'غير محدد'
+        link_display = current_link if current_link else 'غير محدد'
+        show_status = "مفعل ✅" if show_link == '1' else "معطل ❌"
+
+        settings_text = (
+            f"🔧 **إعدادات القناة الإجبارية:**\n"
+            f"• معرف القناة: {channel_display}\n"
+            f"• رابط القناة: {link_display}\n"
+            f"• إظهار الرابط للمستخدمين: {show_status}\n"
+        )
 
-        elif data == 'back_to_bot_settings':
-            current = get_setting('bot_active')
-            status_text = "نشط ✅" if current == '1' else "متوقف ⛔"
-            text = f"⚡ **حالة البوت الحالية:** {status_text}\n\nاختر الإجراء المطلوب:"
-            keyboard = [[InlineKeyboardButton("🔁 تبديل الحالة", callback_data="toggle_bot")]]
-            await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-            await query.answer()
+        settings_buttons = [
+            [InlineKeyboardButton("✏️ تغيير معرف القناة", callback_data="set_channel_id")],
+            [InlineKeyboardButton("🔗 تغيير رابط القناة", callback_data="set_channel_link")],
+            [InlineKeyboardButton("🗑️ إلغاء فرض القناة", callback_data="clear_channel")],
+            [InlineKeyboardButton(f"👁️ إظهار الرابط: {show_status}", callback_data="toggle_show_link")]
+        ]
+        await query.message.edit_text(
+            settings_text,
+            reply_markup=InlineKeyboardMarkup(settings_buttons),
+            parse_mode='Markdown'
+        )
+        await query.answer()
+
+    elif data == 'toggle_bot':
+        current = get_setting('bot_active')
+        new_value = '0' if current == '1' else '1'
+        update_setting('bot_active', new_value)
+        status_text = "نشط ✅" if new_value == '1' else "متوقف ⛔"
+        await query.message.edit_text(
+            f"⚡ تم تغيير حالة البوت إلى: {status_text}",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("رجوع", callback_data="back_to_bot_settings")
+            ]])
+        )
+        await query.answer()
 
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+    elif data == 'back_to_bot_settings':
+        current = get_setting('bot_active')
+        status_text = "نشط ✅" if current == '1' else "متوقف ⛔"
+        text = f"⚡ **حالة البوت الحالية:** {status_text}\n\nاختر الإجراء المطلوب:"
+        keyboard = [[InlineKeyboardButton("🔁 تبديل الحالة", callback_data="toggle_bot")]]
+        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await query.answer()
 
 # --- دالة مسح سجلات التقدم ---
 async def clear_progress_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        conn = sqlite3.connect('quiz_system.db')
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM progress')
-        conn.commit()
-        conn.close()
-        await update.message.reply_text("✅ تم مسح جميع سجلات تقدم المستخدمين بنجاح.")
-    except Exception as e:
-        await update.message.reply_text(f"❌ حدث خطأ أثناء المسح: {e}")
+    status_msg = await update.message.reply_text("⏳ جاري التحضير لمسح سجلات التقدم...")
+    await start_purge(context, "progress_all", progress_purge_steps(),
+                      status_msg, "مسح جميع سجلات تقدم المستخدمين")
 
 # --- لوحة الإدارة ---
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -708,7 +1398,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ["➕ إنشاء اختبار", "⚙️ إدارة الاختبارات"],
         ["🔧 إعدادات القناة", "⚡ تشغيل/إيقاف البوت"],
-        ["🧹 تصفير السجلات", "📧 البريد"]
+        ["🧹 تصفير السجلات", "📧 البريد"],
+        ["📊 الجلسات", "🩺 التشخيص"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text(
@@ -717,10 +1408,36 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+# بطاقة الاختبار في لوحة الإدارة، تُبنى من صف quiz_overview
+def render_quiz_card(q):
+    qid, name, active, maxu, used, shuf_q, shuf_o, ttl_days, files_count, questions_count, users_count = q
+    status = "🟢 نشط" if active else "🔴 مخفي"
+    priv_info = f"👥 {used}/{maxu if maxu>0 else '∞'}"
+    info_text = (f"📑 **{name}**\n"
+                 f"📂 الملفات: {files_count} | ❓ الأسئلة: {questions_count} | 👥 المستخدمين: {users_count}\n"
+                 f"الحالة: {status} | الحد الأقصى: {priv_info}")
+
+    btns = [
+        [InlineKeyboardButton("➕ رفع ملف", callback_data=f"up_{qid}"),
+         InlineKeyboardButton("📂 الملفات", callback_data=f"showf_{qid}")],
+        [InlineKeyboardButton(f"الحالة: {status}", callback_data=f"tog_{qid}"),
+         InlineKeyboardButton("🔗 رابط خاص جديد", callback_data=f"newpriv_{qid}")],
+        [InlineKeyboardButton(f"⚙️ حد أقصى {priv_info}", callback_data=f"setmax_{qid}"),
+         InlineKeyboardButton("👥 عرض المستخدمين", callback_data=f"showpriv_{qid}")],
+        [InlineKeyboardButton("🗑 مسح القائمة الخاصة", callback_data=f"clearpriv_{qid}"),
+         InlineKeyboardButton("❌ حذف الاختبار", callback_data=f"delquiz_{qid}"),
+         InlineKeyboardButton("✏️ تعديل الاسم", callback_data=f"editname_{qid}")],
+        [InlineKeyboardButton("🧹 تصفير تقدم الاختبار", callback_data=f"resetprog_{qid}"),
+         InlineKeyboardButton("🏆 المتصدرون", callback_data=f"admtop_{qid}")],
+        [InlineKeyboardButton(f"🔀 خلط الأسئلة: {'✅' if shuf_q else '❌'}", callback_data=f"shufq_{qid}"),
+         InlineKeyboardButton(f"🔀 خلط الخيارات: {'✅' if shuf_o else '❌'}", callback_data=f"shufo_{qid}")],
+        [InlineKeyboardButton(f"⏳ أرشفة الجلسات بعد {ttl_days or SESSION_TTL_DAYS} يوم", callback_data=f"setttl_{qid}")]
+    ]
+    return info_text, InlineKeyboardMarkup(btns)
+
 # --- معالجة النصوص من المشرف ---
 async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text
-    conn = get_db()
 
     if txt == "📧 البريد":
         await update.message.reply_text("📝 أرسل الآن نص الرسالة التي تريد إرسالها لجميع المستخدمين.")
@@ -748,130 +1465,259 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await clear_progress_data(update, context)
         return
 
-    try:
-        if context.user_data.get('awaiting_channel_id'):
-            update_setting('required_channel', txt)
-            del context.user_data['awaiting_channel_id']
-            await update.message.reply_text(f"✅ تم تعيين معرف القناة إلى: {txt}")
+    if 'awaiting_qedit' in context.user_data and update.effective_user.id == OWNER_ID:
+        qid, field = context.user_data.pop('awaiting_qedit')
+        value = txt.strip()
+        if field == 'correct':
+            value = value.upper()
+            if value not in ('A', 'B', 'C', 'D'):
+                await update.message.reply_text("❌ الإجابة الصحيحة يجب أن تكون أحد الأحرف A أو B أو C أو D.")
+                return
+        saved = store.update_question(qid, field, value)
+        if saved is None:
+            await update.message.reply_text("⚠️ السؤال غير موجود (ربما تم حذفه).")
             return
-
-        if context.user_data.get('awaiting_channel_link'):
-            update_setting('channel_link', txt)
-            del context.user_data['awaiting_channel_link']
-            await update.message.reply_text(f"✅ تم تعيين رابط القناة إلى: {txt}")
+        if not saved:
+            await update.message.reply_text("❌ يوجد سؤال مطابق تماماً في نفس المجموعة، لم يتم الحفظ.")
             return
+        text, markup = render_question_editor(qid)
+        await update.message.reply_text(f"✅ تم تحديث {QUESTION_FIELDS[field]}.\n\n{text}", reply_markup=markup)
+        return
 
-        if 'awaiting_newname' in context.user_data:
-            quiz_id = context.user_data['awaiting_newname']
-            try:
-                conn.execute('UPDATE quizzes SET name=? WHERE id=?', (txt, quiz_id))
-                conn.commit()
-                await update.message.reply_text(f"✅ تم تحديث اسم الاختبار إلى: {txt}")
-            except Exception as e:
-                await update.message.reply_text(f"❌ حدث خطأ أثناء تحديث الاسم: {e}")
-            finally:
-                del context.user_data['awaiting_newname']
-            return
+    if context.user_data.get('awaiting_channel_id'):
+        update_setting('required_channel', txt)
+        del context.user_data['awaiting_channel_id']
+        await update.message.reply_text(f"✅ تم تعيين معرف القناة إلى: {txt}")
+        return
 
-        if txt == "➕ إنشاء اختبار":
-            await update.message.reply_text("أرسل اسم الاختبار:")
-            context.user_data['state'] = 'naming'
-
-        elif context.user_data.get('state') == 'naming':
-            conn.execute('INSERT INTO quizzes (name) VALUES (?)', (txt,))
-            conn.commit()
-            await update.message.reply_text(f"✅ تم إنشاء الاختبار: {txt}")
-            context.user_data['state'] = None
-
-        elif txt == "⚙️ إدارة الاختبارات":
-            quizzes = conn.execute('''
-                SELECT 
-                    q.id, 
-                    q.name, 
-                    q.is_active,
-                    q.max_users,
-                    q.used_users,
-                    (SELECT COUNT(*) FROM groups WHERE quiz_id = q.id) as files_count,
-                    (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id) as questions_count,
-                    (SELECT COUNT(DISTINCT user_id) FROM progress WHERE quiz_id = q.id) as users_count
-                FROM quizzes q
-            ''').fetchall()
-
-            if not quizzes:
-                await update.message.reply_text("📭 لا توجد اختبارات مضافة بعد.")
-            else:
-                for q in quizzes:
-                    qid, name, active, maxu, used, files_count, questions_count, users_count = q
-                    status = "🟢 نشط" if active else "🔴 مخفي"
-                    priv_info = f"👥 {used}/{maxu if maxu>0 else '∞'}"
-                    info_text = (f"📑 **{name}**\n"
-                                 f"📂 الملفات: {files_count} | ❓ الأسئلة: {questions_count} | 👥 المستخدمين: {users_count}\n"
-                                 f"الحالة: {status} | الحد الأقصى: {priv_info}")
-
-                    btns = [
-                        [InlineKeyboardButton("➕ رفع ملف", callback_data=f"up_{qid}"),
-                         InlineKeyboardButton("📂 الملفات", callback_data=f"showf_{qid}")],
-                        [InlineKeyboardButton(f"الحالة: {status}", callback_data=f"tog_{qid}"),
-                         InlineKeyboardButton("🔗 رابط خاص جديد", callback_data=f"newpriv_{qid}")],
-                        [InlineKeyboardButton(f"⚙️ حد أقصى {priv_info}", callback_data=f"setmax_{qid}"),
-                         InlineKeyboardButton("👥 عرض المستخدمين", callback_data=f"showpriv_{qid}")],
-                        [InlineKeyboardButton("🗑 مسح القائمة الخاصة", callback_data=f"clearpriv_{qid}"),
-                         InlineKeyboardButton("❌ حذف الاختبار", callback_data=f"delquiz_{qid}"),
-                         InlineKeyboardButton("✏️ تعديل الاسم", callback_data=f"editname_{qid}")]
-                    ]
-                    await update.message.reply_text(info_text, reply_markup=InlineKeyboardMarkup(btns), parse_mode='Markdown')
-
-        elif txt == "🔧 إعدادات القناة":
-            current_channel = get_setting('required_channel')
-            current_link = get_setting('channel_link')
-            show_link = get_setting('show_channel_link')
-            channel_display = current_channel if current_channel else 'غير محدد'
-            link_display = current_link if current_link else 'غير محدد'
-            show_status = "مفعل ✅" if show_link == '1' else "معطل ❌"
-
-            settings_text = (
-                f"🔧 **إعدادات القناة الإجبارية:**\n"
-                f"• معرف القناة: {channel_display}\n"
-                f"• رابط القناة: {link_display}\n"
-                f"• إظهار الرابط للمستخدمين: {show_status}\n"
-            )
+    if context.user_data.get('awaiting_channel_link'):
+        update_setting('channel_link', txt)
+        del context.user_data['awaiting_channel_link']
+        await update.message.reply_text(f"✅ تم تعيين رابط القناة إلى: {txt}")
+        return
 
-            settings_buttons = [
-                [InlineKeyboardButton("✏️ تغيير معرف القناة", callback_data="set_channel_id")],
-                [InlineKeyboardButton("🔗 تغيير رابط القناة", callback_data="set_channel_link")],
-                [InlineKeyboardButton("🗑️ إلغاء فرض القناة", callback_data="clear_channel")],
-                [InlineKeyboardButton(f"👁️ إظهار الرابط: {show_status}", callback_data="toggle_show_link")]
-            ]
+    if 'awaiting_newname' in context.user_data:
+        quiz_id = context.user_data['awaiting_newname']
+        try:
+            store.update_quiz(quiz_id, name=txt)
+            await update.message.reply_text(f"✅ تم تحديث اسم الاختبار إلى: {txt}")
+        except Exception as e:
+            await update.message.reply_text(f"❌ حدث خطأ أثناء تحديث الاسم: {e}")
+        finally:
+            del context.user_data['awaiting_newname']
+        return
 
-            await update.message.reply_text(
-                settings_text,
-                reply_markup=InlineKeyboardMarkup(settings_buttons),
-                parse_mode='Markdown'
-            )
+    if txt == "➕ إنشاء اختبار":
+        await update.message.reply_text("أرسل اسم الاختبار:")
+        context.user_data['state'] = 'naming'
 
-        elif txt == "⚡ تشغيل/إيقاف البوت":
-            current = get_setting('bot_active')
-            status_text = "نشط ✅" if current == '1' else "متوقف ⛔"
-            text = f"⚡ **حالة البوت الحالية:** {status_text}\n\nاختر الإجراء المطلوب:"
-            keyboard = [[InlineKeyboardButton("🔁 تبديل الحالة", callback_data="toggle_bot")]]
-            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    elif context.user_data.get('state') == 'naming':
+        store.create_quiz(txt)
+        await update.message.reply_text(f"✅ تم إنشاء الاختبار: {txt}")
+        context.user_data['state'] = None
 
-        elif 'awaiting_max' in context.user_data:
-            try:
-                new_max = int(txt)
-                quiz_id = context.user_data['awaiting_max']
-                conn.execute('UPDATE quizzes SET max_users=? WHERE id=?', (new_max, quiz_id))
-                conn.commit()
-                await update.message.reply_text(f"✅ تم تعيين الحد الأقصى للاختبار إلى {new_max}.")
-            except ValueError:
-                await update.message.reply_text("❌ الرجاء إدخال رقم صحيح.")
-            finally:
-                del context.user_data['awaiting_max']
+    elif txt == "⚙️ إدارة الاختبارات":
+        quizzes = store.quiz_overview()
 
-    finally:
-        conn.close()
+        if not quizzes:
+            await update.message.reply_text("📭 لا توجد اختبارات مضافة بعد.")
+        else:
+            for q in quizzes:
+                info_text, markup = render_quiz_card(q)
+                await update.message.reply_text(info_text, reply_markup=markup, parse_mode='Markdown')
+
+    elif txt == "🔧 إعدادات القناة":
+        current_channel = get_setting('required_channel')
+        current_link = get_setting('channel_link')
+        show_link = get_setting('show_channel_link')
+        channel_display = current_channel if current_channel else 'غير محدد'
+        link_display = current_link if current_link else 'غير محدد'
+        show_status = "مفعل ✅" if show_link == '1' else "معطل ❌"
+
+        settings_text = (
+            f"🔧 **إعدادات القناة الإجبارية:**\n"
+            f"• معرف القناة: {channel_display}\n"
+            f"• رابط القناة: {link_display}\n"
+            f"• إظهار الرابط للمستخدمين: {show_status}\n"
+        )
+
+        settings_buttons = [
+            [InlineKeyboardButton("✏️ تغيير معرف القناة", callback_data="set_channel_id")],
+            [InlineKeyboardButton("🔗 تغيير رابط القناة", callback_data="set_channel_link")],
+            [InlineKeyboardButton("🗑️ إلغاء فرض القناة", callback_data="clear_channel")],
+            [InlineKeyboardButton(f"👁️ إظهار الرابط: {show_status}", callback_data="toggle_show_link")]
+        ]
+
+        await update.message.reply_text(
+            settings_text,
+            reply_markup=InlineKeyboardMarkup(settings_buttons),
+            parse_mode='Markdown'
+        )
+
+    elif txt == "📊 الجلسات" and update.effective_user.id == OWNER_ID:
+        await update.message.reply_text(format_session_metrics(), parse_mode='Markdown')
+
+    elif txt == "🩺 التشخيص" and update.effective_user.id == OWNER_ID:
+        await update.message.reply_text(format_diagnostics())
+
+    elif txt == "⚡ تشغيل/إيقاف البوت":
+        current = get_setting('bot_active')
+        status_text = "نشط ✅" if current == '1' else "متوقف ⛔"
+        text = f"⚡ **حالة البوت الحالية:** {status_text}\n\nاختر الإجراء المطلوب:"
+        keyboard = [[InlineKeyboardButton("🔁 تبديل الحالة", callback_data="toggle_bot")]]
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+    elif 'awaiting_max' in context.user_data:
+        try:
+            new_max = int(txt)
+            quiz_id = context.user_data['awaiting_max']
+            store.update_quiz(quiz_id, max_users=new_max)
+            await update.message.reply_text(f"✅ تم تعيين الحد الأقصى للاختبار إلى {new_max}.")
+        except ValueError:
+            await update.message.reply_text("❌ الرجاء إدخال رقم صحيح.")
+        finally:
+            del context.user_data['awaiting_max']
+
+    elif 'awaiting_ttl' in context.user_data and update.effective_user.id == OWNER_ID:
+        try:
+            ttl_days = int(txt)
+            if ttl_days < 0:
+                raise ValueError
+            quiz_id = context.user_data['awaiting_ttl']
+            store.update_quiz(quiz_id, session_ttl_days=ttl_days)
+            shown = ttl_days if ttl_days else f"الافتراضي ({SESSION_TTL_DAYS})"
+            await update.message.reply_text(f"✅ تم تعيين مدة خمول الجلسات لهذا الاختبار إلى {shown} يوم.")
+        except ValueError:
+            await update.message.reply_text("❌ الرجاء إدخال رقم صحيح.")
+        finally:
+            del context.user_data['awaiting_ttl']
+
+
+# --- البحث في بنك الأسئلة وتعديلها ---
+SEARCH_PAGE_SIZE = 5
+QUESTION_FIELDS = {
+    'stem': "نص السؤال",
+    'a': "الخيار A",
+    'b': "الخيار B",
+    'c': "الخيار C",
+    'd': "الخيار D",
+    'correct': "الإجابة الصحيحة",
+    'explanation': "الشرح",
+}
+
+def render_search_page(text, page):
+    total, rows = store.search_questions(text, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+    if not total:
+        return f"🔍 لا توجد نتائج لـ: {text}", None
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    lines = [f"🔍 نتائج البحث عن: {text}", f"📊 {total} نتيجة | صفحة {page + 1}/{pages}", ""]
+    btns = []
+    for qid, quiz_name, file_name, snip in rows:
+        lines.append(f"#{qid} | {quiz_name} / {file_name}\n{snip}\n")
+        btns.append([InlineKeyboardButton(f"✏️ تعديل السؤال #{qid}", callback_data=f"editq_{qid}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"srch_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"srch_{page + 1}"))
+    if nav:
+        btns.append(nav)
+    return '\n'.join(lines), InlineKeyboardMarkup(btns)
+
+def render_question_editor(qid):
+    q = store.get_question(qid)
+    if not q:
+        return "⚠️ السؤال غير موجود (ربما تم حذفه).", None
+    text = (f"📝 السؤال #{qid}\n\n{q[0]}\n\n"
+            f"A) {q[1]}\nB) {q[2]}\nC) {q[3]}\nD) {q[4]}\n\n"
+            f"✅ الصح: {q[5]}\n💡 الشرح: {q[6]}\n\nاختر الحقل الذي تريد تعديله:")
+    fields = list(QUESTION_FIELDS.items())
+    btns = [[InlineKeyboardButton(label, callback_data=f"editqf_{qid}_{field}") for field, label in fields[i:i + 2]]
+            for i in range(0, len(fields), 2)]
+    return text, InlineKeyboardMarkup(btns)
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        return
+    text = ' '.join(context.args).strip()
+    if not text:
+        await update.message.reply_text("🔍 الاستخدام: /search كلمات البحث")
+        return
+    context.user_data['search_query'] = text
+    try:
+        msg, markup = render_search_page(text, 0)
+    except StorageError as e:
+        await update.message.reply_text(f"❌ تعذر البحث: {e}")
+        return
+    await update.message.reply_text(msg, reply_markup=markup)
 
 # --- رفع ملف إكسل ---
+def find_zip_member(archive, ref):
+    names = [n for n in archive.namelist() if not n.endswith('/')]
+    if ref in names:
+        return ref
+    base = os.path.basename(ref.replace('\\', '/'))
+    for n in names:
+        if os.path.basename(n) == base:
+            return n
+    return None
+
+# الصور المضمنة في الورقة مرتبطة بالخلية التي ترتكز عليها، والصف الأول هو صف العناوين
+def read_embedded_images(sheet_name, sheet_bytes):
+    if not sheet_name.lower().endswith('.xlsx'):
+        return {}
+    from openpyxl import load_workbook
+    ws = load_workbook(io.BytesIO(sheet_bytes)).worksheets[0]
+    found = {}
+    for img in getattr(ws, '_images', []):
+        anchor = getattr(img.anchor, '_from', None)
+        if anchor is None:
+            continue
+        found.setdefault(anchor.row - 1, (img._data(), img.format or 'png'))
+    return found
+
+# تعمل في خيط منفصل: تقرأ الملف (إكسل أو أرشيف ZIP) وتحفظ الصور في المخزن
+def read_question_file(file_name, file_bytes):
+    import pandas as pd
+
+    archive = None
+    sheet_name, sheet_bytes = file_name, bytes(file_bytes)
+    if file_name.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(io.BytesIO(sheet_bytes))
+        sheets = [n for n in archive.namelist() if n.lower().endswith(('.xlsx', '.xls'))]
+        if not sheets:
+            raise ValueError("لا يوجد ملف إكسل داخل الأرشيف")
+        sheet_name = sheets[0]
+        sheet_bytes = archive.read(sheet_name)
+
+    df = pd.read_excel(io.BytesIO(sheet_bytes))
+    embedded = read_embedded_images(sheet_name, sheet_bytes)
+    rows, images = [], {}
+    for i, (_, r) in enumerate(df.iterrows()):
+        stem = str(r.get('Question_Stem', ''))
+        a = str(r.get('answer_A', ''))
+        b = str(r.get('answer_B', ''))
+        c = str(r.get('answer_C', ''))
+        d = str(r.get('answer_D', ''))
+        correct = str(r.get('Correct_Answer', '')).strip().upper()
+        explanation = str(r.get('Explanation', 'لا يوجد شرح'))
+
+        image_hash = None
+        ref = r.get('Image')
+        if archive is not None and is_option_text(ref):
+            member = find_zip_member(archive, str(ref).strip())
+            if member is None:
+                raise ValueError(f"الصورة '{ref}' غير موجودة داخل الأرشيف")
+            image_hash, path = save_image_bytes(archive.read(member), os.path.splitext(member)[1] or '.png')
+            images[image_hash] = path
+        elif i in embedded:
+            data, ext = embedded[i]
+            image_hash, path = save_image_bytes(data, ext)
+            images[image_hash] = path
+
+        rows.append((stem, a, b, c, d, correct, explanation, image_hash))
+    return rows, images
+
 async def on_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID or not context.user_data.get('up_id'):
         return
@@ -879,50 +1725,55 @@ async def on_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     doc = update.message.document
     file = await doc.get_file()
     file_bytes = await file.download_as_bytearray()
-    df = pd.read_excel(io.BytesIO(file_bytes))
 
-    conn = get_db()
     try:
-        cur = conn.cursor()
+        rows, images = await asyncio.to_thread(read_question_file, doc.file_name, file_bytes)
         group_name = os.path.splitext(doc.file_name)[0]
-        cur.execute('INSERT INTO groups (quiz_id, file_name) VALUES (?,?)', (qid, group_name))
-        grp_id = cur.lastrowid
-        for _, r in df.iterrows():
-            stem = str(r.get('Question_Stem', ''))
-            a = str(r.get('answer_A', ''))
-            b = str(r.get('answer_B', ''))
-            c = str(r.get('answer_C', ''))
-            d = str(r.get('answer_D', ''))
-            correct = str(r.get('Correct_Answer', '')).strip().upper()
-            explanation = str(r.get('Explanation', 'لا يوجد شرح'))
-            conn.execute('''INSERT INTO questions 
-                (quiz_id, group_id, stem, a, b, c, d, correct, explanation) 
-                VALUES (?,?,?,?,?,?,?,?,?)''',
-                (qid, grp_id, stem, a, b, c, d, correct, explanation))
-        conn.commit()
-        await update.message.reply_text(f"✅ تم استيراد '{doc.file_name}' بنجاح.")
+        reimported, summary = await asyncio.to_thread(store.import_group, qid, group_name, rows, images)
+        images_note = f" ({len(images)} صورة)" if images else ""
+        if reimported:
+            msg = (f"♻️ تم تحديث '{group_name}' من الملف '{doc.file_name}'{images_note}:\n"
+                   f"➕ أسئلة جديدة: {summary['added']}\n"
+                   f"✏️ أسئلة معدلة: {summary['updated']}\n"
+                   f"🗑 أسئلة أُزيلت من الملف: {summary['removed']}\n"
+                   f"✔️ بدون تغيير: {summary['unchanged']}")
+        else:
+            msg = f"✅ تم استيراد '{doc.file_name}' بنجاح ({summary['added']} سؤال){images_note}."
+        if summary['duplicates']:
+            msg += f"\n⚠️ تم تجاهل {summary['duplicates']} سؤال مكرر داخل الملف."
+        await update.message.reply_text(msg)
     except Exception as e:
         await update.message.reply_text(f"❌ حدث خطأ أثناء استيراد الملف: {e}")
-    finally:
-        conn.close()
 
 # --- التشغيل الرئيسي ---
 def main():
-    init_db()
-    keep_alive()
+    if RESTORE_FROM_BACKUP:
+        restore_from_backup(RESTORE_FROM_BACKUP)
+    store.init()
 
     while True:
         try:
             logger.info("يتم الآن تجهيز اتصال البوت...")
-            app_tg = Application.builder().token(BOT_TOKEN).build()
-
-            app_tg.add_handler(CommandHandler("start", start))
-            app_tg.add_handler(CommandHandler("admin", admin_panel))
-            app_tg.add_handler(MessageHandler(filters.Regex("^(➕ إنشاء اختبار|⚙️ إدارة الاختبارات|🔧 إعدادات القناة|⚡ تشغيل/إيقاف البوت|🧹 تصفير السجلات|📧 البريد)$"), handle_admin_text))
-            app_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_text))
-            app_tg.add_handler(MessageHandler(filters.Document.ALL, on_file_upload))
-            app_tg.add_handler(CallbackQueryHandler(handle_broadcast_confirmation, pattern="^broadcast_"))
-            app_tg.add_handler(CallbackQueryHandler(handle_callbacks))
+            app_tg = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
+
+            app_tg.add_handler(TypeHandler(Update, track_first_update), group=-1)
+
+            app_tg.add_handler(CommandHandler("start", timed(start)))
+            app_tg.add_handler(CommandHandler("admin", timed(admin_panel)))
+            app_tg.add_handler(CommandHandler("search", timed(search_command)))
+            app_tg.add_handler(CommandHandler("top", timed(top_command)))
+            app_tg.add_handler(CommandHandler("backup", timed(backup_command)))
+            app_tg.add_handler(MessageHandler(filters.Regex("^(➕ إنشاء اختبار|⚙️ إدارة الاختبارات|🔧 إعدادات القناة|⚡ تشغيل/إيقاف البوت|🧹 تصفير السجلات|📧 البريد|📊 الجلسات|🩺 التشخيص)$"), timed(handle_admin_text)))
+            app_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_admin_text)))
+            app_tg.add_handler(MessageHandler(filters.Document.ALL, timed(on_file_upload)))
+            app_tg.add_handler(CallbackQueryHandler(timed(handle_broadcast_confirmation), pattern="^broadcast_"))
+            app_tg.add_handler(CallbackQueryHandler(timed(handle_callbacks)))
+            if app_tg.job_queue:
+                app_tg.job_queue.run_repeating(evict_idle_sessions, interval=SESSION_EVICTION_INTERVAL, first=60)
+                if store.can_backup and BACKUP_INTERVAL > 0:
+                    app_tg.job_queue.run_repeating(run_backup, interval=BACKUP_INTERVAL, first=300)
+            else:
+                logger.warning("JobQueue غير متاح، لن تتم أرشفة الجلسات الخاملة ولا النسخ الاحتياطي تلقائياً")
             logger.info("البوت بدأ العمل بنجاح...")
             app_tg.run_polling(drop_pending_updates=True)
 